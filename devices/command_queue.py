@@ -0,0 +1,122 @@
+# devices/command_queue.py
+"""
+Hàng đợi lệnh theo từng ESP8266 (lưu trong Redis ESP_COMMAND_REDIS_URL, dùng chung giữa các worker):
+- Gộp lệnh: mỗi device chỉ giữ lệnh mới nhất, lệnh cũ chưa gửi sẽ bị bỏ (superseded)
+- Tuần tự: mỗi board chỉ nhận 1 request tại một thời điểm (lock theo IP, giữ cho từng lệnh)
+- toggle được đổi thành on/off dựa trên trạng thái mong muốn mới nhất,
+  nên bấm liên tục không làm trạng thái nhảy lung tung
+Lock và so sánh + xóa cần Redis thật (SET NX, script Lua), không dùng Django cache
+"""
+import threading
+import time
+import uuid
+
+import redis
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+LATEST_KEY = 'esp_cmd:latest:{device_id}'
+DESIRED_KEY = 'esp_cmd:desired:{device_id}'
+LOCK_KEY = 'esp_lock:{ip}'
+
+LOCK_POLL_SECONDS = 0.05
+
+# Xóa các key nếu KEYS[1] vẫn mang giá trị ARGV[1] (so sánh + xóa nguyên tử trong Redis)
+COMPARE_AND_DELETE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', unpack(KEYS))
+end
+return 0
+"""
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def get_redis():
+    """Redis client dùng chung (tạo 1 lần mỗi process, thread-safe)"""
+    global _client
+    if _client is None:
+        url = _setting('ESP_COMMAND_REDIS_URL', None)
+        if not url:
+            raise ImproperlyConfigured('ESP_COMMAND_REDIS_URL is required for the ESP8266 command queue')
+        with _client_lock:
+            if _client is None:
+                _client = redis.Redis.from_url(url, decode_responses=True)
+    return _client
+
+
+def enqueue(device, django_action):
+    """
+    Ghi nhận lệnh mới nhất cho device
+    Returns: (command_id, resolved_action) với resolved_action là 'on' / 'off'
+    """
+    ttl = _setting('ESP_COMMAND_TTL', 60)
+    device_id = str(device.id)
+    client = get_redis()
+
+    if django_action == 'toggle':
+        desired = client.get(DESIRED_KEY.format(device_id=device_id))
+        current = device.is_on if desired is None else desired == '1'
+        resolved_action = 'off' if current else 'on'
+    else:
+        resolved_action = django_action
+
+    command_id = str(uuid.uuid4())
+    # MULTI / EXEC: lệnh mới nhất và trạng thái mong muốn luôn đi cùng nhau
+    pipeline = client.pipeline()
+    pipeline.set(LATEST_KEY.format(device_id=device_id), command_id, ex=ttl)
+    pipeline.set(DESIRED_KEY.format(device_id=device_id), '1' if resolved_action == 'on' else '0', ex=ttl)
+    pipeline.execute()
+    return command_id, resolved_action
+
+
+def is_latest(device_id, command_id):
+    """Lệnh còn là lệnh mới nhất của device không (False = đã bị lệnh sau thay thế)"""
+    latest = get_redis().get(LATEST_KEY.format(device_id=device_id))
+    return latest is None or latest == command_id
+
+
+def _delete_if_equal(keys, value):
+    """Xóa keys nếu keys[0] vẫn bằng value (nguyên tử trong Redis)"""
+    client = get_redis()
+    client.register_script(COMPARE_AND_DELETE_SCRIPT)(keys=keys, args=[value])
+
+
+def finish(device_id, command_id):
+    """Xóa trạng thái mong muốn khi lệnh mới nhất đã xong"""
+    _delete_if_equal([
+        LATEST_KEY.format(device_id=device_id),
+        DESIRED_KEY.format(device_id=device_id),
+    ], command_id)
+
+
+def acquire_board(ip, command_id):
+    """
+    Giữ lock của board cho 1 lệnh (không chờ). Returns: True nếu lấy được
+    ESP_BOARD_LOCK_TTL phải lớn hơn thời gian 1 lệnh (timeout x số lần thử)
+    """
+    ttl = _setting('ESP_BOARD_LOCK_TTL', 15)
+    return bool(get_redis().set(LOCK_KEY.format(ip=ip), command_id, nx=True, ex=ttl))
+
+
+def wait_for_board(ip, command_id, timeout=None):
+    """Chờ đến khi lấy được lock của board. Returns: False nếu hết thời gian chờ"""
+    if timeout is None:
+        timeout = _setting('ESP_BOARD_LOCK_WAIT', 10)
+    deadline = time.monotonic() + timeout
+    while not acquire_board(ip, command_id):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(LOCK_POLL_SECONDS)
+    return True
+
+
+def release_board(ip, command_id):
+    """Trả lock của board (chỉ khi lock vẫn thuộc lệnh này)"""
+    _delete_if_equal([LOCK_KEY.format(ip=ip)], command_id)
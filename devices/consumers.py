@@ -1,54 +1,332 @@
 # devices/consumers.py
 import json
+from datetime import datetime
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from .models import Device
+from . import realtime
+
+try:
+    import msgpack
+except ImportError:  # msgpack không bắt buộc - chỉ hỗ trợ JSON
+    msgpack = None
+
+# Subprotocol cho encoding gọn (MessagePack + key ngắn + index thiết bị)
+COMPACT_SUBPROTOCOL = 'msgpack'
+
+# Key ngắn trong encoding gọn
+SHORT_KEYS = {
+    'type': 't',
+    'seq': 's',
+    'device': 'd',
+    'devices': 'D',
+    'updates': 'u',
+    'events': 'e',
+    'id': 'i',
+    'name': 'n',
+    'device_type': 'y',
+    'room': 'r',
+    'is_on': 'o',
+    'status': 'x',
+    'updated_at': 'a',
+    'command_id': 'c',
+    'device_id': 'i',
+    'message': 'm',
+    'action': 'ac',
+    'home': 'h',
+    'rooms': 'R',
+    'device_ids': 'I',
+}
+
+# Field của thiết bị đã có trong frame từ điển (bỏ khi trùng)
+DICTIONARY_FIELDS = ('name', 'device_type', 'room')
+
 
 class DeviceConsumer(AsyncWebsocketConsumer):
+    """
+    WebSocket cập nhật thiết bị (ws/devices/)
+
+    Chỉ user đã đăng nhập mới kết nối được. Client đăng ký thiết bị / phòng / cả nhà:
+        {"action": "subscribe", "device_ids": [...], "rooms": [...], "home": true}
+        {"action": "unsubscribe", "device_ids": [...], "rooms": [...], "home": true}
+
+    Tương thích client cũ (chưa gửi subscribe / unsubscribe): nhận cập nhật cả nhà,
+    mỗi thiết bị 1 message {"type": "device_update", "device": {...}} như trước.
+    Message subscribe / unsubscribe đầu tiên bỏ đăng ký mặc định này và chuyển sang device_batch.
+
+    Encoding gọn: client xin subprotocol "msgpack" (cần cài msgpack trên server).
+    Frame đầu tiên là từ điển {"t": "dictionary", "k": key ngắn, "D": [[id, name, device_type, room], ...]};
+    các frame sau là MessagePack với key ngắn, thiết bị dùng index trong từ điển,
+    updated_at là unix timestamp.
+
+    Kết nối lại: gửi seq lớn nhất đã nhận để lấy các thay đổi bị lỡ
+        {"action": "resume", "last_seq": 123}
+    -> {"type": "resume", "seq": ..., "events": [{"seq": ..., "updates": [...]}]}
+       hoặc {"type": "snapshot", "seq": ..., "devices": [...]} nếu khoảng lỡ quá lớn
+    """
+
     async def connect(self):
-        self.room_group_name = 'device_updates'
-        
-        # Tham gia room group
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
+        self.groups_joined = set()
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            await self.close()
+            return
+
+        # Client cũ: mặc định nhận cả nhà theo format device_update đến khi gửi subscribe / unsubscribe
+        self.legacy = True
+        self.home = True
+        self.rooms = set()
+        self.device_rooms = {}  # device_id đăng ký riêng -> phòng
+        self.compact = (
+            msgpack is not None
+            and COMPACT_SUBPROTOCOL in self.scope.get('subprotocols', [])
         )
-        
-        await self.accept()
+        self.device_index = {}  # device_id -> index trong từ điển (encoding gọn)
+        self.device_dictionary = []
+
+        if self.compact:
+            await self.accept(subprotocol=COMPACT_SUBPROTOCOL)
+            await self._send_dictionary()
+        else:
+            await self.accept()
+
+        for group in realtime.home_groups():
+            await self._join(group)
 
     async def disconnect(self, close_code):
-        # Rời khỏi room group
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
+        # Rời khỏi tất cả group đã đăng ký
+        for group in list(self.groups_joined):
+            await self._leave(group)
+
+    async def _join(self, group):
+        if group not in self.groups_joined:
+            await self.channel_layer.group_add(group, self.channel_name)
+            self.groups_joined.add(group)
+
+    async def _leave(self, group):
+        if group in self.groups_joined:
+            await self.channel_layer.group_discard(group, self.channel_name)
+            self.groups_joined.discard(group)
+
+    # Nhận message từ WebSocket (JSON, hoặc MessagePack khi dùng encoding gọn)
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            if bytes_data is not None and self.compact:
+                text_data_json = msgpack.unpackb(bytes_data, raw=False)
+            else:
+                text_data_json = json.loads(text_data)
+        except (TypeError, ValueError):
+            await self._send_error('Dữ liệu không hợp lệ')
+            return
+        if not isinstance(text_data_json, dict):
+            await self._send_error('Dữ liệu không hợp lệ')
+            return
+
+        action = text_data_json.get('action')
+        if action in ('subscribe', 'unsubscribe'):
+            await self._handle_subscription(action, text_data_json)
+            return
+        if action == 'resume':
+            await self._handle_resume(text_data_json)
+            return
+
+        await self._send_error('Action không hợp lệ')
+
+    async def _handle_subscription(self, action, data):
+        device_ids = [str(device_id) for device_id in data.get('device_ids') or []]
+        rooms = {str(room) for room in data.get('rooms') or []} & set(dict(Device.ROOM_CHOICES))
 
-    # Nhận message từ WebSocket
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        message = text_data_json['message']
-        
-        # Gửi message đến room group
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'device_message',
-                'message': message
+        if self.legacy:
+            # Client mới: bỏ đăng ký cả nhà mặc định
+            self.legacy = False
+            self.home = False
+
+        if action == 'subscribe':
+            if device_ids:
+                # Chỉ cho đăng ký thiết bị có thật
+                self.device_rooms.update(await self._device_rooms(device_ids))
+            self.rooms |= rooms
+            if data.get('home'):
+                self.home = True
+        else:
+            for device_id in device_ids:
+                self.device_rooms.pop(device_id, None)
+            self.rooms -= rooms
+            if data.get('home'):
+                self.home = False
+
+        # Cập nhật chỉ gửi đến group phòng: tham gia đúng các phòng cần
+        if self.home:
+            groups = set(realtime.home_groups())
+        else:
+            groups = {realtime.room_group(room) for room in self.rooms | set(self.device_rooms.values())}
+        for group in groups - self.groups_joined:
+            await self._join(group)
+        for group in self.groups_joined - groups:
+            await self._leave(group)
+
+        await self.send_message({
+            'type': 'subscription',
+            'action': action,
+            'home': self.home,
+            'rooms': sorted(self.rooms),
+            'device_ids': sorted(self.device_rooms),
+        })
+
+    def _wants(self, device_id, room):
+        """Client có đăng ký cập nhật của thiết bị này không"""
+        return self.home or room in self.rooms or device_id in self.device_rooms
+
+    async def _handle_resume(self, data):
+        try:
+            last_seq = int(data.get('last_seq'))
+        except (TypeError, ValueError):
+            last_seq = None
+
+        events = None
+        if last_seq is not None:
+            seq, events = await sync_to_async(realtime.events_since)(last_seq)
+
+        if events is None:
+            # Lấy seq trước khi đọc DB: thay đổi sau đó vẫn đến qua group
+            seq = await sync_to_async(realtime.current_seq)()
+            await self.send_message({
+                'type': 'snapshot',
+                'seq': seq,
+                'devices': await self._snapshot(),
+            })
+            return
+
+        # Chỉ gửi thay đổi client đang đăng ký
+        missed = []
+        for event in events:
+            updates = [
+                change['update'] for change in event['updates']
+                if self._wants(change['update']['id'], change['room'])
+            ]
+            if updates:
+                missed.append({'seq': event['seq'], 'updates': updates})
+
+        await self.send_message({
+            'type': 'resume',
+            'seq': seq,
+            'events': missed,
+        })
+
+    @database_sync_to_async
+    def _snapshot(self):
+        return [
+            realtime.device_payload(device)
+            for device in Device.objects.all()
+            if self._wants(str(device.id), device.room)
+        ]
+
+    @database_sync_to_async
+    def _device_rooms(self, device_ids):
+        return {
+            str(device_id): room
+            for device_id, room in Device.objects.filter(id__in=device_ids).values_list('id', 'room')
+        }
+
+    async def send_message(self, data):
+        """Gửi message cho client theo encoding đã thỏa thuận"""
+        if self.compact:
+            await self.send(bytes_data=msgpack.packb(self._compact(data), use_bin_type=True))
+        else:
+            await self.send(text_data=json.dumps(data))
+
+    async def _send_dictionary(self):
+        """Frame từ điển cho encoding gọn: key ngắn + danh sách thiết bị (index = vị trí)"""
+        self.device_dictionary = await self._load_dictionary()
+        self.device_index = {row[0]: index for index, row in enumerate(self.device_dictionary)}
+        await self.send(bytes_data=msgpack.packb({
+            't': 'dictionary',
+            'k': SHORT_KEYS,
+            'D': self.device_dictionary,
+        }, use_bin_type=True))
+
+    @database_sync_to_async
+    def _load_dictionary(self):
+        return [
+            [str(device_id), name, device_type, room]
+            for device_id, name, device_type, room in Device.objects.order_by('id').values_list(
+                'id', 'name', 'device_type', 'room'
+            )
+        ]
+
+    def _compact(self, value, key=None):
+        if key in ('status', 'message'):
+            # Dữ liệu tự do của thiết bị / client: giữ nguyên key
+            return value
+        if isinstance(value, dict):
+            if key in ('device', 'devices', 'updates') or 'updated_at' in value:
+                value = self._compact_device(value)
+            return {
+                SHORT_KEYS.get(item_key, item_key): self._compact(item_value, item_key)
+                for item_key, item_value in value.items()
             }
-        )
+        if isinstance(value, list):
+            return [self._compact(item, key) for item in value]
+        if key == 'device_id':
+            return self.device_index.get(value, value)
+        return value
+
+    def _compact_device(self, device):
+        """Thiết bị: id -> index, bỏ field trùng từ điển, updated_at -> unix timestamp"""
+        device = dict(device)
+        index = self.device_index.get(device.get('id'))
+        if index is not None:
+            device['id'] = index
+            row = self.device_dictionary[index]
+            for position, field in enumerate(DICTIONARY_FIELDS, start=1):
+                if field in device and device[field] == row[position]:
+                    del device[field]
+        updated_at = device.get('updated_at')
+        if isinstance(updated_at, str):
+            try:
+                device['updated_at'] = int(datetime.fromisoformat(updated_at).timestamp())
+            except ValueError:
+                pass
+        return device
 
-    # Nhận message từ room group
-    async def device_message(self, event):
-        message = event['message']
-        
-        # Gửi message đến WebSocket
-        await self.send(text_data=json.dumps({
+    async def _send_error(self, message):
+        await self.send_message({
+            'type': 'error',
             'message': message
-        }))
+        })
+
+    # Nhận message từ room group (cả phòng): chỉ chuyển phần client đăng ký
+    async def device_batch(self, event):
+        # Nhiều cập nhật (chỉ field thay đổi) của 1 phòng gom trong 1 message
+        updates = [update for update in event['updates'] if self._wants(update['id'], event['room'])]
+        if not updates:
+            return
+
+        if self.legacy:
+            # Client cũ chỉ hiểu device_update: mỗi thiết bị 1 message
+            for update in updates:
+                await self.send_message({
+                    'type': 'device_update',
+                    'device': update
+                })
+            return
+
+        await self.send_message({
+            'type': 'device_batch',
+            'seq': event.get('seq'),
+            'updates': updates
+        })
 
-    async def device_update(self, event):
-        # Gửi device update đến client
-        await self.send(text_data=json.dumps({
-            'type': 'device_update',
+    async def command_result(self, event):
+        if not self._wants(event['device_id'], event['room']):
+            return
+        # Gửi kết quả lệnh điều khiển bất đồng bộ đến client (confirmed / failed / superseded)
+        await self.send_message({
+            'type': 'command_result',
+            'command_id': event['command_id'],
+            'device_id': event['device_id'],
+            'status': event['status'],
+            'message': event['message'],
             'device': event['device']
-        }))
\ No newline at end of file
+        })
@@ -0,0 +1,326 @@
+# devices/control.py
+"""Logic điều khiển thiết bị dùng chung cho DeviceControlView, BulkDeviceControlView và Celery tasks"""
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Device, DeviceLog, DeviceUsageSession
+from . import command_queue, device_cache, esp_client, usage
+
+# CONVERT action từ Flutter sang format Django
+ACTION_MAPPING = {
+    'turn_on': 'on',
+    'turn_off': 'off',
+    'open': 'on',
+    'close': 'off'
+}
+
+VALID_ACTIONS = ('on', 'off', 'toggle')
+
+# Kết quả gửi lệnh: đã có lệnh mới hơn cho device nên lệnh này không gửi
+SUPERSEDED = 'superseded'
+
+
+def normalize_action(action):
+    """Chuyển đổi action từ Flutter ('turn_on', 'open'...) sang 'on' / 'off' / 'toggle'"""
+    return ACTION_MAPPING.get(action, action)
+
+
+def predict_is_on(device, django_action):
+    """Trạng thái is_on sau khi thực hiện action"""
+    if django_action == 'toggle':
+        return not device.is_on
+    if django_action == 'on':
+        return True
+    if django_action == 'off':
+        return False
+    return device.is_on
+
+
+def apply_action(device, django_action, data):
+    """Cập nhật is_on và status của device (chưa lưu DB)"""
+    device.is_on = predict_is_on(device, django_action)
+
+    # Cập nhật status dựa trên device type
+    if device.device_type == 'light':
+        device.status = {
+            'brightness': data.get('brightness', device.status.get('brightness', 100) if device.status else 100),
+            'color': data.get('color', device.status.get('color', '#ffffff') if device.status else '#ffffff')
+        }
+    elif device.device_type == 'fan':
+        device.status = {
+            'speed': data.get('speed', device.status.get('speed', 3) if device.status else 3),
+            'mode': data.get('mode', device.status.get('mode', 'normal') if device.status else 'normal')
+        }
+    elif device.device_type == 'ac':
+        device.status = {
+            'temperature': data.get('temperature', device.status.get('temperature', 25) if device.status else 25),
+            'mode': data.get('mode', device.status.get('mode', 'cool') if device.status else 'cool')
+        }
+
+
+def update_statistics(device, action, old_is_on):
+    """Cập nhật thống kê sử dụng (DeviceStatistics / UsageRollup tính từ session qua usage)"""
+    # Chuyển từ off sang on: tạo session mới + tăng số lần bật
+    if action in ['on', 'toggle'] and not old_is_on:
+        # device.save() lưu current_session_start
+        session = DeviceUsageSession.objects.create(
+            device=device,
+            start_time=timezone.now()
+        )
+        device.current_session_start = session.start_time
+        usage.record_turn_ons([(device, session)])
+
+    # Kết thúc session nếu chuyển từ on sang off
+    elif action in ['off', 'toggle'] and old_is_on:
+        device.current_session_start = None
+        # Tìm session chưa kết thúc
+        active_session = DeviceUsageSession.objects.filter(
+            device=device,
+            end_time__isnull=True
+        ).last()
+
+        if active_session:
+            active_session.end_time = timezone.now()
+            duration = (active_session.end_time - active_session.start_time).total_seconds() / 60
+            active_session.duration_minutes = int(duration)
+            active_session.save()
+            # Chia session theo ngày / giờ (session qua nửa đêm tính đúng ngày)
+            usage.record_closed_sessions([(device, active_session)])
+
+
+def commit_control(device, action, data, user, django_action=None):
+    """
+    Sau khi ESP8266 đã nhận lệnh: cập nhật thống kê, trạng thái device và ghi log
+    action: action gốc từ Flutter (giữ nguyên trong log để dễ debug)
+    django_action: action đã chuẩn hóa (mặc định normalize_action(action))
+    """
+    django_action = django_action or normalize_action(action)
+    old_status = device.status.copy() if device.status else {}
+    old_is_on = device.is_on
+
+    # Cập nhật thống kê TRƯỚC KHI thay đổi trạng thái
+    update_statistics(device, django_action, old_is_on)
+
+    apply_action(device, django_action, data)
+    device.save()
+
+    # Ghi log
+    DeviceLog.objects.create(
+        device=device,
+        action=action,
+        old_status={'is_on': old_is_on, **old_status},
+        new_status={'is_on': device.is_on, **device.status},
+        user=user
+    )
+    return device
+
+
+def execute_control(device, action, data, user, django_action=None):
+    """
+    Gửi lệnh đến ESP8266 rồi cập nhật DB
+    Returns: True nếu thành công, False nếu ESP8266 lỗi (DB không đổi)
+    """
+    django_action = django_action or normalize_action(action)
+    if not esp_client.send_command(device, django_action, data):
+        return False
+    commit_control(device, action, data, user, django_action)
+    return True
+
+
+def bulk_update_statistics(transitions):
+    """
+    Cập nhật thống kê cho nhiều thiết bị cùng lúc (số query không phụ thuộc số thiết bị)
+    transitions: list (device, old_is_on, new_is_on)
+    Đặt device.current_session_start - caller lưu device (bulk_update) sau đó
+    """
+    now = timezone.now()
+
+    turned_on = [device for device, old_is_on, new_is_on in transitions if new_is_on and not old_is_on]
+    turned_off = [device for device, old_is_on, new_is_on in transitions if old_is_on and not new_is_on]
+    if not turned_on and not turned_off:
+        return
+
+    # Bật thiết bị: tạo session mới + tăng số lần bật
+    opened_sessions = []
+    for device in turned_on:
+        device.current_session_start = now
+        opened_sessions.append((device, DeviceUsageSession(device=device, start_time=now)))
+    if opened_sessions:
+        DeviceUsageSession.objects.bulk_create([session for _, session in opened_sessions])
+        usage.record_turn_ons(opened_sessions)
+
+    # Tắt thiết bị: kết thúc session đang chạy mới nhất của mỗi thiết bị
+    active_sessions = {}
+    for session in DeviceUsageSession.objects.filter(
+        device_id__in=[device.id for device in turned_off],
+        end_time__isnull=True
+    ).order_by('start_time'):
+        active_sessions[session.device_id] = session
+
+    closed_sessions = []
+    for device in turned_off:
+        device.current_session_start = None
+        session = active_sessions.get(device.id)
+        if session is None:
+            continue
+        session.end_time = now
+        session.duration_minutes = int((now - session.start_time).total_seconds() / 60)
+        closed_sessions.append((device, session))
+
+    if closed_sessions:
+        DeviceUsageSession.objects.bulk_update(
+            [session for _, session in closed_sessions], ['end_time', 'duration_minutes']
+        )
+        usage.record_closed_sessions(closed_sessions)
+
+
+def _send_board_commands(ip, commands):
+    """
+    Gửi tuần tự các lệnh của 1 board, giữ lock của board cho từng lệnh
+    (lock TTL chỉ cần đủ cho 1 lệnh, lệnh từ nơi khác có thể chen giữa 2 lệnh)
+    commands: list (device, django_action, data, command_id); command_id từ command_queue.enqueue
+    Returns: list True / False / SUPERSEDED theo thứ tự commands
+    """
+    results = []
+    for device, django_action, data, command_id in commands:
+        lock_id = command_id or str(uuid.uuid4())
+        if not command_queue.wait_for_board(ip, lock_id):
+            results.append(False)
+            continue
+        try:
+            if command_id and not command_queue.is_latest(device.id, command_id):
+                # Đã có lệnh mới hơn cho thiết bị này - bỏ qua lệnh cũ
+                results.append(SUPERSEDED)
+            else:
+                results.append(esp_client.send_command(device, django_action, data))
+        finally:
+            command_queue.release_board(ip, lock_id)
+    return results
+
+
+def send_grouped(commands, command_ids=None):
+    """
+    Gửi lệnh đến nhiều ESP8266: các board song song, mỗi board tuần tự
+    commands: list (device, django_action, data)
+    command_ids: list command_id (command_queue.enqueue) theo thứ tự commands, None = không gộp
+    Returns: list True / False / SUPERSEDED theo thứ tự commands
+    """
+    results = [False] * len(commands)
+    command_ids = command_ids or [None] * len(commands)
+
+    by_ip = {}
+    for index, (device, django_action, data) in enumerate(commands):
+        if not device.ip_address:
+            continue
+        by_ip.setdefault(str(device.ip_address).strip(), []).append(index)
+
+    if not by_ip:
+        return results
+
+    max_workers = min(len(by_ip), getattr(settings, 'ESP_BULK_CONCURRENCY', 16))
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='esp-bulk') as executor:
+        futures = {
+            ip: executor.submit(
+                _send_board_commands, ip, [commands[i] + (command_ids[i],) for i in indexes]
+            )
+            for ip, indexes in by_ip.items()
+        }
+        for ip, future in futures.items():
+            for index, success in zip(by_ip[ip], future.result()):
+                results[index] = success
+    return results
+
+
+def execute_bulk(commands, user):
+    """
+    Điều khiển nhiều thiết bị:
+    gửi lệnh theo board (song song), rồi ghi thống kê, trạng thái và log trong 1 transaction
+    commands: list (device, action, data) - action gốc từ Flutter
+    Returns: list dict kết quả theo từng thiết bị
+    """
+    prepared = []
+    for device, action, data in commands:
+        django_action = normalize_action(action)
+        command_id = None
+        if device.ip_address and django_action in VALID_ACTIONS:
+            # Gộp với lệnh khác của cùng device (toggle theo trạng thái mong muốn mới nhất)
+            command_id, django_action = command_queue.enqueue(device, django_action)
+        elif django_action == 'toggle':
+            django_action = 'off' if device.is_on else 'on'
+        prepared.append((device, action, django_action, data, command_id))
+
+    try:
+        sent = send_grouped(
+            [(device, django_action, data) for device, _, django_action, data, _ in prepared],
+            [command_id for *_, command_id in prepared],
+        )
+        _commit_bulk(prepared, sent, user)
+    finally:
+        for device, *_, command_id in prepared:
+            if command_id:
+                command_queue.finish(device.id, command_id)
+
+    results = []
+    for (device, _, django_action, _, _), success in zip(prepared, sent):
+        result = {
+            'device_id': str(device.id),
+            'name': device.name,
+            'success': bool(success),
+            'is_on': device.is_on,
+        }
+        if success is SUPERSEDED:
+            result['status'] = 'superseded'
+            result['is_on'] = django_action == 'on'
+        results.append(result)
+    return results
+
+
+def _commit_bulk(prepared, sent, user):
+    """Ghi thống kê, trạng thái và log của các lệnh đã gửi thành công trong 1 transaction"""
+    applied = [
+        (device, action, django_action, data)
+        for (device, action, django_action, data, _), success in zip(prepared, sent)
+        if success is True
+    ]
+    if not applied:
+        return
+
+    # Trạng thái có thể đã đổi bởi lệnh khác trong lúc gửi
+    fresh = Device.objects.in_bulk([device.id for device, *_ in applied])
+
+    transitions = []
+    changed_devices = []
+    logs = []
+    now = timezone.now()
+    for device, action, django_action, data in applied:
+        if device.id in fresh:
+            device.is_on = fresh[device.id].is_on
+            device.status = fresh[device.id].status
+            device.current_session_start = fresh[device.id].current_session_start
+        old_status = device.status.copy() if device.status else {}
+        old_is_on = device.is_on
+        apply_action(device, django_action, data)
+        device.updated_at = now
+
+        transitions.append((device, old_is_on, device.is_on))
+        changed_devices.append(device)
+        logs.append(DeviceLog(
+            device=device,
+            action=action,
+            old_status={'is_on': old_is_on, **old_status},
+            new_status={'is_on': device.is_on, **device.status},
+            user=user
+        ))
+
+    with transaction.atomic():
+        bulk_update_statistics(transitions)
+        Device.objects.bulk_update(
+            changed_devices, ['is_on', 'status', 'current_session_start', 'updated_at']
+        )
+        DeviceLog.objects.bulk_create(logs)
+        # bulk_update không gửi signal
+        device_cache.invalidate()
@@ -0,0 +1,114 @@
+# devices/device_cache.py
+"""
+Snapshot danh sách thiết bị cho DeviceListView (đã serialize sẵn):
+- Bộ nhớ process + Redis, đánh dấu bằng generation (số tăng dần trong Redis)
+- Mỗi lần Device thay đổi (save / bulk_update / update) gọi invalidate() để tăng generation
+- Request không có thay đổi chỉ đọc generation từ Redis, không query bảng devices
+"""
+import hashlib
+import json
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Device
+from . import realtime
+
+logger = logging.getLogger(__name__)
+
+GENERATION_KEY = 'devices:list:generation'
+SNAPSHOT_KEY = 'devices:list:snapshot:{generation}'
+
+_local = {}
+_local_lock = threading.Lock()
+
+
+def _bump_generation():
+    try:
+        cache.add(GENERATION_KEY, 0, timeout=None)
+        cache.incr(GENERATION_KEY)
+    except Exception as e:
+        logger.warning(f'Device list cache invalidate failed: {e}')
+    with _local_lock:
+        _local.clear()
+
+
+def invalidate():
+    """Báo danh sách thiết bị đã thay đổi (chạy sau khi transaction commit)"""
+    transaction.on_commit(_bump_generation)
+
+
+def _current_generation():
+    try:
+        return cache.get(GENERATION_KEY)
+    except Exception as e:
+        logger.warning(f'Device list cache read failed: {e}')
+        return None
+
+
+def _build_snapshot():
+    # seq lấy trước khi đọc DB: client dùng để resume WebSocket
+    seq = realtime.current_seq()
+    devices_data = [
+        {
+            'id': str(device.id),
+            'name': device.name,
+            'device_type': device.device_type,
+            'room': device.room,
+            'is_on': device.is_on,
+            'status': device.status,
+            'ip_address': device.ip_address,
+            'created_at': device.created_at.isoformat(),
+        }
+        for device in Device.objects.all()
+    ]
+    body = json.dumps({
+        'success': True,
+        'devices': devices_data,
+        'seq': seq
+    }).encode('utf-8')
+    return {
+        'body': body,
+        'etag': '"%s"' % hashlib.sha1(body).hexdigest(),
+    }
+
+
+def get_snapshot():
+    """
+    Snapshot hiện tại: dict {'body': bytes JSON, 'etag': str}
+    Thứ tự: bộ nhớ process -> Redis -> DB
+    """
+    generation = _current_generation()
+    if generation is None:
+        # Chưa có generation (Redis mới / lỗi): tạo generation để các process dùng chung
+        try:
+            cache.add(GENERATION_KEY, 0, timeout=None)
+            generation = cache.get(GENERATION_KEY)
+        except Exception:
+            generation = None
+        if generation is None:
+            return _build_snapshot()
+
+    with _local_lock:
+        if _local.get('generation') == generation:
+            return _local['snapshot']
+
+    key = SNAPSHOT_KEY.format(generation=generation)
+    try:
+        snapshot = cache.get(key)
+    except Exception:
+        snapshot = None
+    if snapshot is None:
+        snapshot = _build_snapshot()
+        try:
+            cache.set(key, snapshot, timeout=getattr(settings, 'DEVICE_LIST_CACHE_TTL', 300))
+        except Exception as e:
+            logger.warning(f'Device list cache write failed: {e}')
+
+    with _local_lock:
+        _local['generation'] = generation
+        _local['snapshot'] = snapshot
+    return snapshot
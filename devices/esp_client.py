@@ -0,0 +1,134 @@
+# devices/esp_client.py
+"""
+HTTP client dùng chung cho mọi request đến ESP8266
+(views, management commands, Celery tasks).
+
+Một requests.Session cho mỗi process, giữ kết nối keep-alive theo từng host,
+cùng timeout và retry lấy từ settings (ESP_HTTP_*).
+"""
+import logging
+import threading
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def get_session(retry=True):
+    """
+    Session dùng chung (tạo 1 lần cho mỗi process)
+    retry=False: không retry kết nối (dùng cho poll /api/status, đã có backoff riêng)
+    """
+    session = _sessions.get(retry)
+    if session is not None:
+        return session
+
+    with _sessions_lock:
+        session = _sessions.get(retry)
+        if session is None:
+            # Chỉ retry lỗi kết nối, không retry khi ESP đã nhận lệnh (tránh gửi lệnh 2 lần)
+            max_retries = Retry(
+                total=_setting('ESP_HTTP_RETRIES', 1) if retry else 0,
+                read=0,
+                status=0,
+                backoff_factor=_setting('ESP_HTTP_BACKOFF', 0.1),
+                allowed_methods=['GET'],
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=_setting('ESP_HTTP_POOL_CONNECTIONS', 64),
+                pool_maxsize=_setting('ESP_HTTP_POOL_MAXSIZE', 4),
+                max_retries=max_retries,
+            )
+            session = requests.Session()
+            session.mount('http://', adapter)
+            _sessions[retry] = session
+    return session
+
+
+def esp_get(ip, path, params=None, timeout=None, retry=True):
+    """
+    GET http://<ip><path> qua session dùng chung
+    Raises: requests.exceptions.RequestException khi lỗi kết nối/timeout
+    """
+    url = f"http://{str(ip).strip()}{path}"
+    if timeout is None:
+        timeout = _setting('ESP_HTTP_TIMEOUT', 5)
+    return get_session(retry).get(url, params=params, timeout=timeout)
+
+
+def get_led_number(device):
+    """Xác định LED number từ device name (dùng chung cho gửi lệnh và sync_device_status)"""
+    name = device.name.lower()
+    if '2' in name or 'ngủ' in name or 'ngu' in name:
+        return '2'
+    return '1'  # Mặc định LED1
+
+
+def build_command(device, action, data=None):
+    """
+    Chuyển action ('on', 'off', 'toggle') thành endpoint ESP8266
+    Returns: (path, params) hoặc None nếu device type chưa hỗ trợ
+    """
+    data = data or {}
+    device_type = device.device_type.lower()
+
+    if action == 'toggle':
+        turn_on = not device.is_on
+    else:
+        turn_on = action != 'off'
+
+    if device_type in ['light', 'led']:
+        return f"/led{get_led_number(device)}", {'state': '1' if turn_on else '0'}
+
+    if device_type == 'fan':
+        if not turn_on:
+            speed = '0'
+        elif action == 'on':
+            speed = str(data.get('speed', 3))  # Mặc định tốc độ 3
+        else:
+            speed = '3'
+        return "/fan", {'speed': speed}
+
+    if device_type == 'door':
+        return "/door", {'action': 'open' if turn_on else 'close'}
+
+    # Cùng nhóm loại với sync_device_status (đọc key DRY): 'dryer' cũng gửi /dry
+    if device_type in ['dryer', 'dry', 'ac']:
+        return "/dry", {'action': 'out' if turn_on else 'in'}
+
+    return None
+
+
+def send_command(device, action, data=None):
+    """
+    Gửi lệnh điều khiển đến ESP8266 của device
+    Returns: True nếu ESP trả về 200 (hoặc device type không cần gửi lệnh), False nếu lỗi
+    """
+    if not device.ip_address:
+        logger.warning(f"Device {device.name} không có IP address")
+        return False
+
+    command = build_command(device, action, data)
+    if command is None:
+        logger.info(f"Device type {device.device_type} chưa được hỗ trợ")
+        return True  # Vẫn cho phép cập nhật DB
+
+    path, params = command
+    try:
+        response = esp_get(device.ip_address, path, params=params)
+        logger.info(f"ESP8266 {device.ip_address}{path} {params} -> {response.status_code}")
+        return response.status_code == 200
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"ESP8266 {device.ip_address}{path} error: {e}")
+        return False
@@ -0,0 +1,322 @@
+# devices/management/commands/rebuild_statistics.py
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Min, Q, Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from devices.models import DeviceStatistics, DeviceUsageSession, UsageRollup
+from devices import stats_cache, usage
+from datetime import datetime, time as dt_time, timedelta
+import time
+
+
+class Command(BaseCommand):
+    """
+    Tính lại DeviceStatistics (và UsageRollup) từ lịch sử DeviceUsageSession:
+    - Tính lần lượt từng tháng trong khoảng (bậc thang tiền điện tính theo tháng)
+    - Mỗi tháng: đọc session giao với tháng 1 lượt theo từng chunk (keyset theo device_id,
+      start_time, id - có index), chia theo giờ / ngày bằng devices/usage.py (cùng công thức
+      với lúc ghi trực tiếp), cộng vào thống kê ngày + rollup giờ / ngày của mọi thiết bị,
+      phòng, loại thiết bị. Bộ nhớ theo số thiết bị × số giờ của 1 tháng
+    - Tiền điện bậc thang: giá từng giờ tính từ điện năng cả nhà (tổng rollup giờ theo loại,
+      cộng điện năng đầu tháng đã có trong DB); tiền = điện năng giờ đó × giá, tiền ngày = tổng các giờ
+    - Ghi bằng bulk_create(update_conflicts=True); dòng trong tháng không còn session bị xóa
+    - Mỗi tháng ghi và commit trong 1 transaction: API thống kê không thấy tháng đang tính dở,
+      dừng giữa chừng thì các tháng đã commit vẫn đúng
+    """
+    help = 'Rebuild daily statistics and usage rollups from DeviceUsageSession history'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--from',
+            dest='date_from',
+            help='First local date to rebuild, YYYY-MM-DD (default: first session)',
+        )
+        parser.add_argument(
+            '--to',
+            dest='date_to',
+            help='Last local date to rebuild, YYYY-MM-DD (default: today)',
+        )
+        parser.add_argument(
+            '--device',
+            action='append',
+            dest='device_ids',
+            help='Only rebuild this device (repeatable). Usage rollups are skipped.',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=5000,
+            help='Sessions read per query (default: 5000)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Rows written per INSERT (default: 1000)',
+        )
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        self.chunk_size = max(1, options['chunk_size'])
+        self.batch_size = max(1, options['batch_size'])
+        device_ids = options['device_ids'] or []
+
+        all_sessions = DeviceUsageSession.objects.all()
+        sessions = all_sessions.filter(device_id__in=device_ids) if device_ids else all_sessions
+
+        today = timezone.localtime(timezone.now()).date()
+        start_date = self._parse_date(options['date_from'], '--from')
+        end_date = self._parse_date(options['date_to'], '--to') or today
+        if start_date is None:
+            first_start = sessions.aggregate(first=Min('start_time'))['first']
+            if first_start is None:
+                self.stdout.write(self.style.WARNING('⚠️ No usage sessions to rebuild from'))
+                return
+            start_date = timezone.localtime(first_start).date()
+        if start_date > end_date:
+            raise CommandError('--from must not be after --to')
+
+        rebuild_rollups = not device_ids
+        self.stdout.write(
+            self.style.SUCCESS(f'🔁 Rebuilding statistics {start_date} → {end_date}')
+        )
+        if not rebuild_rollups:
+            self.stdout.write(self.style.WARNING(
+                '⚠️ --device given: usage rollups (room / type totals) are left unchanged'
+            ))
+
+        counts = {'sessions': 0, 'devices': set(), 'daily': 0, 'deleted': 0, 'rollups': 0, 'months': 0}
+        for window_start, window_end in self._month_windows(start_date, end_date):
+            window_counts = self._rebuild_window(
+                all_sessions, device_ids, window_start, window_end,
+                count_earlier=window_start == start_date,
+            )
+            for key, value in window_counts.items():
+                if key == 'devices':
+                    counts[key] |= value
+                else:
+                    counts[key] += value
+            self.stdout.write(f'   📅 {window_start} → {window_end}: {window_counts["daily"]} daily row(s)')
+        counts['devices'] = len(counts['devices'])
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ Rebuilt {counts['daily']} daily row(s) from {counts['sessions']} session(s) "
+            f"of {counts['devices']} device(s) in {elapsed:.1f}s"
+        ))
+        self.stdout.write(f"   🗑️ Removed {counts['deleted']} stale daily row(s)")
+        if rebuild_rollups:
+            self.stdout.write(
+                f"   📊 Usage rollups: {counts['rollups']} hour/day row(s), {counts['months']} month row(s)"
+            )
+
+    def _parse_date(self, value, option):
+        if value is None:
+            return None
+        parsed = parse_date(value)
+        if parsed is None:
+            raise CommandError(f'{option} must be a date in YYYY-MM-DD format')
+        return parsed
+
+    def _month_windows(self, start_date, end_date):
+        """Các khoảng [đầu, cuối] theo từng tháng trong [start_date, end_date]"""
+        window_start = start_date
+        while window_start <= end_date:
+            next_month = (window_start.replace(day=1) + timedelta(days=32)).replace(day=1)
+            window_end = min(end_date, next_month - timedelta(days=1))
+            yield window_start, window_end
+            window_start = next_month
+
+    def _rebuild_window(self, all_sessions, device_ids, start_date, end_date, count_earlier=True):
+        """
+        Tính lại và ghi 1 khoảng trong cùng 1 tháng, commit khi xong
+        count_earlier: đếm cả session bắt đầu trước khoảng (False với các tháng sau tháng đầu,
+        để session qua nhiều tháng chỉ được đếm 1 lần)
+        Returns: dict số session / thiết bị đã đọc và số dòng đã ghi / xóa của khoảng
+        """
+        rebuild_rollups = not device_ids
+        start_dt = timezone.make_aware(datetime.combine(start_date, dt_time.min))
+        end_dt = timezone.make_aware(datetime.combine(end_date + timedelta(days=1), dt_time.min))
+        # Session giao với khoảng: bắt đầu trước end_dt và kết thúc sau start_dt
+        # (session đang chạy chỉ tính lần bật nên chỉ cần bắt đầu trong khoảng)
+        in_range = Q(start_time__lt=end_dt) & (Q(end_time__gt=start_dt) | Q(start_time__gte=start_dt))
+        counts = {'daily': 0, 'deleted': 0, 'rollups': 0, 'months': 0}
+
+        with transaction.atomic():
+            rebuilt_at = timezone.now()
+            # Giá bậc thang phụ thuộc điện năng cả nhà nên đọc session của mọi thiết bị
+            daily, rollups, read_counts = self._accumulate(
+                all_sessions.filter(in_range), device_ids, None if count_earlier else start_dt
+            )
+            counts.update(read_counts)
+            self._apply_prices(daily, rollups, self._hourly_prices(rollups, start_date, end_date))
+
+            counts['daily'] = self._write_daily([
+                DeviceStatistics(
+                    device_id=device_id,
+                    date=day,
+                    turn_on_count=values[0],
+                    total_usage_minutes=values[1],
+                    power_consumption=values[2],
+                    cost=values[3],
+                )
+                for (device_id, day), values in daily.items()
+                if start_date <= day <= end_date
+            ])
+            daily.clear()
+            if rebuild_rollups:
+                UsageRollup.objects.filter(
+                    grain__in=['hour', 'day'], bucket_date__range=[start_date, end_date]
+                ).delete()
+                counts['rollups'] = self._write_rollups(usage.rollup_rows(rollups), start_date, end_date)
+            rollups.clear()
+
+            # Dòng trong khoảng không được ghi lại nghĩa là không còn session
+            stale = DeviceStatistics.objects.filter(
+                date__range=[start_date, end_date], updated_at__lt=rebuilt_at
+            )
+            if device_ids:
+                stale = stale.filter(device_id__in=device_ids)
+            counts['deleted'] = stale.delete()[0]
+
+            if rebuild_rollups:
+                counts['months'] = self._rebuild_months(start_date, end_date)
+
+            stats_cache.invalidate(start_date, end_date)
+        return counts
+
+    def _stream_sessions(self, sessions):
+        """Session theo (device_id, start_time, id), mỗi query chunk_size dòng"""
+        sessions = sessions.order_by('device_id', 'start_time', 'id').values_list(
+            'id', 'device_id', 'device__device_type', 'device__room', 'start_time', 'end_time',
+            'device__rated_power_w'
+        )
+        last = None
+        while True:
+            chunk = sessions
+            if last is not None:
+                session_id, device_id, start_time = last
+                chunk = chunk.filter(
+                    Q(device_id__gt=device_id)
+                    | Q(device_id=device_id, start_time__gt=start_time)
+                    | Q(device_id=device_id, start_time=start_time, id__gt=session_id)
+                )
+            rows = list(chunk[:self.chunk_size])
+            yield from rows
+            if len(rows) < self.chunk_size:
+                return
+            last = (rows[-1][0], rows[-1][1], rows[-1][4])
+
+    def _accumulate(self, sessions, device_ids, count_from=None):
+        """
+        1 lượt đọc session: thống kê ngày (chỉ thiết bị được chọn) và rollup của mọi thiết bị,
+        tiền điện chưa tính (giá cần điện năng cả nhà của cả khoảng)
+        count_from: chỉ đếm session bắt đầu từ thời điểm này
+        Returns: (daily, rollups, {'sessions': số session, 'devices': set device_id})
+        """
+        selected = set(device_ids)
+        counts = {'sessions': 0, 'devices': set()}
+        daily, rollups = {}, {}
+        for _, device_id, device_type, room, start_time, end_time, rated_power_w in self._stream_sessions(sessions):
+            is_selected = not selected or device_id in selected
+            usage.accumulate_session(
+                daily if is_selected else {}, rollups, device_id, device_type, room,
+                start_time, end_time, {}, rated_power_w=rated_power_w
+            )
+            if is_selected:
+                counts['devices'].add(device_id)
+                if count_from is None or start_time >= count_from:
+                    counts['sessions'] += 1
+        return daily, rollups, counts
+
+    def _hourly_prices(self, rollups, start_date, end_date):
+        """Giá điện từng giờ trong khoảng (đ/kWh) theo điện năng cả nhà"""
+        # Mỗi thiết bị thuộc đúng 1 loại: tổng rollup giờ theo loại = điện năng cả nhà
+        household = {}
+        for (grain, scope, _, day, hour), values in rollups.items():
+            if grain == 'hour' and scope == 'type' and start_date <= day <= end_date:
+                household[(day, hour)] = household.get((day, hour), 0.0) + values[2]
+
+        # Điện năng đầu tháng trước start_date (ngoài khoảng rebuild) vẫn tính vào bậc thang
+        first_month = start_date.replace(day=1)
+        month_to_date = {
+            first_month: UsageRollup.objects.filter(
+                grain='day', scope='type', bucket_date__gte=first_month, bucket_date__lt=start_date
+            ).aggregate(total=Sum('power_consumption'))['total'] or 0.0
+        }
+        return usage.hourly_prices(household, month_to_date)
+
+    def _apply_prices(self, daily, rollups, prices):
+        """Tiền điện: rollup giờ = điện năng × giá giờ đó; rollup ngày / thống kê ngày = tổng các giờ"""
+        day_costs = {}
+        for (grain, scope, scope_key, day, hour), values in rollups.items():
+            if grain == 'hour':
+                values[3] = values[2] * prices.get((day, hour), 0.0)
+                key = (scope, scope_key, day)
+                day_costs[key] = day_costs.get(key, 0.0) + values[3]
+        for (grain, scope, scope_key, day, _), values in rollups.items():
+            if grain == 'day':
+                values[3] = day_costs.get((scope, scope_key, day), 0.0)
+        for (device_id, day), values in daily.items():
+            values[3] = day_costs.get(('device', str(device_id), day), 0.0)
+
+    def _write_daily(self, rows):
+        """Ghi đè thống kê ngày (device, date) đã có, thêm dòng chưa có. Xóa rows sau khi ghi."""
+        # MySQL không hỗ trợ chỉ định unique_fields (dùng mọi unique key của bảng)
+        unique_fields = (
+            ['device', 'date'] if connection.features.supports_update_conflicts_with_target else None
+        )
+        DeviceStatistics.objects.bulk_create(
+            rows,
+            batch_size=self.batch_size,
+            update_conflicts=True,
+            unique_fields=unique_fields,
+            update_fields=usage.DAILY_VALUE_FIELDS + ['updated_at'],
+        )
+        written = len(rows)
+        rows.clear()
+        return written
+
+    def _write_rollups(self, rows, start_date, end_date):
+        """Ghi rollup giờ / ngày trong khoảng (dòng cũ đã xóa). Xóa rows sau khi ghi."""
+        rows = [row for row in rows if start_date <= row[3] <= end_date and row[0] != 'month']
+        usage.upsert_increment(
+            UsageRollup, usage.ROLLUP_KEY_FIELDS, usage.ROLLUP_VALUE_FIELDS, rows,
+            batch_size=self.batch_size,
+        )
+        return len(rows)
+
+    def _rebuild_months(self, start_date, end_date):
+        """Rollup tháng = tổng rollup ngày của tháng (tháng chỉ rebuild một phần vẫn đúng)"""
+        first_month = start_date.replace(day=1)
+        last_month = end_date.replace(day=1)
+        next_month = (last_month + timedelta(days=32)).replace(day=1)
+        UsageRollup.objects.filter(grain='month', bucket_date__range=[first_month, last_month]).delete()
+
+        months = UsageRollup.objects.filter(
+            grain='day', bucket_date__gte=first_month, bucket_date__lt=next_month
+        ).annotate(month=TruncMonth('bucket_date')).values('scope', 'scope_key', 'month').annotate(
+            total_turn_on=Sum('turn_on_count'),
+            total_minutes=Sum('usage_minutes'),
+            total_power=Sum('power_consumption'),
+            total_cost=Sum('cost'),
+        ).order_by()
+
+        rows = [
+            UsageRollup(
+                grain='month',
+                scope=row['scope'],
+                scope_key=row['scope_key'],
+                bucket_date=row['month'],
+                hour=0,
+                turn_on_count=row['total_turn_on'] or 0,
+                usage_minutes=row['total_minutes'] or 0.0,
+                power_consumption=row['total_power'] or 0.0,
+                cost=row['total_cost'] or 0.0,
+            )
+            for row in months
+        ]
+        UsageRollup.objects.bulk_create(rows, batch_size=self.batch_size)
+        return len(rows)
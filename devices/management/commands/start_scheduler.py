@@ -1,15 +1,26 @@
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
 from django.core.management.base import BaseCommand
+from django.db import transaction
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from devices.models import DeviceSchedule, DeviceLog, Device
+from devices import control, device_cache, realtime, schedule_claim
+import asyncio
+import heapq
 import time
 import logging
-import requests
-from datetime import datetime, timedelta
+from datetime import datetime, timezone as dt_timezone
 
 logger = logging.getLogger(__name__)
 
+# Chờ tối đa giữa 2 lần thử lại khi listener sự kiện lịch hẹn lỗi (giây)
+LISTENER_RETRY_MAX = 30
+
 class Command(BaseCommand):
     help = 'Run custom device scheduler with real ESP8266 control'
+    batch_size = 500
+    _broadcaster = None
     
     def add_arguments(self, parser):
         parser.add_argument(
@@ -18,24 +29,191 @@ class Command(BaseCommand):
             default=30,
             help='Check interval in seconds (default: 30)',
         )
+        parser.add_argument(
+            '--engine',
+            choices=['poll', 'heap'],
+            default='poll',
+            help='Scheduler engine: "poll" rescans every --interval, '
+                 '"heap" sleeps until the next due schedule (default: poll)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Max schedules claimed per query (default: 500)',
+        )
+        parser.add_argument(
+            '--horizon',
+            type=int,
+            default=3600,
+            help='Heap engine: load schedules due within this many seconds (default: 3600)',
+        )
     
     def handle(self, *args, **options):
         interval = options['interval']
-        self.stdout.write(
-            self.style.SUCCESS(f'🚀 Starting Device Scheduler with ESP8266 Control (checking every {interval}s)...')
-        )
+        self.batch_size = max(1, options['batch_size'])
         
         try:
-            while True:
-                self.check_and_execute_schedules()
-                self.stdout.write(f'⏰ Next check in {interval} seconds...\n')
-                time.sleep(interval)
+            if options['engine'] == 'heap':
+                self.stdout.write(
+                    self.style.SUCCESS('🚀 Starting Device Scheduler with ESP8266 Control (heap engine)...')
+                )
+                asyncio.run(self.run_heap_engine(options['horizon'], interval))
+            else:
+                self.stdout.write(
+                    self.style.SUCCESS(f'🚀 Starting Device Scheduler with ESP8266 Control (checking every {interval}s)...')
+                )
+                while True:
+                    self.check_and_execute_schedules()
+                    self.stdout.write(f'⏰ Next check in {interval} seconds...\n')
+                    time.sleep(interval)
                 
         except KeyboardInterrupt:
             self.stdout.write(
                 self.style.WARNING('\n🛑 Scheduler stopped by user')
             )
     
+    async def run_heap_engine(self, horizon, fallback_interval):
+        """
+        Engine hướng sự kiện: min-heap (next_run_at, schedule_id) cho các lịch trong --horizon,
+        ngủ đúng đến lịch kế tiếp, cập nhật heap khi nhận sự kiện từ group schedule_events
+        (gửi bởi signals khi ScheduleListView / ScheduleDetailView tạo, sửa, xóa lịch hẹn)
+        """
+        heap = []
+        entries = {}  # schedule_id -> timestamp next_run_at (để bỏ qua entry cũ trong heap)
+        events = asyncio.Queue()
+        
+        channel_layer = get_channel_layer()
+        listener = None
+        if channel_layer is not None:
+            channel_name = await channel_layer.new_channel()
+            await channel_layer.group_add(realtime.SCHEDULE_EVENTS_GROUP, channel_name)
+            listener = asyncio.create_task(self._listen_schedule_events(channel_layer, channel_name, events))
+        else:
+            self.stdout.write(
+                self.style.WARNING(f'⚠️ No channel layer - reloading every {fallback_interval}s')
+            )
+        
+        def push(schedule_id, next_run_at, loaded_until):
+            if next_run_at is None:
+                entries.pop(schedule_id, None)
+                return
+            timestamp = next_run_at.timestamp()
+            if timestamp > loaded_until:
+                # Ngoài horizon - sẽ được nạp ở lần reload kế tiếp
+                entries.pop(schedule_id, None)
+                return
+            entries[schedule_id] = timestamp
+            heapq.heappush(heap, (timestamp, schedule_id))
+        
+        loaded_until = 0.0
+        # Lịch có lease hết hạn (worker khác chết giữa chừng) không có sự kiện báo: kiểm tra định kỳ
+        reclaim_interval = schedule_claim.lease_seconds()
+        next_reclaim_at = time.time() + reclaim_interval
+        try:
+            while True:
+                now = time.time()
+                
+                # Nạp thêm lịch trong horizon (chỉ phần chưa nạp)
+                if now + horizon / 2 >= loaded_until:
+                    if channel_layer is not None:
+                        # Gia hạn membership của group
+                        await channel_layer.group_add(realtime.SCHEDULE_EVENTS_GROUP, channel_name)
+                    new_until = now + horizon
+                    upcoming = await sync_to_async(self._load_upcoming)(loaded_until, new_until)
+                    loaded_until = new_until
+                    for schedule_id, next_run_at in upcoming:
+                        push(schedule_id, next_run_at, loaded_until)
+                    self.stdout.write(f'📥 Loaded {len(upcoming)} upcoming schedule(s), heap size {len(entries)}')
+                
+                # Bỏ entry cũ ở đỉnh heap
+                while heap and entries.get(heap[0][1]) != heap[0][0]:
+                    heapq.heappop(heap)
+                
+                if (heap and heap[0][0] <= now) or now >= next_reclaim_at:
+                    next_reclaim_at = now + reclaim_interval
+                    # Lấy tất cả lịch đã đến hạn ra khỏi heap rồi thực thi (query theo next_run_at)
+                    while heap and heap[0][0] <= now:
+                        timestamp, schedule_id = heapq.heappop(heap)
+                        if entries.get(schedule_id) == timestamp:
+                            del entries[schedule_id]
+                    executed = await sync_to_async(self.check_and_execute_schedules)()
+                    for schedule_id, next_run_at in executed:
+                        push(schedule_id, next_run_at, loaded_until)
+                    continue
+                
+                # Ngủ đến lịch kế tiếp / lần reload kế tiếp, hoặc đến khi có sự kiện
+                wake_at = min(loaded_until - horizon / 2, next_reclaim_at)
+                if heap:
+                    wake_at = min(wake_at, heap[0][0])
+                if listener is None:
+                    wake_at = min(wake_at, now + fallback_interval)
+                
+                try:
+                    event = await asyncio.wait_for(events.get(), timeout=max(0.0, wake_at - time.time()))
+                except asyncio.TimeoutError:
+                    if listener is None:
+                        loaded_until = 0.0  # Không có sự kiện - nạp lại toàn bộ
+                    continue
+                
+                if event.get('type') == 'reload':
+                    # Listener vừa kết nối lại, có thể đã lỡ sự kiện - nạp lại toàn bộ
+                    loaded_until = 0.0
+                    continue
+                
+                next_run_at = parse_datetime(event['next_run_at']) if event.get('next_run_at') else None
+                push(event['schedule_id'], next_run_at, loaded_until)
+        finally:
+            if listener is not None:
+                listener.cancel()
+                await channel_layer.group_discard(realtime.SCHEDULE_EVENTS_GROUP, channel_name)
+    
+    async def _listen_schedule_events(self, channel_layer, channel_name, events):
+        """
+        Nhận sự kiện schedule.changed từ channel layer, đẩy vào queue của engine
+        Lỗi (mất kết nối Redis...): log, chờ (backoff) rồi đăng ký lại group và nhận tiếp;
+        báo engine nạp lại toàn bộ vì có thể đã lỡ sự kiện trong lúc lỗi
+        """
+        delay = 1
+        while True:
+            try:
+                message = await channel_layer.receive(channel_name)
+            except Exception as e:
+                logger.exception('Schedule event listener failed')
+                self.stdout.write(
+                    self.style.ERROR(f'❌ Schedule event listener error: {e} - retrying in {delay}s')
+                )
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, LISTENER_RETRY_MAX)
+                try:
+                    await channel_layer.group_add(realtime.SCHEDULE_EVENTS_GROUP, channel_name)
+                except Exception as e:
+                    logger.warning(f'Schedule event listener re-subscribe failed: {e}')
+                    continue
+                await events.put({'type': 'reload'})
+                continue
+            
+            delay = 1
+            if message.get('type') == 'schedule.changed':
+                await events.put(message)
+    
+    def _load_upcoming(self, from_timestamp, until_timestamp):
+        """Lấy (id, next_run_at) của lịch có next_run_at trong (from, until]"""
+        queryset = DeviceSchedule.objects.filter(
+            is_active=True,
+            is_executed=False,
+            next_run_at__isnull=False,
+            next_run_at__lte=datetime.fromtimestamp(until_timestamp, tz=dt_timezone.utc),
+        )
+        if from_timestamp:
+            queryset = queryset.filter(
+                next_run_at__gt=datetime.fromtimestamp(from_timestamp, tz=dt_timezone.utc)
+            )
+        return [
+            (str(schedule_id), next_run_at)
+            for schedule_id, next_run_at in queryset.values_list('id', 'next_run_at')
+        ]
+    
     def check_and_execute_schedules(self):
         """Kiểm tra và thực thi schedules"""
         now = timezone.now()
@@ -45,32 +223,19 @@ class Command(BaseCommand):
             f'🕐 Current time: {now_local.strftime("%Y-%m-%d %H:%M:%S %z")}'
         )
         
-        # Tìm schedules active, chưa executed
-        pending_schedules = DeviceSchedule.objects.filter(
-            is_active=True,
-            is_executed=False
-        ).select_related('device', 'user')
-        
-        if not pending_schedules.exists():
-            self.stdout.write('⏰ No pending schedules found')
-            return
+        # Claim các schedules đã đến hạn (lease + SKIP LOCKED) - scheduler khác không lấy trùng
+        due_schedules = []
+        while True:
+            claimed = schedule_claim.claim_due(now, limit=self.batch_size)
+            due_schedules.extend(claimed)
+            if len(claimed) < self.batch_size:
+                break
         
         schedules_to_execute = []
+        skipped = []
         
-        for schedule in pending_schedules:
-            if schedule.scheduled_date:
-                scheduled_naive = datetime.combine(
-                    schedule.scheduled_date, 
-                    schedule.scheduled_time
-                )
-            else:
-                scheduled_naive = datetime.combine(
-                    now_local.date(), 
-                    schedule.scheduled_time
-                )
-            
-            scheduled_aware = timezone.make_aware(scheduled_naive)
-            scheduled_local = timezone.localtime(scheduled_aware)
+        for schedule in due_schedules:
+            scheduled_local = timezone.localtime(schedule.scheduled_at)
             
             self.stdout.write(
                 f'📅 {schedule.device.name} ({schedule.device.device_type.upper()})'
@@ -82,28 +247,23 @@ class Command(BaseCommand):
                 f'   🕐 Current:   {now_local.strftime("%Y-%m-%d %H:%M:%S %z")}'
             )
             
-            time_diff = (now - scheduled_aware).total_seconds()
+            time_diff = (now - schedule.scheduled_at).total_seconds()
             
-            if time_diff >= 0:
-                if time_diff > 300:  # Quá 5 phút
-                    self.stdout.write(
-                        self.style.WARNING(
-                            f'   ⚠️  Too late (delayed {time_diff/60:.1f} minutes) - Skipping'
-                        )
-                    )
-                    schedule.is_executed = True
-                    schedule.save()
-                else:
-                    self.stdout.write(
-                        self.style.SUCCESS(f'   ✅ Ready to execute (delay: {time_diff:.0f}s)')
+            if time_diff > 300:  # Quá 5 phút
+                self.stdout.write(
+                    self.style.WARNING(
+                        f'   ⚠️  Too late (delayed {time_diff/60:.1f} minutes) - Skipping'
                     )
-                    schedules_to_execute.append(schedule)
+                )
+                # Bỏ lần này: lịch lặp lại chuyển sang lần kế tiếp
+                skipped.append(schedule)
             else:
-                minutes_left = abs(time_diff) / 60
                 self.stdout.write(
-                    f'   ⏳ Not yet (in {minutes_left:.1f} minutes)'
+                    self.style.SUCCESS(f'   ✅ Ready to execute (delay: {time_diff:.0f}s)')
                 )
+                schedules_to_execute.append(schedule)
         
+        completed = schedule_claim.complete(skipped, now)
         if schedules_to_execute:
             self.stdout.write(
                 self.style.SUCCESS(
@@ -111,258 +271,123 @@ class Command(BaseCommand):
                 )
             )
             
-            for schedule in schedules_to_execute:
-                self.execute_schedule(schedule)
+            completed += self.execute_schedules_batch(schedules_to_execute)
         else:
             self.stdout.write('⏰ No schedules ready for execution')
+        
+        # (id, next_run_at mới) của các lịch đã hoàn tất - dùng cho heap engine
+        # (lịch lỗi giữ lease, được claim lại khi lease hết hạn)
+        return [(str(schedule.id), schedule.next_run_at) for schedule in completed]
     
-    def execute_schedule(self, schedule):
-        """Thực thi schedule - GỬI LỆNH ĐẾN ESP8266"""
-        try:
-            device = schedule.device
-            old_state = device.is_on
-            
-            self.stdout.write(f'⚡ Executing: {device.name} -> {schedule.action}')
-            
-            # ✅ BƯỚC 1: GỬI LỆNH ĐẾN ESP8266 TRƯỚC
-            esp_success = self._send_to_esp8266(device, schedule.action)
-            
-            if not esp_success:
-                self.stdout.write(
-                    self.style.ERROR(f'❌ Failed to send command to ESP8266')
-                )
-                # Có thể chọn: return để không cập nhật DB, hoặc vẫn cập nhật
-                # return  # Uncomment nếu muốn bỏ qua khi ESP8266 lỗi
-            
-            # ✅ BƯỚC 2: Cập nhật database
-            if schedule.action == 'on':
-                device.is_on = True
-                action_text = "BẬT"
-            elif schedule.action == 'off':
-                device.is_on = False
-                action_text = "TẮT"
-            else:
-                self.stdout.write(
-                    self.style.ERROR(f'❌ Unknown action: {schedule.action}')
-                )
-                return
-            
-            # Cập nhật device status
-            if not device.status:
-                device.status = {}
-            
-            device.status['last_scheduled_action'] = schedule.action
-            device.status['last_scheduled_time'] = timezone.now().isoformat()
-            device.save()
-            
-            # ✅ BƯỚC 3: Đánh dấu schedule đã executed
-            schedule.is_executed = True
-            schedule.executed_at = timezone.now()
-            schedule.save()
-            
-            # ✅ BƯỚC 4: Ghi log
-            try:
-                DeviceLog.objects.create(
-                    device=device,
-                    action=f'scheduled_{schedule.action}',
-                    old_status={'is_on': old_state},
-                    new_status={'is_on': device.is_on},
-                    user=schedule.user if schedule.user else None
-                )
-            except Exception as log_error:
-                self.stdout.write(
-                    self.style.WARNING(f'⚠️ Log error: {log_error}')
-                )
-            
-            self.stdout.write(
-                self.style.SUCCESS(
-                    f'✅ {action_text} {device.name} ({device.device_type.upper()}) | '
-                    f'ESP8266: {"✅" if esp_success else "❌"} | '
-                    f'DB: {old_state} → {device.is_on}'
-                )
-            )
-            
-            # ✅ BƯỚC 5: Gửi realtime update
-            self.send_realtime_update(device)
-            
-        except Exception as e:
-            self.stdout.write(
-                self.style.ERROR(f'❌ Lỗi thực thi schedule {schedule.id}: {e}')
-            )
-            logger.error(f'Schedule execution error: {e}', exc_info=True)
-            
-            try:
-                schedule.is_executed = True
-                schedule.save()
-            except:
-                pass
-    
-    def _send_to_esp8266(self, device, action):
+    def execute_schedules_batch(self, schedules):
         """
-        🔥 QUAN TRỌNG: Gửi lệnh điều khiển đến ESP8266
+        Thực thi nhiều schedule cùng lúc - GỬI LỆNH ĐẾN ESP8266
+        Các board chạy song song (mỗi board tuần tự), sau đó đọc lại device (SELECT FOR UPDATE)
+        và lưu device / schedule / log bằng bulk query trong 1 transaction
+        Returns: list schedule đã hoàn tất (schedule_claim.complete)
         """
-        try:
-            if not device.ip_address:
-                self.stdout.write(
-                    self.style.WARNING(f'⚠️ Device {device.name} không có IP address')
-                )
-                return False
-            
-            self.stdout.write(f'📡 Sending to ESP8266: {device.ip_address}')
-            
-            # Mapping device types
-            device_type = device.device_type.lower()
-            
-            if device_type in ['light', 'led']:
-                return self._control_light(device, action)
-            elif device_type == 'fan':
-                return self._control_fan(device, action)
-            elif device_type == 'door':
-                return self._control_door(device, action)
-            elif device_type == 'dryer':
-                return self._control_dryer(device, action)
+        now = timezone.now()
+        
+        valid_schedules = []
+        for schedule in schedules:
+            if schedule.action in ('on', 'off'):
+                valid_schedules.append(schedule)
             else:
                 self.stdout.write(
-                    self.style.WARNING(f'⚠️ Device type {device_type} chưa hỗ trợ')
+                    self.style.ERROR(f'❌ Unknown action: {schedule.action} ({schedule.device.name})')
                 )
-                return True  # Vẫn cho phép cập nhật DB
-            
-        except Exception as e:
-            self.stdout.write(
-                self.style.ERROR(f'❌ ESP8266 error: {e}')
-            )
-            return False
-    
-    def _control_light(self, device, action):
-        """Điều khiển đèn LED"""
-        try:
-            # Xác định LED number
-            led_number = self._get_led_number(device)
-            
-            # Xác định state
-            state = '1' if action == 'on' else '0'
-            
-            url = f"http://{device.ip_address}/led{led_number}?state={state}"
-            self.stdout.write(f'   🔗 LED URL: {url}')
-            
-            response = requests.get(url, timeout=5)
-            success = response.status_code == 200
-            
-            self.stdout.write(
-                self.style.SUCCESS(f'   ✅ LED response: {response.status_code}')
-                if success else
-                self.style.ERROR(f'   ❌ LED failed: {response.status_code}')
-            )
-            
-            return success
-            
-        except requests.exceptions.Timeout:
-            self.stdout.write(self.style.ERROR('   ❌ LED timeout'))
-            return False
-        except Exception as e:
-            self.stdout.write(self.style.ERROR(f'   ❌ LED error: {e}'))
-            return False
-    
-    def _control_fan(self, device, action):
-        """Điều khiển quạt"""
+        
+        # ✅ BƯỚC 1: GỬI LỆNH ĐẾN ESP8266 (nhóm theo board)
+        started = time.monotonic()
+        sent = control.send_grouped([
+            (schedule.device, schedule.action, {}) for schedule in valid_schedules
+        ])
+        boards = {str(s.device.ip_address).strip() for s in valid_schedules if s.device.ip_address}
+        self.stdout.write(
+            f'📡 Sent {len(valid_schedules)} command(s) to {len(boards)} ESP8266 board(s) '
+            f'in {time.monotonic() - started:.2f}s'
+        )
+        
+        # ✅ BƯỚC 2: Lưu trạng thái device + log + hoàn tất lịch (bỏ lease) trong 1 transaction
+        # (vẫn cập nhật DB khi ESP8266 lỗi, giống trước đây)
+        # Đọc lại device với SELECT FOR UPDATE: trong lúc gửi lệnh, API / poller có thể
+        # đã đổi device - chỉ ghi đè is_on và các key last_scheduled_* của status
+        # Lỗi: lịch giữ lease, hết hạn thì được claim và gửi lại
+        results = []
         try:
-            speed = '3' if action == 'on' else '0'
-            
-            url = f"http://{device.ip_address}/fan?speed={speed}"
-            self.stdout.write(f'   🔗 FAN URL: {url}')
-            
-            response = requests.get(url, timeout=5)
-            success = response.status_code == 200
-            
-            self.stdout.write(
-                self.style.SUCCESS(f'   ✅ FAN response: {response.status_code}')
-                if success else
-                self.style.ERROR(f'   ❌ FAN failed: {response.status_code}')
-            )
-            
-            return success
-            
+            with transaction.atomic():
+                fresh = Device.objects.select_for_update().in_bulk(
+                    list({schedule.device_id for schedule in valid_schedules})
+                )
+                initial_is_on = {device_id: device.is_on for device_id, device in fresh.items()}
+                changed_devices = {}
+                logs = []
+                for schedule, esp_success in zip(valid_schedules, sent):
+                    device = fresh.get(schedule.device_id)
+                    if device is None:
+                        continue
+                    old_state = device.is_on
+                    device.is_on = schedule.action == 'on'
+                    
+                    if not device.status:
+                        device.status = {}
+                    device.status['last_scheduled_action'] = schedule.action
+                    device.status['last_scheduled_time'] = now.isoformat()
+                    device.updated_at = now
+                    changed_devices[device.id] = device
+                    
+                    logs.append(DeviceLog(
+                        device=device,
+                        action=f'scheduled_{schedule.action}',
+                        old_status={'is_on': old_state},
+                        new_status={'is_on': device.is_on},
+                        user=schedule.user
+                    ))
+                    results.append((device.name, device.device_type, old_state, device.is_on, esp_success))
+                
+                if changed_devices:
+                    # Mở / đóng session theo trạng thái đầu và cuối của mỗi device trong batch
+                    control.bulk_update_statistics([
+                        (device, initial_is_on[device_id], device.is_on)
+                        for device_id, device in changed_devices.items()
+                    ])
+                    Device.objects.bulk_update(
+                        list(changed_devices.values()),
+                        ['is_on', 'status', 'current_session_start', 'updated_at']
+                    )
+                    # bulk_update không gửi signal
+                    device_cache.invalidate()
+                DeviceLog.objects.bulk_create(logs)
+                completed = schedule_claim.complete(schedules, now)
         except Exception as e:
-            self.stdout.write(self.style.ERROR(f'   ❌ FAN error: {e}'))
-            return False
-    
-    def _control_door(self, device, action):
-        """Điều khiển cửa"""
-        try:
-            door_action = 'open' if action == 'on' else 'close'
-            
-            url = f"http://{device.ip_address}/door?action={door_action}"
-            self.stdout.write(f'   🔗 DOOR URL: {url}')
-            
-            response = requests.get(url, timeout=5)
-            success = response.status_code == 200
-            
             self.stdout.write(
-                self.style.SUCCESS(f'   ✅ DOOR response: {response.status_code}')
-                if success else
-                self.style.ERROR(f'   ❌ DOOR failed: {response.status_code}')
+                self.style.ERROR(f'❌ Lỗi lưu kết quả {len(schedules)} schedule(s): {e}')
             )
-            
-            return success
-            
-        except Exception as e:
-            self.stdout.write(self.style.ERROR(f'   ❌ DOOR error: {e}'))
-            return False
-    
-    def _control_dryer(self, device, action):
-        """Điều khiển máy sấy"""
-        try:
-            dryer_action = 'out' if action == 'on' else 'in'
-            
-            url = f"http://{device.ip_address}/dry?action={dryer_action}"
-            self.stdout.write(f'   🔗 DRYER URL: {url}')
-            
-            response = requests.get(url, timeout=5)
-            success = response.status_code == 200
-            
+            logger.error(f'Schedule batch execution error: {e}', exc_info=True)
+            return []
+        
+        # ✅ BƯỚC 3: In kết quả từng schedule
+        for name, device_type, old_state, new_state, esp_success in results:
+            action_text = "BẬT" if new_state else "TẮT"
             self.stdout.write(
-                self.style.SUCCESS(f'   ✅ DRYER response: {response.status_code}')
-                if success else
-                self.style.ERROR(f'   ❌ DRYER failed: {response.status_code}')
+                (self.style.SUCCESS if esp_success else self.style.WARNING)(
+                    f'{"✅" if esp_success else "⚠️"} {action_text} {name} '
+                    f'({device_type.upper()}) | '
+                    f'ESP8266: {"✅" if esp_success else "❌"} | '
+                    f'DB: {old_state} → {new_state}'
+                )
             )
-            
-            return success
-            
-        except Exception as e:
-            self.stdout.write(self.style.ERROR(f'   ❌ DRYER error: {e}'))
-            return False
-    
-    def _get_led_number(self, device):
-        """Xác định LED number từ device name"""
-        name = device.name.lower()
-        if '2' in name or 'ngủ' in name or 'ngu' in name:
-            return '2'
-        return '1'
+        
+        # ✅ BƯỚC 4: Gửi realtime update (1 message mỗi phòng cho cả batch)
+        broadcaster = self.get_broadcaster()
+        for device in changed_devices.values():
+            broadcaster.add(device)
+        if broadcaster.flush(force=True):
+            self.stdout.write(f'   📡 Đã gửi realtime update ({len(changed_devices)} device)')
+        return completed
     
-    def send_realtime_update(self, device):
-        """Gửi realtime update qua WebSocket"""
-        try:
-            from asgiref.sync import async_to_sync
-            from channels.layers import get_channel_layer
-            
-            channel_layer = get_channel_layer()
-            if channel_layer:
-                async_to_sync(channel_layer.group_send)(
-                    'device_updates',
-                    {
-                        'type': 'device_update',
-                        'device': {
-                            'id': str(device.id),
-                            'name': device.name,
-                            'is_on': device.is_on,
-                            'device_type': device.device_type,
-                            'status': device.status,
-                            'updated_at': device.updated_at.isoformat() if device.updated_at else None,
-                        }
-                    }
-                )
-                self.stdout.write('   📡 Đã gửi realtime update')
-        except Exception as e:
-            self.stdout.write(
-                self.style.WARNING(f'   ⚠️ Không gửi được realtime update: {e}')
-            )
\ No newline at end of file
+    def get_broadcaster(self):
+        """Broadcaster dùng chung cho scheduler (giữ trạng thái đã gửi để tính delta)"""
+        if self._broadcaster is None:
+            self._broadcaster = realtime.UpdateBroadcaster()
+        return self._broadcaster
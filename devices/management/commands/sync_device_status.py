@@ -1,7 +1,14 @@
 # devices/management/commands/sync_device_status.py
+from django.conf import settings
+from django.core.cache import cache
 from django.core.management.base import BaseCommand
+from django.db import transaction
 from django.utils import timezone
-from devices.models import Device, DeviceLog
+from devices.models import Device
+from devices import control, device_cache, esp_client, realtime
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import heapq
 import requests
 import json
 import time
@@ -9,8 +16,150 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+PUSH_CACHE_KEY = 'esp_push:{ip}'
+
+
+def mark_board_pushed(ip):
+    """Ghi nhận board vừa push trạng thái để poller chỉ poll dự phòng"""
+    fallback = getattr(settings, 'ESP_PUSH_FALLBACK_SECONDS', 60)
+    cache.set(PUSH_CACHE_KEY.format(ip=ip), time.time(), timeout=fallback)
+
+
+def recently_pushed(ips):
+    """Trả về tập IP đã push trong ESP_PUSH_FALLBACK_SECONDS gần nhất"""
+    if not ips:
+        return set()
+    try:
+        keys = {PUSH_CACHE_KEY.format(ip=ip): ip for ip in ips}
+        return {keys[key] for key in cache.get_many(list(keys))}
+    except Exception as e:
+        # Cache lỗi thì poll như bình thường
+        logger.warning(f'Push cache unavailable: {e}')
+        return set()
+
+
+class PollScheduler:
+    """
+    Lịch poll riêng cho từng ESP8266 (theo IP).
+    - Board vừa thay đổi: poll lại sau min_interval
+    - Board ổn định: giãn dần interval (x1.5) đến max_interval
+    - Board lỗi liên tục: backoff lũy thừa (x2) đến max_backoff
+    Thời điểm poll kế tiếp lưu trong min-heap để mỗi lượt chỉ lấy các IP đã đến hạn.
+    """
+
+    STABLE_FACTOR = 1.5
+
+    def __init__(self, min_interval, max_interval, max_backoff, offline_after=3):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.max_backoff = max(max_backoff, min_interval)
+        self.offline_after = offline_after
+        self._heap = []  # (next_poll_at, ip)
+        self._state = {}  # ip -> {'next_at', 'interval', 'failures', 'online'}
+
+    def sync_ips(self, ips, now):
+        """Thêm IP mới (poll ngay) và bỏ IP không còn device"""
+        ips = set(ips)
+        for ip in list(self._state):
+            if ip not in ips:
+                # Entry cũ trong heap sẽ bị bỏ qua khi pop
+                del self._state[ip]
+        for ip in ips:
+            if ip not in self._state:
+                self._state[ip] = {
+                    'next_at': now,
+                    'interval': self.min_interval,
+                    'failures': 0,
+                    'online': None,
+                }
+                heapq.heappush(self._heap, (now, ip))
+
+    def pop_due(self, now):
+        """Lấy các IP đã đến hạn poll"""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            next_at, ip = heapq.heappop(self._heap)
+            state = self._state.get(ip)
+            if state is None or state['next_at'] != next_at:
+                continue  # Entry đã bị thay thế
+            due.append(ip)
+        return due
+
+    def seconds_until_next(self, now):
+        """Số giây đến lần poll kế tiếp (None nếu không có IP nào)"""
+        while self._heap:
+            next_at, ip = self._heap[0]
+            state = self._state.get(ip)
+            if state is None or state['next_at'] != next_at:
+                heapq.heappop(self._heap)
+                continue
+            return max(0.0, next_at - now)
+        return None
+
+    def record_success(self, ip, changed, now):
+        """
+        Ghi nhận poll thành công
+        Returns: True nếu board vừa chuyển sang online (cần cập nhật DB)
+        """
+        state = self._state.get(ip)
+        if state is None:
+            return False
+        
+        if changed:
+            state['interval'] = self.min_interval
+        elif state['failures']:
+            state['interval'] = self.min_interval
+        else:
+            state['interval'] = min(state['interval'] * self.STABLE_FACTOR, self.max_interval)
+        state['failures'] = 0
+        
+        flipped = state['online'] is not True
+        state['online'] = True
+        self._schedule(ip, now + state['interval'])
+        return flipped
+
+    def record_push(self, ip, now):
+        """Board đã tự push trạng thái: lùi lần poll kế tiếp về max_interval"""
+        state = self._state.get(ip)
+        if state is None:
+            return
+        state['failures'] = 0
+        state['online'] = True
+        state['interval'] = self.max_interval
+        self._schedule(ip, now + self.max_interval)
+
+    def record_failure(self, ip, now):
+        """
+        Ghi nhận poll lỗi (timeout, mất kết nối...)
+        Returns: True nếu board vừa chuyển sang offline (cần cập nhật DB)
+        """
+        state = self._state.get(ip)
+        if state is None:
+            return False
+        
+        state['failures'] += 1
+        state['interval'] = min(self.min_interval * (2 ** state['failures']), self.max_backoff)
+        
+        flipped = False
+        if state['failures'] >= self.offline_after and state['online'] is not False:
+            state['online'] = False
+            flipped = True
+        self._schedule(ip, now + state['interval'])
+        return flipped
+
+    def _schedule(self, ip, next_at):
+        self._state[ip]['next_at'] = next_at
+        heapq.heappush(self._heap, (next_at, ip))
+
+
 class Command(BaseCommand):
     help = 'Sync device status from ESP8266 hardware'
+
+    # Giá trị mặc định khi Command được tạo trực tiếp (vd: DeviceSyncView)
+    engine = 'sync'
+    concurrency = 16
+    _executor = None
+    _broadcaster = None
     
     def add_arguments(self, parser):
         parser.add_argument(
@@ -19,25 +168,171 @@ class Command(BaseCommand):
             default=5,
             help='Polling interval in seconds (default: 5)',
         )
+        parser.add_argument(
+            '--engine',
+            choices=['sync', 'async'],
+            default='sync',
+            help='Poll engine: "sync" polls boards one by one, "async" polls all boards at once (default: sync)',
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=16,
+            help='Max concurrent ESP8266 requests for --engine=async (default: 16)',
+        )
+        parser.add_argument(
+            '--schedule',
+            choices=['fixed', 'adaptive'],
+            default='fixed',
+            help='Polling schedule: "fixed" polls every board each --interval, '
+                 '"adaptive" keeps a per-board interval with backoff (default: fixed)',
+        )
+        parser.add_argument(
+            '--max-interval',
+            type=int,
+            default=60,
+            help='Adaptive: longest interval for boards that have not changed (default: 60)',
+        )
+        parser.add_argument(
+            '--max-backoff',
+            type=int,
+            default=300,
+            help='Adaptive: longest backoff for boards that keep failing (default: 300)',
+        )
+        parser.add_argument(
+            '--offline-after',
+            type=int,
+            default=3,
+            help='Adaptive: consecutive failures before devices are marked offline (default: 3)',
+        )
     
     def handle(self, *args, **options):
         interval = options['interval']
+        self.engine = options['engine']
+        self.concurrency = max(1, options['concurrency'])
         self.stdout.write(
-            self.style.SUCCESS(f'🔄 Starting Device Status Sync (polling every {interval}s)...')
+            self.style.SUCCESS(
+                f'🔄 Starting Device Status Sync (polling every {interval}s, '
+                f'engine={self.engine}, schedule={options["schedule"]})...'
+            )
         )
         
         try:
-            while True:
-                self.sync_all_devices()
-                time.sleep(interval)
+            if options['schedule'] == 'adaptive':
+                scheduler = PollScheduler(
+                    min_interval=interval,
+                    max_interval=options['max_interval'],
+                    max_backoff=options['max_backoff'],
+                    offline_after=max(1, options['offline_after']),
+                )
+                self.run_adaptive(scheduler)
+            else:
+                while True:
+                    cycle_start = time.monotonic()
+                    self.sync_all_devices()
+                    # Trừ thời gian của chu kỳ để giữ đúng interval
+                    elapsed = time.monotonic() - cycle_start
+                    time.sleep(max(0, interval - elapsed))
                 
         except KeyboardInterrupt:
             self.stdout.write(
                 self.style.WARNING('\n🛑 Status sync stopped by user')
             )
-    
+        finally:
+            if self._executor:
+                self._executor.shutdown(wait=False)
+
+    def run_adaptive(self, scheduler):
+        """Vòng lặp poll theo lịch riêng từng IP (--schedule=adaptive)"""
+        devices_by_ip = {}
+        next_refresh = 0.0
+        
+        while True:
+            now = time.monotonic()
+            
+            # Nạp lại danh sách device định kỳ (device mới / đổi IP)
+            if now >= next_refresh:
+                devices_by_ip = self.load_devices_by_ip()
+                scheduler.sync_ips(devices_by_ip, now)
+                next_refresh = now + scheduler.max_interval
+            
+            due_ips = scheduler.pop_due(now)
+            
+            # Board đã push gần đây thì chỉ poll dự phòng
+            pushed_ips = recently_pushed(due_ips)
+            for ip in pushed_ips:
+                scheduler.record_push(ip, now)
+            due_ips = [ip for ip in due_ips if ip not in pushed_ips]
+            
+            if due_ips:
+                self.stdout.write(f'🔄 Polling {len(due_ips)}/{len(devices_by_ip)} board(s) due')
+                due_devices = {ip: devices_by_ip[ip] for ip in due_ips}
+                statuses = self.fetch_statuses(due_devices)
+                
+                try:
+                    changed_devices = self._reconcile_changed(due_devices, statuses)
+                except Exception as e:
+                    self.stdout.write(self.style.ERROR(f'❌ Reconcile error: {e}'))
+                    changed_devices = []
+                changed_ips = {str(device.ip_address).strip() for device in changed_devices}
+                
+                done_at = time.monotonic()
+                for ip in due_ips:
+                    if statuses.get(ip) is None:
+                        if scheduler.record_failure(ip, done_at):
+                            self.set_online(ip, False)
+                    elif scheduler.record_success(ip, ip in changed_ips, done_at):
+                        self.set_online(ip, True)
+            
+            wait = scheduler.seconds_until_next(time.monotonic())
+            if wait is None:
+                wait = scheduler.max_interval
+            time.sleep(min(wait, max(0.0, next_refresh - time.monotonic())))
+
+    def set_online(self, ip, is_online):
+        """Cập nhật is_online cho tất cả device của 1 ESP8266"""
+        updated = Device.objects.filter(ip_address=ip).exclude(is_online=is_online).update(
+            is_online=is_online,
+            updated_at=timezone.now(),
+        )
+        if updated:
+            device_cache.invalidate()
+            self.stdout.write(
+                self.style.SUCCESS(f'🟢 ESP8266 {ip}: online') if is_online else
+                self.style.WARNING(f'🔴 ESP8266 {ip}: offline ({updated} device(s))')
+            )
+
     def sync_all_devices(self):
-        """Đồng bộ trạng thái - DÙNG SQL TRỰC TIẾP HOÀN TOÀN"""
+        """Đồng bộ trạng thái tất cả ESP8266 trong 1 chu kỳ"""
+        devices_by_ip = self.load_devices_by_ip()
+        
+        # Board đã push gần đây thì không cần poll
+        for ip in recently_pushed(list(devices_by_ip)):
+            self.stdout.write(f'📨 {ip}: pushed recently, skipping poll')
+            del devices_by_ip[ip]
+        
+        if not devices_by_ip:
+            return 0
+        
+        statuses = self.fetch_statuses(devices_by_ip)
+        
+        # Cập nhật DB 1 lần cho cả chu kỳ
+        try:
+            changes_count = self.reconcile_devices(devices_by_ip, statuses)
+        except Exception as e:
+            self.stdout.write(self.style.ERROR(f'❌ Reconcile error: {e}'))
+            return 0
+        
+        if changes_count > 0:
+            self.stdout.write(
+                self.style.SUCCESS(f'✅ Updated {changes_count} device(s) this cycle')
+            )
+        else:
+            self.stdout.write('ℹ️ No changes this cycle')
+        return changes_count
+
+    def load_devices_by_ip(self):
+        """Lấy devices có IP - DÙNG SQL TRỰC TIẾP HOÀN TOÀN, nhóm theo IP"""
         
         from django.db import connection
         
@@ -56,7 +351,7 @@ class Command(BaseCommand):
         
         if not devices_data:
             self.stdout.write('⚠️ No devices with IP found')
-            return
+            return {}
         
         # Tạo device objects từ SQL data
         devices = []
@@ -83,40 +378,73 @@ class Command(BaseCommand):
                 devices_by_ip[clean_ip] = []
             devices_by_ip[clean_ip].append(device)
         
-        # Sync từng IP
+        return devices_by_ip
+
+    def fetch_statuses(self, devices_by_ip):
+        """
+        Lấy status của các ESP8266 theo engine đã chọn
+        Returns: dict {ip: esp_status hoặc None nếu lỗi}
+        """
+        if self.engine == 'async':
+            # Gọi tất cả ESP8266 cùng lúc
+            return asyncio.run(self.fetch_all_statuses(list(devices_by_ip)))
+        
+        # Gọi từng IP
+        statuses = {}
         for ip, device_list in devices_by_ip.items():
             self.stdout.write(f'🔄 Syncing {len(device_list)} devices from {ip}')
-            self.sync_esp8266(ip, device_list)
+            statuses[ip] = self.fetch_esp_status(ip)
+        return statuses
+
+    async def fetch_all_statuses(self, ips):
+        """
+        Gọi /api/status của tất cả ESP8266 song song (tối đa --concurrency request cùng lúc)
+        Returns: dict {ip: esp_status hoặc None nếu lỗi}
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.concurrency,
+                thread_name_prefix='esp-poll',
+            )
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        
+        async def fetch(ip):
+            async with semaphore:
+                return ip, await loop.run_in_executor(self._executor, self.fetch_esp_status, ip)
+        
+        results = await asyncio.gather(*(fetch(ip) for ip in ips))
+        return dict(results)
 
     def sync_esp8266(self, ip, devices):
         """Đồng bộ trạng thái từ ESP8266 qua endpoint /api/status"""
+        esp_status = self.fetch_esp_status(ip)
+        if esp_status is not None:
+            self.apply_esp_status(ip, devices, esp_status)
+
+    def fetch_esp_status(self, ip):
+        """
+        Gọi API /api/status của 1 ESP8266
+        Returns: dict status, hoặc None nếu lỗi
+        """
         try:
-            # Gọi API status của ESP8266
-            url = f"http://{ip}/api/status"
-            response = requests.get(url, timeout=3)
+            # Không retry: board lỗi đã có backoff riêng (--schedule=adaptive)
+            response = esp_client.esp_get(
+                ip, '/api/status',
+                timeout=getattr(settings, 'ESP_STATUS_TIMEOUT', 3),
+                retry=False,
+            )
             
             if response.status_code != 200:
                 self.stdout.write(
                     self.style.WARNING(f'⚠️ ESP8266 {ip}: HTTP {response.status_code}')
                 )
-                return
+                return None
             
             # Parse JSON response
             esp_status = response.json()
             self.stdout.write(f'📡 ESP8266 {ip}: {esp_status}')
-            
-            # Cập nhật từng device
-            changes_count = 0
-            for device in devices:
-                if self.update_device_status(device, esp_status):
-                    changes_count += 1
-            
-            if changes_count > 0:
-                self.stdout.write(
-                    self.style.SUCCESS(f'✅ Updated {changes_count} device(s) from {ip}')
-                )
-            else:
-                self.stdout.write(f'ℹ️ No changes from {ip}')
+            return esp_status
                 
         except requests.exceptions.Timeout:
             self.stdout.write(
@@ -126,7 +454,7 @@ class Command(BaseCommand):
             self.stdout.write(
                 self.style.WARNING(f'❌ ESP8266 {ip}: Connection failed')
             )
-        except json.JSONDecodeError:
+        except (json.JSONDecodeError, ValueError):
             self.stdout.write(
                 self.style.ERROR(f'❌ ESP8266 {ip}: Invalid JSON response')
             )
@@ -134,15 +462,107 @@ class Command(BaseCommand):
             self.stdout.write(
                 self.style.ERROR(f'❌ ESP8266 {ip}: {e}')
             )
+        return None
+
+    def apply_esp_status(self, ip, devices, esp_status):
+        """Cập nhật các device của 1 ESP8266 theo status đã lấy được"""
+        try:
+            changes_count = self.reconcile_devices({ip: devices}, {ip: esp_status})
+            
+            if changes_count > 0:
+                self.stdout.write(
+                    self.style.SUCCESS(f'✅ Updated {changes_count} device(s) from {ip}')
+                )
+            else:
+                self.stdout.write(f'ℹ️ No changes from {ip}')
+        except Exception as e:
+            self.stdout.write(
+                self.style.ERROR(f'❌ ESP8266 {ip}: {e}')
+            )
+            return 0
+        return changes_count
 
     def update_device_status(self, device, esp_status):
         """
         Cập nhật trạng thái 1 device dựa trên ESP status
         Returns: True nếu có thay đổi, False nếu không
         """
-        # Lấy device thực từ database
-        real_device = Device.objects.get(id=device.id)
+        return self.reconcile_devices({'_': [device]}, {'_': esp_status}) > 0
+
+    def reconcile_devices(self, devices_by_ip, statuses):
+        """
+        Cập nhật hàng loạt theo status của các ESP8266:
+        load devices 1 lần, tính thay đổi trong bộ nhớ, ghi bằng 1 bulk_update
+        Returns: số device đã thay đổi
+        """
+        return len(self._reconcile_changed(devices_by_ip, statuses))
+
+    def _reconcile_changed(self, devices_by_ip, statuses):
+        """Như reconcile_devices nhưng trả về danh sách device đã thay đổi"""
+        device_ids = [
+            device.id
+            for ip, device_list in devices_by_ip.items()
+            if statuses.get(ip) is not None
+            for device in device_list
+        ]
+        if not device_ids:
+            return []
+        
+        # Lấy device thực từ database - 1 query cho cả chu kỳ
+        real_devices = Device.objects.in_bulk(device_ids)
+        
+        now = timezone.now()
+        changed_devices = []
+        transitions = []
+        for ip, device_list in devices_by_ip.items():
+            esp_status = statuses.get(ip)
+            if esp_status is None:
+                continue
+            
+            for device in device_list:
+                real_device = real_devices.get(device.id)
+                if real_device is None:
+                    continue
+                
+                change = self._compute_device_change(real_device, esp_status)
+                if change is None:
+                    continue
+                
+                old_is_on = real_device.is_on
+                real_device.is_on, real_device.status = change
+                # bulk_update không tự cập nhật auto_now
+                real_device.updated_at = now
+                changed_devices.append(real_device)
+                transitions.append((real_device, old_is_on, real_device.is_on))
+        
+        if not changed_devices:
+            return []
+        
+        # Bật / tắt từ công tắc vật lý cũng mở / đóng session như điều khiển qua app
+        with transaction.atomic():
+            control.bulk_update_statistics(transitions)
+            Device.objects.bulk_update(
+                changed_devices, ['is_on', 'status', 'current_session_start', 'updated_at']
+            )
+        # bulk_update không gửi signal
+        device_cache.invalidate()
+        
+        # 🔥 ĐÃ BỎ GHI LOG Ở ĐÂY
         
+        # Gửi realtime update (gom theo phòng, chỉ field thay đổi)
+        # force: gửi ngay cuối chu kỳ, không để thay đổi nằm chờ đến chu kỳ sau
+        broadcaster = self.get_broadcaster()
+        for real_device in changed_devices:
+            broadcaster.add(real_device)
+        broadcaster.flush(force=True)
+        
+        return changed_devices
+
+    def _compute_device_change(self, real_device, esp_status):
+        """
+        Tính trạng thái mới của 1 device từ ESP status (không ghi DB)
+        Returns: (new_is_on, new_status) nếu có thay đổi, None nếu không
+        """
         # Xử lý status field (có thể là string hoặc dict)
         old_status = self._parse_status_field(real_device.status)
         old_is_on = real_device.is_on
@@ -153,7 +573,7 @@ class Command(BaseCommand):
         device_type = real_device.device_type.lower()
         
         if device_type in ['light', 'led']:
-            led_num = self._get_led_number(real_device)
+            led_num = esp_client.get_led_number(real_device)
             key = f"LED{led_num}"
             if key in esp_status:
                 new_is_on = bool(esp_status[key])
@@ -172,22 +592,20 @@ class Command(BaseCommand):
         
         # Nếu không xác định được hoặc không thay đổi
         if new_is_on is None or new_is_on == old_is_on:
-            return False
+            return None
         
-        # CÓ THAY ĐỔI - Cập nhật database
+        # CÓ THAY ĐỔI
         self.stdout.write(
             self.style.WARNING(
                 f'🔄 {real_device.name}: {old_is_on} → {new_is_on}'
             )
         )
         
-        real_device.is_on = new_is_on
-        
         # Cập nhật status chi tiết
         device_status = old_status.copy()  # Đã được parse thành dict
         
         if device_type in ['light', 'led']:
-            led_num = self._get_led_number(real_device)
+            led_num = esp_client.get_led_number(real_device)
             key = f"LED{led_num}"
             device_status['state'] = 'on' if new_is_on else 'off'
             device_status['value'] = esp_status.get(key, 0)
@@ -210,15 +628,7 @@ class Command(BaseCommand):
             device_status['humidity'] = esp_status.get('HUM')
             device_status['last_updated'] = timezone.now().isoformat()
         
-        real_device.status = device_status
-        real_device.save()
-        
-        # 🔥 ĐÃ BỎ GHI LOG Ở ĐÂY
-        
-        # Gửi realtime update
-        self.send_realtime_update(real_device)
-        
-        return True
+        return new_is_on, device_status
 
     def _parse_status_field(self, status_field):
         """Parse status field từ string JSON thành dictionary"""
@@ -237,106 +647,9 @@ class Command(BaseCommand):
                 return {}
         
         return {}
-
-    
-    def _get_led_number(self, device):
-        """Xác định LED number từ device name"""
-        name = device.name.lower()
-        if '2' in name or 'ngủ' in name or 'ngu' in name:
-            return '2'
-        return '1'
-    
-    def _update_statistics(self, device, new_is_on, old_is_on):
-        """Cập nhật thống kê khi có thay đổi trạng thái"""
-        from devices.models import DeviceStatistics, DeviceUsageSession
-        
-        today = timezone.localtime(timezone.now()).date()
-        
-        # Bật thiết bị
-        if new_is_on and not old_is_on:
-            # Tạo session mới
-            DeviceUsageSession.objects.create(
-                device=device,
-                start_time=timezone.now()
-            )
-            
-            # Cập nhật số lần bật
-            stats, created = DeviceStatistics.objects.get_or_create(
-                device=device,
-                date=today,
-                defaults={
-                    'turn_on_count': 1,
-                    'total_usage_minutes': 0,
-                    'power_consumption': 0.0,
-                    'cost': 0.0
-                }
-            )
-            if not created:
-                stats.turn_on_count += 1
-                stats.save()
-        
-        # Tắt thiết bị
-        elif not new_is_on and old_is_on:
-            # Kết thúc session
-            active_session = DeviceUsageSession.objects.filter(
-                device=device,
-                end_time__isnull=True
-            ).order_by('-start_time').first()
-            
-            if active_session:
-                active_session.end_time = timezone.now()
-                duration = (active_session.end_time - active_session.start_time).total_seconds() / 60
-                active_session.duration_minutes = int(duration)
-                active_session.save()
-                
-                # Cập nhật thống kê
-                if active_session.duration_minutes > 0:
-                    power_rates = {
-                        'light': 0.01, 'led': 0.01, 'fan': 0.05,
-                        'ac': 0.8, 'dryer': 0.1, 'door': 0.005
-                    }
-                    
-                    stats, _ = DeviceStatistics.objects.get_or_create(
-                        device=device,
-                        date=today,
-                        defaults={
-                            'turn_on_count': 0,
-                            'total_usage_minutes': 0,
-                            'power_consumption': 0.0,
-                            'cost': 0.0
-                        }
-                    )
-                    
-                    power_rate = power_rates.get(device.device_type.lower(), 0.01)
-                    hours_used = active_session.duration_minutes / 60
-                    stats.total_usage_minutes += active_session.duration_minutes
-                    stats.power_consumption += power_rate * hours_used
-                    stats.cost += stats.power_consumption * 3000
-                    stats.save()
     
-    def send_realtime_update(self, device):
-        """Gửi realtime update qua WebSocket"""
-        try:
-            from asgiref.sync import async_to_sync
-            from channels.layers import get_channel_layer
-            
-            channel_layer = get_channel_layer()
-            if channel_layer:
-                async_to_sync(channel_layer.group_send)(
-                    'device_updates',
-                    {
-                        'type': 'device_update',
-                        'device': {
-                            'id': str(device.id),
-                            'name': device.name,
-                            'is_on': device.is_on,
-                            'device_type': device.device_type,
-                            'status': device.status,
-                            'updated_at': timezone.now().isoformat(),
-                        }
-                    }
-                )
-        except Exception as e:
-            self.stdout.write(
-                self.style.WARNING(f'⚠️ WebSocket update failed: {e}')
-            )
\ No newline at end of file
+    def get_broadcaster(self):
+        """Broadcaster dùng chung cho cả vòng lặp (giữ trạng thái đã gửi để tính delta)"""
+        if self._broadcaster is None:
+            self._broadcaster = realtime.UpdateBroadcaster()
+        return self._broadcaster
@@ -0,0 +1,75 @@
+# Generated by Django 5.2.5 on 2026-10-17 09:30
+
+import datetime
+
+from django.db import migrations, models
+from django.utils import timezone
+
+# Bản sao logic tại thời điểm tạo migration (không import devices.models: code đó còn thay đổi)
+WEEKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+ALL_WEEKDAYS_MASK = 0b1111111
+
+
+def weekday_mask(repeat_days):
+    mask = 0
+    for day in repeat_days or []:
+        day = str(day).lower()[:3]
+        if day in WEEKDAYS:
+            mask |= 1 << WEEKDAYS.index(day)
+    return mask
+
+
+def next_scheduled_datetime(schedule, now):
+    today = now.date()
+
+    if schedule.repeat_type == 'once':
+        once_date = schedule.scheduled_date or today
+        once_datetime = timezone.make_aware(datetime.datetime.combine(once_date, schedule.scheduled_time))
+        return once_datetime if once_datetime > now else None
+
+    if schedule.repeat_type == 'daily':
+        mask = ALL_WEEKDAYS_MASK
+    elif schedule.repeat_type == 'weekly':
+        mask = weekday_mask(schedule.repeat_days)
+    else:
+        mask = 0
+    if not mask:
+        return None
+
+    weekday = today.weekday()
+    rotated = ((mask >> weekday) | (mask << (7 - weekday))) & ALL_WEEKDAYS_MASK
+    today_datetime = timezone.make_aware(datetime.datetime.combine(today, schedule.scheduled_time))
+    if today_datetime <= now:
+        rotated = (rotated & ~1) | ((rotated & 1) << 7)
+    days_to_add = (rotated & -rotated).bit_length() - 1
+    next_date = today + datetime.timedelta(days=days_to_add)
+    return timezone.make_aware(datetime.datetime.combine(next_date, schedule.scheduled_time))
+
+
+def fill_next_run_at(apps, schema_editor):
+    now = timezone.localtime(timezone.now())
+    DeviceSchedule = apps.get_model('devices', 'DeviceSchedule')
+    schedules = list(DeviceSchedule.objects.filter(is_active=True, is_executed=False))
+    for schedule in schedules:
+        schedule.next_run_at = next_scheduled_datetime(schedule, now)
+    DeviceSchedule.objects.bulk_update(schedules, ['next_run_at'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devices', '0002_devicescene'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deviceschedule',
+            name='next_run_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='deviceschedule',
+            index=models.Index(fields=['is_active', 'is_executed', 'next_run_at'], name='device_sched_due_idx'),
+        ),
+        migrations.RunPython(fill_next_run_at, migrations.RunPython.noop),
+    ]
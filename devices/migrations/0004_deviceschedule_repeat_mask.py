@@ -0,0 +1,39 @@
+# Generated by Django 5.2.5 on 2026-10-17 10:30
+
+from django.db import migrations, models
+
+# Bản sao logic tại thời điểm tạo migration (không import devices.models: code đó còn thay đổi)
+WEEKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+
+def weekday_mask(repeat_days):
+    mask = 0
+    for day in repeat_days or []:
+        day = str(day).lower()[:3]
+        if day in WEEKDAYS:
+            mask |= 1 << WEEKDAYS.index(day)
+    return mask
+
+
+def fill_repeat_mask(apps, schema_editor):
+    DeviceSchedule = apps.get_model('devices', 'DeviceSchedule')
+    schedules = list(DeviceSchedule.objects.filter(repeat_type='weekly'))
+    for schedule in schedules:
+        schedule.repeat_mask = weekday_mask(schedule.repeat_days)
+    DeviceSchedule.objects.bulk_update(schedules, ['repeat_mask'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devices', '0003_deviceschedule_next_run_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deviceschedule',
+            name='repeat_mask',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_repeat_mask, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.5 on 2026-10-17 11:00
+
+from django.db import migrations, models
+
+
+def fill_current_session_start(apps, schema_editor):
+    Device = apps.get_model('devices', 'Device')
+    DeviceUsageSession = apps.get_model('devices', 'DeviceUsageSession')
+    
+    # Session đang chạy mới nhất của mỗi thiết bị
+    current = {}
+    for device_id, start_time in DeviceUsageSession.objects.filter(
+        end_time__isnull=True
+    ).order_by('start_time').values_list('device_id', 'start_time'):
+        current[device_id] = start_time
+    
+    devices = list(Device.objects.filter(id__in=list(current)))
+    for device in devices:
+        device.current_session_start = current[device.id]
+    Device.objects.bulk_update(devices, ['current_session_start'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devices', '0004_deviceschedule_repeat_mask'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='current_session_start',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(fill_current_session_start, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,158 @@
+# Generated by Django 5.2.5 on 2026-10-17 11:30
+
+from datetime import datetime, time as dt_time, timedelta
+
+from django.db import migrations, models
+from django.db.models import Min, Q
+from django.utils import timezone
+
+# Bản sao logic tính rollup tại thời điểm tạo migration
+# (không import devices.usage / devices.tariff: code đó còn thay đổi)
+POWER_KW = {
+    'light': 0.01,
+    'led': 0.01,
+    'fan': 0.05,
+    'ac': 0.8,
+    'socket': 0.02,
+    'door': 0.005,
+    'dryer': 0.1,
+}
+DEFAULT_POWER_KW = 0.01
+# Giá điện sinh hoạt EVN (đ/kWh): (số kWh của bậc, giá)
+EVN_TIERS = ((50, 1984), (50, 2050), (100, 2380), (100, 2998), (100, 3350), (None, 3460))
+
+
+def tiered_cost(kwh):
+    cost = 0.0
+    remaining = max(kwh, 0.0)
+    for size, price in EVN_TIERS:
+        used = remaining if size is None else min(remaining, size)
+        cost += used * price
+        remaining -= used
+        if remaining <= 0:
+            break
+    return cost
+
+
+def split_hours(start, end):
+    """(date, hour, minutes) của [start, end) theo từng giờ địa phương"""
+    current = timezone.localtime(start)
+    end = timezone.localtime(end)
+    while current < end:
+        piece_end = min(current.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1), end)
+        yield current.date(), current.hour, (piece_end - current).total_seconds() / 60
+        current = piece_end
+
+
+def rollup_keys(device_id, device_type, room, day, hour):
+    for scope, scope_key in (('device', str(device_id)), ('room', room or ''), ('type', device_type or '')):
+        yield ('hour', scope, scope_key, day, hour)
+        yield ('day', scope, scope_key, day, 0)
+        yield ('month', scope, scope_key, day.replace(day=1), 0)
+
+
+def add(rows, key, turn_on, minutes, kwh):
+    values = rows.setdefault(key, [0, 0.0, 0.0])
+    values[0] += turn_on
+    values[1] += minutes
+    values[2] += kwh
+
+
+def fill_rollups(apps, schema_editor):
+    """Rollup cho session đã có, từng tháng một (bộ nhớ chỉ giữ 1 tháng)"""
+    DeviceUsageSession = apps.get_model('devices', 'DeviceUsageSession')
+    UsageRollup = apps.get_model('devices', 'UsageRollup')
+
+    first = DeviceUsageSession.objects.aggregate(first=Min('start_time'))['first']
+    if first is None:
+        return
+    month = timezone.localtime(first).date().replace(day=1)
+    while month <= timezone.localdate():
+        next_month = (month + timedelta(days=32)).replace(day=1)
+        start = timezone.make_aware(datetime.combine(month, dt_time.min))
+        end = timezone.make_aware(datetime.combine(next_month, dt_time.min))
+        sessions = DeviceUsageSession.objects.filter(
+            Q(start_time__gte=start, start_time__lt=end) | Q(start_time__lt=start, end_time__gt=start)
+        ).values_list('device_id', 'device__device_type', 'device__room', 'start_time', 'end_time')
+
+        # key -> [lần bật, phút, kWh]; session đang chạy chỉ tính lần bật
+        rows = {}
+        for device_id, device_type, room, start_time, end_time in sessions.iterator(chunk_size=2000):
+            if start_time >= start:
+                local = timezone.localtime(start_time)
+                for key in rollup_keys(device_id, device_type, room, local.date(), local.hour):
+                    add(rows, key, 1, 0.0, 0.0)
+            if end_time is None:
+                continue
+            power_kw = POWER_KW.get((device_type or '').lower(), DEFAULT_POWER_KW)
+            for day, hour, minutes in split_hours(max(start_time, start), min(end_time, end)):
+                for key in rollup_keys(device_id, device_type, room, day, hour):
+                    add(rows, key, 0, minutes, power_kw * minutes / 60)
+
+        # Giá bậc thang từng giờ theo điện năng cả nhà (tổng theo loại thiết bị) lũy kế trong tháng
+        household = {}
+        for (grain, scope, _, day, hour), values in rows.items():
+            if grain == 'hour' and scope == 'type':
+                household[(day, hour)] = household.get((day, hour), 0.0) + values[2]
+        prices, used = {}, 0.0
+        for key in sorted(household):
+            kwh = household[key]
+            prices[key] = (tiered_cost(used + kwh) - tiered_cost(used)) / kwh if kwh else 0.0
+            used += kwh
+
+        costs = {}
+        for (grain, scope, scope_key, day, hour), values in rows.items():
+            if grain == 'hour':
+                cost = values[2] * prices.get((day, hour), 0.0)
+                for key in (
+                    ('hour', scope, scope_key, day, hour),
+                    ('day', scope, scope_key, day, 0),
+                    ('month', scope, scope_key, month, 0),
+                ):
+                    costs[key] = costs.get(key, 0.0) + cost
+
+        UsageRollup.objects.bulk_create([
+            UsageRollup(
+                grain=key[0],
+                scope=key[1],
+                scope_key=key[2],
+                bucket_date=key[3],
+                hour=key[4],
+                turn_on_count=values[0],
+                usage_minutes=values[1],
+                power_consumption=values[2],
+                cost=costs.get(key, 0.0),
+            )
+            for key, values in rows.items()
+        ], batch_size=1000)
+        month = next_month
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devices', '0005_device_current_session_start'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('grain', models.CharField(choices=[('hour', 'Giờ'), ('day', 'Ngày'), ('month', 'Tháng')], max_length=5)),
+                ('scope', models.CharField(choices=[('device', 'Thiết bị'), ('room', 'Phòng'), ('type', 'Loại thiết bị')], max_length=6)),
+                ('scope_key', models.CharField(max_length=100)),
+                ('bucket_date', models.DateField()),
+                ('hour', models.PositiveSmallIntegerField(default=0)),
+                ('turn_on_count', models.IntegerField(default=0)),
+                ('usage_minutes', models.FloatField(default=0.0)),
+                ('power_consumption', models.FloatField(default=0.0)),
+                ('cost', models.FloatField(default=0.0)),
+            ],
+            options={
+                'db_table': 'device_usage_rollups',
+                'constraints': [models.UniqueConstraint(fields=('grain', 'scope', 'scope_key', 'bucket_date', 'hour'), name='usage_rollup_bucket_uniq')],
+            },
+        ),
+        migrations.RunPython(fill_rollups, migrations.RunPython.noop),
+    ]
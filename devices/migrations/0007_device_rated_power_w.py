@@ -0,0 +1,40 @@
+# Generated by Django 5.2.5 on 2026-10-17 12:30
+
+from django.db import migrations, models
+
+# Công suất mặc định (W) theo loại thiết bị tại thời điểm tạo migration
+RATED_POWER_W = {
+    'light': 10,
+    'led': 10,
+    'fan': 50,
+    'ac': 800,
+    'socket': 20,
+    'door': 5,
+    'dryer': 100,
+}
+DEFAULT_POWER_W = 10
+
+
+def fill_rated_power(apps, schema_editor):
+    Device = apps.get_model('devices', 'Device')
+
+    devices = list(Device.objects.filter(rated_power_w__isnull=True))
+    for device in devices:
+        device.rated_power_w = RATED_POWER_W.get((device.device_type or '').lower(), DEFAULT_POWER_W)
+    Device.objects.bulk_update(devices, ['rated_power_w'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devices', '0006_usagerollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='rated_power_w',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.RunPython(fill_rated_power, migrations.RunPython.noop),
+    ]
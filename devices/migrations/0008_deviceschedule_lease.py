@@ -0,0 +1,23 @@
+# Generated by Django 5.2.5 on 2026-10-17 13:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devices', '0007_device_rated_power_w'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deviceschedule',
+            name='claimed_by',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='deviceschedule',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.5 on 2026-10-17 13:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devices', '0008_deviceschedule_lease'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='deviceusagesession',
+            index=models.Index(fields=['device', 'start_time', 'id'], name='device_session_keyset_idx'),
+        ),
+    ]
@@ -33,6 +33,10 @@ class Device(models.Model):
     ip_address = models.GenericIPAddressField(blank=True, null=True)
     is_online = models.BooleanField(default=False)
     description = models.TextField(blank=True, null=True)
+    # Công suất định mức (W) dùng tính điện năng; None: mặc định theo loại (devices/tariff.py)
+    rated_power_w = models.FloatField(null=True, blank=True)
+    # Thời điểm bắt đầu session đang chạy (None = không có), cập nhật khi mở / đóng session
+    current_session_start = models.DateTimeField(null=True, blank=True, db_index=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -77,6 +81,62 @@ class DeviceUsageSession(models.Model):
     
     class Meta:
         db_table = 'device_usage_sessions'
+        indexes = [
+            # rebuild_statistics đọc session theo keyset (device_id, start_time, id)
+            models.Index(fields=['device', 'start_time', 'id'], name='device_session_keyset_idx'),
+        ]
+
+class UsageRollup(models.Model):
+    """
+    Thống kê sử dụng tổng hợp sẵn theo giờ / ngày / tháng, cho từng thiết bị, phòng, loại thiết bị.
+    Cộng dồn khi DeviceUsageSession kết thúc (devices/usage.py). Ngày giờ theo giờ địa phương.
+    """
+    GRAIN_CHOICES = (
+        ('hour', 'Giờ'),
+        ('day', 'Ngày'),
+        ('month', 'Tháng'),
+    )
+
+    SCOPE_CHOICES = (
+        ('device', 'Thiết bị'),
+        ('room', 'Phòng'),
+        ('type', 'Loại thiết bị'),
+    )
+
+    grain = models.CharField(max_length=5, choices=GRAIN_CHOICES)
+    scope = models.CharField(max_length=6, choices=SCOPE_CHOICES)
+    scope_key = models.CharField(max_length=100)  # device id / room / device_type
+    bucket_date = models.DateField()  # Ngày (tháng: ngày 1)
+    hour = models.PositiveSmallIntegerField(default=0)  # Chỉ dùng cho grain='hour'
+    turn_on_count = models.IntegerField(default=0)  # Số session bắt đầu trong bucket
+    usage_minutes = models.FloatField(default=0.0)
+    power_consumption = models.FloatField(default=0.0)
+    cost = models.FloatField(default=0.0)
+
+    class Meta:
+        db_table = 'device_usage_rollups'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['grain', 'scope', 'scope_key', 'bucket_date', 'hour'],
+                name='usage_rollup_bucket_uniq',
+            ),
+        ]
+
+class DeviceScene(models.Model):
+    """Ngữ cảnh: danh sách lệnh cho nhiều thiết bị, vd: [{'device_id': '...', 'action': 'off'}]"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='scenes')
+    name = models.CharField(max_length=100)
+    actions = models.JSONField(default=list)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'device_scenes'
+        ordering = ['name']
+
+    def __str__(self):
+        return self.name
 
 # devices/models.py - Cập nhật DeviceSchedule model
 class DeviceSchedule(models.Model):
@@ -99,59 +159,108 @@ class DeviceSchedule(models.Model):
     scheduled_date = models.DateField(null=True, blank=True)  # Ngày cụ thể (cho lịch một lần)
     repeat_type = models.CharField(max_length=10, choices=REPEAT_CHOICES, default='once')
     repeat_days = models.JSONField(default=list, blank=True)  # ['mon', 'tue', ...]
+    repeat_mask = models.PositiveSmallIntegerField(default=0)  # Bitmask từ repeat_days (bit 0 = thứ 2)
     is_active = models.BooleanField(default=True)
     is_executed = models.BooleanField(default=False)
+    next_run_at = models.DateTimeField(null=True, blank=True)  # Lần thực thi tiếp theo (tính khi save)
+    # Lease của worker đang thực thi lần hẹn hiện tại (devices/schedule_claim.py)
+    claimed_by = models.CharField(max_length=32, blank=True, default='')
+    claimed_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         db_table = 'device_schedules'
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['is_active', 'is_executed', 'next_run_at'], name='device_sched_due_idx'),
+        ]
 
     def __str__(self):
         return f"{self.device.name} -> {self.action} lúc {self.scheduled_time}"
 
     def get_next_scheduled_datetime(self):
         """Tính toán thời gian thực thi tiếp theo"""
-        from django.utils import timezone
-        import datetime
-        
-        now = timezone.now()
-        today = now.date()
-        current_time = now.time()
-        
-        # Tạo datetime từ scheduled_time
-        scheduled_datetime = datetime.datetime.combine(today, self.scheduled_time)
-        scheduled_datetime = timezone.make_aware(scheduled_datetime)
-        
+        return next_scheduled_datetime(self)
+
+    def mark_executed(self):
+        """
+        Sau khi thực thi (chưa lưu DB):
+        lịch một lần -> is_executed; lịch lặp lại -> giữ nguyên, save() tự chuyển next_run_at sang lần kế tiếp
+        """
         if self.repeat_type == 'once':
-            if self.scheduled_date:
-                once_datetime = datetime.datetime.combine(self.scheduled_date, self.scheduled_time)
-                once_datetime = timezone.make_aware(once_datetime)
-                return once_datetime if once_datetime > now else None
-            return scheduled_datetime if scheduled_datetime > now else None
-        
-        elif self.repeat_type == 'daily':
-            if scheduled_datetime > now:
-                return scheduled_datetime
-            else:
-                return scheduled_datetime + datetime.timedelta(days=1)
+            self.is_executed = True
+
+    def refresh_next_run_at(self):
+        """Tính lại repeat_mask và next_run_at (chưa lưu DB, dùng được với bulk_update)"""
+        # Biên dịch repeat_days thành bitmask để tính lịch lặp nhanh
+        self.repeat_mask = weekday_mask(self.repeat_days) if self.repeat_type == 'weekly' else 0
         
-        elif self.repeat_type == 'weekly' and self.repeat_days:
-            # Tìm ngày trong tuần tiếp theo
-            current_weekday = now.strftime('%a').lower()[:3]  # 'mon', 'tue', etc.
-            days = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
-            
-            # Tìm ngày gần nhất trong tuần
-            current_idx = days.index(current_weekday)
-            for i in range(7):
-                check_day = days[(current_idx + i) % 7]
-                if check_day in self.repeat_days:
-                    days_to_add = i
-                    next_date = today + datetime.timedelta(days=days_to_add)
-                    next_datetime = datetime.datetime.combine(next_date, self.scheduled_time)
-                    next_datetime = timezone.make_aware(next_datetime)
-                    if next_datetime > now:
-                        return next_datetime
+        # Luôn cập nhật next_run_at để scheduler chỉ cần lọc next_run_at <= now
+        if self.is_active and not self.is_executed:
+            self.next_run_at = self.get_next_scheduled_datetime()
+        else:
+            self.next_run_at = None
+
+    def save(self, *args, **kwargs):
+        self.refresh_next_run_at()
         
-        return None
\ No newline at end of file
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | {'next_run_at', 'repeat_mask'}
+        super().save(*args, **kwargs)
+
+
+WEEKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+ALL_WEEKDAYS_MASK = 0b1111111
+
+
+def weekday_mask(repeat_days):
+    """['mon', 'wed'] -> bitmask (bit 0 = thứ 2 ... bit 6 = chủ nhật)"""
+    mask = 0
+    for day in repeat_days or []:
+        day = str(day).lower()[:3]
+        if day in WEEKDAYS:
+            mask |= 1 << WEEKDAYS.index(day)
+    return mask
+
+
+def next_scheduled_datetime(schedule, now=None):
+    """
+    Tính thời gian thực thi tiếp theo (sau now) của 1 lịch hẹn theo giờ địa phương
+    Dùng cho DeviceSchedule.get_next_scheduled_datetime
+    """
+    from django.utils import timezone
+    import datetime
+    
+    now = timezone.localtime(now or timezone.now())
+    today = now.date()
+    
+    if schedule.repeat_type == 'once':
+        once_date = schedule.scheduled_date or today
+        once_datetime = timezone.make_aware(datetime.datetime.combine(once_date, schedule.scheduled_time))
+        return once_datetime if once_datetime > now else None
+    
+    if schedule.repeat_type == 'daily':
+        mask = ALL_WEEKDAYS_MASK
+    elif schedule.repeat_type == 'weekly':
+        mask = getattr(schedule, 'repeat_mask', 0) or weekday_mask(schedule.repeat_days)
+    else:
+        mask = 0
+    
+    if not mask:
+        return None
+    
+    # Xoay mask để bit 0 là hôm nay, bit i là i ngày sau
+    weekday = today.weekday()
+    rotated = ((mask >> weekday) | (mask << (7 - weekday))) & ALL_WEEKDAYS_MASK
+    
+    # Hôm nay đã qua giờ hẹn thì bỏ bit hôm nay (tuần sau = bit 7)
+    today_datetime = timezone.make_aware(datetime.datetime.combine(today, schedule.scheduled_time))
+    if today_datetime <= now:
+        rotated = (rotated & ~1) | ((rotated & 1) << 7)
+    
+    # Bit thấp nhất = số ngày đến lần thực thi kế tiếp
+    days_to_add = (rotated & -rotated).bit_length() - 1
+    next_date = today + datetime.timedelta(days=days_to_add)
+    return timezone.make_aware(datetime.datetime.combine(next_date, schedule.scheduled_time))
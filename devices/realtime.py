@@ -0,0 +1,230 @@
+# devices/realtime.py
+"""
+Gửi cập nhật realtime đến WebSocket (DeviceConsumer) qua channel layer
+
+Mỗi cập nhật chỉ gửi đến 1 group: room.<room> của phòng chứa thiết bị.
+Consumer tham gia group theo đăng ký của client ({"action": "subscribe", ...}):
+- rooms: group của các phòng đó
+- device_ids: group phòng của thiết bị, lọc lại theo device_id trước khi gửi cho client
+- home: group của mọi phòng (mặc định cho client cũ đến khi gửi subscribe / unsubscribe)
+
+Mỗi thay đổi trạng thái có số thứ tự seq tăng dần (Redis) và được lưu vào
+ring buffer REALTIME_RING_SIZE phần tử, để client kết nối lại gửi
+{"action": "resume", "last_seq": N} và chỉ nhận phần bị lỡ
+(quá cũ thì nhận snapshot đầy đủ).
+"""
+import logging
+import re
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import Device
+
+logger = logging.getLogger(__name__)
+
+SCHEDULE_EVENTS_GROUP = 'schedule_events'
+
+SEQ_KEY = 'rt:seq'
+EVENT_KEY = 'rt:event:{slot}'
+
+# Field luôn có trong delta của UpdateBroadcaster
+ALWAYS_SENT_FIELDS = ('id', 'is_on', 'status', 'updated_at')
+
+# Tên group của channels chỉ cho phép ASCII chữ/số, '-', '_', '.' và < 100 ký tự
+_GROUP_UNSAFE_CHARS = re.compile(r'[^0-9A-Za-z._-]')
+
+
+def _safe_group_name(prefix, value):
+    return f"{prefix}.{_GROUP_UNSAFE_CHARS.sub('_', str(value))}"[:99]
+
+
+def room_group(room):
+    """Group của 1 phòng"""
+    return _safe_group_name('room', room)
+
+
+def home_groups():
+    """Group của mọi phòng (đăng ký cả nhà)"""
+    return [room_group(room) for room, _ in Device.ROOM_CHOICES]
+
+
+def device_payload(device):
+    """Dữ liệu device gửi cho client"""
+    return {
+        'id': str(device.id),
+        'name': device.name,
+        'is_on': device.is_on,
+        'device_type': device.device_type,
+        'status': device.status,
+        'updated_at': device.updated_at.isoformat() if device.updated_at else timezone.now().isoformat(),
+    }
+
+
+def _group_send(message, group):
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return False
+    try:
+        async_to_sync(channel_layer.group_send)(group, message)
+        return True
+    except Exception as e:
+        logger.warning(f'WebSocket update failed: {e}')
+        return False
+
+
+def _ring_size():
+    return getattr(settings, 'REALTIME_RING_SIZE', 1000)
+
+
+def current_seq():
+    """Số thứ tự của thay đổi mới nhất"""
+    try:
+        return cache.get(SEQ_KEY) or 0
+    except Exception as e:
+        logger.warning(f'Realtime seq read failed: {e}')
+        return 0
+
+
+def record_event(updates):
+    """
+    Cấp seq mới và lưu thay đổi vào ring buffer
+    updates: list (room, update)
+    Returns: seq, hoặc None nếu cache lỗi
+    """
+    try:
+        cache.add(SEQ_KEY, 0, timeout=None)
+        seq = cache.incr(SEQ_KEY)
+        cache.set(EVENT_KEY.format(slot=seq % _ring_size()), {
+            'seq': seq,
+            'updates': [{'room': room, 'update': update} for room, update in updates],
+        }, timeout=getattr(settings, 'REALTIME_RING_TTL', 3600))
+        return seq
+    except Exception as e:
+        logger.warning(f'Realtime event record failed: {e}')
+        return None
+
+
+def events_since(last_seq):
+    """
+    Các thay đổi sau last_seq
+    Returns: (seq hiện tại, list event) hoặc (seq hiện tại, None) nếu phải gửi snapshot
+    """
+    seq = current_seq()
+    if last_seq == seq:
+        return seq, []
+    # last_seq > seq: Redis đã bị xóa - client phải lấy lại toàn bộ
+    if last_seq > seq or seq - last_seq > _ring_size():
+        return seq, None
+
+    size = _ring_size()
+    keys = {EVENT_KEY.format(slot=n % size): n for n in range(last_seq + 1, seq + 1)}
+    try:
+        stored = cache.get_many(list(keys))
+    except Exception as e:
+        logger.warning(f'Realtime ring read failed: {e}')
+        return seq, None
+
+    events = []
+    for key, n in keys.items():
+        event = stored.get(key)
+        # Thiếu / đã bị ghi đè (hoặc seq chưa kịp ghi) thì gửi snapshot
+        if event is None or event['seq'] != n:
+            return seq, None
+        events.append(event)
+    return seq, events
+
+
+class UpdateBroadcaster:
+    """
+    Gom cập nhật device (dùng cho vòng lặp sync / scheduler) rồi gửi 1 message mỗi phòng:
+    - Cùng device trong 1 lần gom chỉ giữ trạng thái mới nhất
+    - id / is_on / status / updated_at luôn gửi; field khác chỉ gửi khi thay đổi so với lần gửi
+      trước của process này (lần đầu gửi đủ). Process khác (API, Celery) cũng gửi trạng thái nên
+      không dùng lần gửi trước để bỏ is_on / status
+    - flush() không gửi lại trong REALTIME_BATCH_WINDOW giây trừ khi force=True
+    Client nhận: {"type": "device_batch", "updates": [{"id": ..., "is_on": ..., "status": ..., <field thay đổi>}]}
+    """
+
+    def __init__(self, window=None):
+        if window is None:
+            window = getattr(settings, 'REALTIME_BATCH_WINDOW', 0.5)
+        self.window = window
+        self._pending = {}  # device_id -> (payload, room)
+        self._last_sent = {}  # device_id -> payload đã gửi gần nhất
+        self._last_flush = 0.0
+
+    def add(self, device):
+        """Ghi nhận trạng thái mới (thay thế trạng thái chưa gửi trước đó của device)"""
+        self._pending[str(device.id)] = (device_payload(device), device.room)
+
+    def flush(self, force=False):
+        """Gửi các cập nhật đang gom. Returns: số device đã gửi"""
+        if not self._pending:
+            return 0
+        now = time.monotonic()
+        if not force and now - self._last_flush < self.window:
+            return 0
+        pending, self._pending = self._pending, {}
+        self._last_flush = now
+
+        changes = []
+        updates_by_room = {}
+        for device_id, (payload, room) in pending.items():
+            delta = self._delta(device_id, payload)
+            changes.append((room, delta))
+            updates_by_room.setdefault(room, []).append(delta)
+
+        # Cả batch dùng chung 1 seq
+        seq = record_event(changes)
+        for room, updates in updates_by_room.items():
+            _group_send({
+                'type': 'device_batch',
+                'seq': seq,
+                'room': room,
+                'updates': updates,
+            }, group=room_group(room))
+        return len(changes)
+
+    def _delta(self, device_id, payload):
+        previous = self._last_sent.get(device_id)
+        self._last_sent[device_id] = payload
+        if previous is None:
+            return payload
+
+        return {
+            key: value for key, value in payload.items()
+            if key in ALWAYS_SENT_FIELDS or previous.get(key) != value
+        }
+
+
+def send_command_result(command_id, device_id, status, device=None, message=''):
+    """Gửi kết quả lệnh điều khiển bất đồng bộ (confirmed / failed / superseded)"""
+    if device is not None:
+        room = device.room
+    else:
+        room = Device.objects.filter(id=device_id).values_list('room', flat=True).first()
+        if room is None:
+            return False
+    return _group_send({
+        'type': 'command_result',
+        'command_id': command_id,
+        'device_id': str(device_id),
+        'room': room,
+        'status': status,
+        'message': message,
+        'device': device_payload(device) if device is not None else None,
+    }, group=room_group(room))
+
+
+def send_schedule_changed(schedule_id, next_run_at):
+    """Báo cho start_scheduler (--engine=heap) biết lịch hẹn đã tạo / sửa / xóa"""
+    return _group_send({
+        'type': 'schedule.changed',
+        'schedule_id': str(schedule_id),
+        'next_run_at': next_run_at.isoformat() if next_run_at else None,
+    }, group=SCHEDULE_EVENTS_GROUP)
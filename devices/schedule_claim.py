@@ -0,0 +1,114 @@
+# devices/schedule_claim.py
+"""
+Nhận (claim) lịch hẹn đến hạn để nhiều start_scheduler / Celery worker chạy song song
+mà mỗi lần hẹn được thực thi đúng 1 lần:
+- claim_due: SELECT ... FOR UPDATE SKIP LOCKED rồi ghi lease (claimed_by, claimed_at);
+  worker khác bỏ qua lịch đang có lease còn hạn
+- complete: sau khi đã gửi lệnh và lưu kết quả mới đánh dấu đã chạy / chuyển next_run_at
+  sang lần kế tiếp và bỏ lease
+- Worker chết giữa chừng: lease hết hạn (SCHEDULE_LEASE_SECONDS), worker khác claim lại
+  và gửi lại lệnh (lệnh on/off gửi lại không đổi kết quả)
+"""
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import DeviceSchedule
+from . import realtime
+
+
+def lease_seconds():
+    """Thời hạn lease (giây): phải lớn hơn thời gian gửi lệnh + lưu kết quả của 1 batch"""
+    return getattr(settings, 'SCHEDULE_LEASE_SECONDS', 120)
+
+
+def unleased(now):
+    """Q: lịch chưa bị claim hoặc lease đã hết hạn"""
+    return Q(claimed_at__isnull=True) | Q(claimed_at__lt=now - timedelta(seconds=lease_seconds()))
+
+
+def claim_due(now=None, schedule_ids=None, limit=None):
+    """
+    Claim các lịch đã đến hạn (next_run_at <= now) bằng lease
+    schedule_ids: chỉ claim trong các id này (Celery task)
+    limit: số lịch tối đa mỗi lần claim
+    Returns: list DeviceSchedule (kèm device, user); scheduled_at = thời điểm hẹn của lần này
+    Caller phải gọi complete() sau khi thực thi
+    """
+    now = now or timezone.now()
+    claim_id = uuid.uuid4().hex
+
+    with transaction.atomic():
+        queryset = DeviceSchedule.objects.select_for_update(
+            skip_locked=True, of=('self',)
+        ).filter(
+            unleased(now),
+            is_active=True,
+            is_executed=False,
+            next_run_at__lte=now
+        ).select_related('device', 'user').order_by('next_run_at')
+        if schedule_ids is not None:
+            queryset = queryset.filter(id__in=schedule_ids)
+        if limit:
+            queryset = queryset[:limit]
+
+        schedules = list(queryset)
+        for schedule in schedules:
+            schedule.scheduled_at = schedule.next_run_at
+            schedule.claimed_by = claim_id
+            schedule.claimed_at = now
+        if schedules:
+            DeviceSchedule.objects.bulk_update(schedules, ['claimed_by', 'claimed_at'])
+    return schedules
+
+
+def complete(schedules, now=None):
+    """
+    Lần hẹn đã thực thi (hoặc bị bỏ qua): lịch một lần -> is_executed,
+    lịch lặp lại -> next_run_at lần kế tiếp; bỏ lease
+    Lịch đã bị worker khác claim lại (lease hết hạn) thì không đổi.
+    Lịch bị sửa trong lúc chạy (next_run_at khác lần đã claim) chỉ bỏ lease.
+    Gọi trong transaction lưu kết quả để lưu kết quả + hoàn tất là 1 bước.
+    """
+    if not schedules:
+        return []
+    now = now or timezone.now()
+    claims = {schedule.id: schedule for schedule in schedules}
+
+    with transaction.atomic():
+        current = {
+            schedule.id: schedule
+            for schedule in DeviceSchedule.objects.select_for_update().filter(id__in=list(claims))
+        }
+        completed = []
+        for schedule_id, claimed in claims.items():
+            schedule = current.get(schedule_id)
+            if schedule is None or schedule.claimed_by != claimed.claimed_by:
+                continue
+            if schedule.next_run_at == claimed.scheduled_at:
+                schedule.mark_executed()
+                # bulk_update không gọi save() nên tự tính lại next_run_at
+                schedule.refresh_next_run_at()
+            schedule.claimed_by = ''
+            schedule.claimed_at = None
+            schedule.updated_at = now
+            completed.append(schedule)
+            # Trả next_run_at mới cho caller (heap engine)
+            claimed.is_executed = schedule.is_executed
+            claimed.next_run_at = schedule.next_run_at
+        if completed:
+            DeviceSchedule.objects.bulk_update(
+                completed,
+                ['is_executed', 'repeat_mask', 'next_run_at', 'claimed_by', 'claimed_at', 'updated_at']
+            )
+
+    # bulk_update không gửi signal: báo next_run_at mới cho các scheduler khác (heap engine)
+    def notify():
+        for schedule in completed:
+            realtime.send_schedule_changed(schedule.id, schedule.next_run_at)
+    transaction.on_commit(notify)
+    return completed
@@ -0,0 +1,43 @@
+# devices/signals.py
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Device, DeviceSchedule, DeviceStatistics, DeviceUsageSession
+from . import device_cache, realtime, stats_cache
+
+
+@receiver(post_save, sender=Device)
+@receiver(post_delete, sender=Device)
+def device_changed(sender, instance, **kwargs):
+    """Thiết bị thay đổi: làm mới snapshot của DeviceListView"""
+    device_cache.invalidate()
+
+
+@receiver(post_save, sender=DeviceStatistics)
+@receiver(post_save, sender=DeviceUsageSession)
+@receiver(post_delete, sender=DeviceUsageSession)
+def statistics_changed(sender, instance, **kwargs):
+    """Thống kê / session thay đổi: cache thống kê của các ngày đó phải tính lại"""
+    if sender is DeviceStatistics:
+        stats_cache.invalidate(instance.date)
+    else:
+        stats_cache.invalidate(
+            timezone.localdate(instance.start_time),
+            timezone.localdate(instance.end_time) if instance.end_time else None,
+        )
+
+
+@receiver(post_save, sender=DeviceSchedule)
+def schedule_saved(sender, instance, **kwargs):
+    """Lịch hẹn được tạo / sửa: gửi next_run_at mới cho scheduler"""
+    schedule_id, next_run_at = instance.id, instance.next_run_at
+    transaction.on_commit(lambda: realtime.send_schedule_changed(schedule_id, next_run_at))
+
+
+@receiver(post_delete, sender=DeviceSchedule)
+def schedule_deleted(sender, instance, **kwargs):
+    """Lịch hẹn bị xóa: scheduler bỏ khỏi heap"""
+    schedule_id = instance.id
+    transaction.on_commit(lambda: realtime.send_schedule_changed(schedule_id, None))
@@ -0,0 +1,151 @@
+# devices/stats_cache.py
+"""
+Cache kết quả thống kê theo endpoint + period + khoảng ngày:
+- Khoảng có hôm nay: key kèm generation "today", tăng mỗi khi thống kê hôm nay thay đổi;
+  hết hạn sau STATS_CACHE_TODAY_TTL
+- Ngày đã qua: mỗi tháng có 1 generation, key kèm tổng generation các tháng trong khoảng.
+  Sửa dữ liệu cũ (session qua nửa đêm, rebuild_statistics) chỉ tăng generation của tháng bị sửa;
+  hết hạn sau STATS_CACHE_HISTORY_TTL nên key cũ (bị thay bằng generation mới, hay khoảng
+  (đầu tháng, hôm qua) đổi mỗi ngày) không nằm mãi trong Redis
+Đếm hit / miss theo endpoint (ENDPOINTS) trong Redis (counters()).
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+TODAY_GENERATION_KEY = 'stats:generation:today'
+MONTH_GENERATION_KEY = 'stats:generation:month:{month}'
+RESULT_KEY = 'stats:result:{endpoint}:{period}:{start}:{end}:h{history}:t{today}'
+COUNTER_KEY = 'stats:counter:{endpoint}:{kind}'
+
+# Endpoint dùng get_or_compute (counters() đọc bộ đếm của các endpoint này)
+ENDPOINTS = ('real_statistics', 'overall_rollups')
+
+
+def _months(start_date, end_date):
+    """Ngày đầu các tháng giao với [start_date, end_date]"""
+    month = start_date.replace(day=1)
+    while month <= end_date:
+        yield month
+        month = (month + timedelta(days=32)).replace(day=1)
+
+
+def _history_keys(start_date, end_date, today):
+    """Key generation của các tháng chứa ngày đã qua trong [start_date, end_date]"""
+    if start_date >= today:
+        return []
+    return [
+        MONTH_GENERATION_KEY.format(month=month.strftime('%Y-%m'))
+        for month in _months(start_date, min(end_date, today - timedelta(days=1)))
+    ]
+
+
+def _bump(keys):
+    try:
+        for key in keys:
+            cache.add(key, 0, timeout=None)
+            cache.incr(key)
+    except Exception as e:
+        logger.warning(f'Statistics cache invalidate failed: {e}')
+
+
+def invalidate(start_date=None, end_date=None):
+    """
+    Thống kê các ngày [start_date, end_date] đã thay đổi (chạy sau khi transaction commit)
+    Mặc định: chỉ hôm nay
+    """
+    today = timezone.localdate()
+    start_date = start_date or today
+    end_date = end_date or start_date
+
+    keys = _history_keys(start_date, end_date, today)
+    if end_date >= today:
+        keys.append(TODAY_GENERATION_KEY)
+    transaction.on_commit(lambda: _bump(keys))
+
+
+def _count(endpoint, kind):
+    try:
+        key = COUNTER_KEY.format(endpoint=endpoint, kind=kind)
+        cache.add(key, 0, timeout=None)
+        cache.incr(key)
+    except Exception:
+        pass
+
+
+def get_or_compute(endpoint, period, start_date, end_date, compute):
+    """
+    Lấy kết quả từ cache, chưa có thì compute() rồi lưu lại
+    endpoint: 1 trong ENDPOINTS
+    compute: hàm không tham số, trả về dữ liệu pickle được (dict / list)
+    """
+    if endpoint not in ENDPOINTS:
+        raise ValueError(f'Unknown statistics cache endpoint: {endpoint}')
+    today = timezone.localdate()
+    includes_today = end_date >= today
+    month_keys = _history_keys(start_date, end_date, today)
+    try:
+        generations = cache.get_many(month_keys + [TODAY_GENERATION_KEY])
+    except Exception as e:
+        logger.warning(f'Statistics cache read failed: {e}')
+        return compute()
+
+    key = RESULT_KEY.format(
+        endpoint=endpoint,
+        period=period,
+        start=start_date.isoformat(),
+        end=end_date.isoformat(),
+        # Generation chỉ tăng nên tổng đổi mỗi khi 1 tháng trong khoảng bị sửa
+        history=sum(generations.get(key, 0) for key in month_keys),
+        today=generations.get(TODAY_GENERATION_KEY, 0) if includes_today else '-',
+    )
+    try:
+        value = cache.get(key)
+    except Exception:
+        value = None
+    if value is not None:
+        _count(endpoint, 'hits')
+        return value
+
+    _count(endpoint, 'misses')
+    value = compute()
+    try:
+        if includes_today:
+            timeout = getattr(settings, 'STATS_CACHE_TODAY_TTL', 300)
+        else:
+            timeout = getattr(settings, 'STATS_CACHE_HISTORY_TTL', 7 * 24 * 3600)
+        cache.set(key, value, timeout=timeout)
+    except Exception as e:
+        logger.warning(f'Statistics cache write failed: {e}')
+    return value
+
+
+def counters():
+    """Số hit / miss theo endpoint: {endpoint: {'hits', 'misses', 'hit_rate'}}"""
+    try:
+        values = cache.get_many([
+            COUNTER_KEY.format(endpoint=endpoint, kind=kind)
+            for endpoint in ENDPOINTS
+            for kind in ('hits', 'misses')
+        ])
+    except Exception as e:
+        logger.warning(f'Statistics cache counters failed: {e}')
+        return {}
+
+    result = {}
+    for endpoint in ENDPOINTS:
+        hits = values.get(COUNTER_KEY.format(endpoint=endpoint, kind='hits'), 0)
+        misses = values.get(COUNTER_KEY.format(endpoint=endpoint, kind='misses'), 0)
+        total = hits + misses
+        result[endpoint] = {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / total, 3) if total else 0.0,
+        }
+    return result
@@ -0,0 +1,73 @@
+# devices/tariff.py
+"""
+Công suất thiết bị và giá điện sinh hoạt bậc thang EVN (tính theo tổng điện năng cả nhà trong tháng):
+- Công suất: Device.rated_power_w, chưa đặt thì dùng mặc định theo loại thiết bị
+- Tiền của 1 phần điện năng = tiền bậc thang của tổng tháng sau phần đó - trước phần đó
+"""
+from itertools import accumulate
+
+# Công suất định mức mặc định theo loại thiết bị (W)
+DEFAULT_RATED_POWER_W = {
+    'light': 10,
+    'led': 10,
+    'fan': 50,
+    'ac': 800,
+    'socket': 20,
+    'door': 5,
+    'dryer': 100,
+}
+DEFAULT_POWER_W = 10
+
+# Giá điện sinh hoạt EVN (đ/kWh): (số kWh của bậc, giá), bậc cuối không giới hạn
+EVN_TIERS = (
+    (50, 1984),     # Bậc 1: 0 - 50 kWh
+    (50, 2050),     # Bậc 2: 51 - 100 kWh
+    (100, 2380),    # Bậc 3: 101 - 200 kWh
+    (100, 2998),    # Bậc 4: 201 - 300 kWh
+    (100, 3350),    # Bậc 5: 301 - 400 kWh
+    (None, 3460),   # Bậc 6: từ 401 kWh
+)
+
+
+def default_power_w(device_type):
+    """Công suất mặc định (W) theo loại thiết bị"""
+    return DEFAULT_RATED_POWER_W.get((device_type or '').lower(), DEFAULT_POWER_W)
+
+
+def power_kw(device_type, rated_power_w=None):
+    """Công suất (kW) của thiết bị: rated_power_w nếu có, không thì mặc định theo loại"""
+    if rated_power_w is None:
+        rated_power_w = default_power_w(device_type)
+    return rated_power_w / 1000
+
+
+def tiered_cost(kwh):
+    """Tiền điện (đ) của kwh điện năng trong 1 tháng theo bậc thang"""
+    cost = 0.0
+    remaining = max(kwh, 0.0)
+    for size, price in EVN_TIERS:
+        used = remaining if size is None else min(remaining, size)
+        cost += used * price
+        remaining -= used
+        if remaining <= 0:
+            break
+    return cost
+
+
+def marginal_price(month_to_date):
+    """Giá (đ/kWh) của kWh tiếp theo khi tháng đã dùng month_to_date kWh"""
+    used = 0
+    for size, price in EVN_TIERS:
+        if size is None or month_to_date < used + size:
+            return price
+        used += size
+
+
+def marginal_costs(kwh_values, month_to_date=0.0):
+    """
+    Tiền điện của từng phần điện năng (theo thứ tự) trong cùng 1 tháng, 1 lượt duyệt:
+    phần thứ i tính theo bậc của tổng tháng đã dùng trước nó
+    """
+    totals = list(accumulate(kwh_values, initial=month_to_date))
+    costs = [tiered_cost(total) for total in totals]
+    return [after - before for before, after in zip(costs, costs[1:])]
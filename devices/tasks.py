@@ -1,7 +1,10 @@
 # devices/tasks.py
 from celery import shared_task
+from celery.exceptions import Retry
+from django.db import transaction
 from django.utils import timezone
-from .models import DeviceSchedule, DeviceLog
+from .models import Device, DeviceSchedule, DeviceLog
+from . import command_queue, control, esp_client, realtime, schedule_claim
 import logging
 
 logger = logging.getLogger(__name__)
@@ -13,13 +16,16 @@ def check_pending_schedules(self):
     logger.info("=== CHECKING PENDING SCHEDULES ===")
     
     now = timezone.now()
+    # Bỏ lịch đang được worker khác thực thi (lease còn hạn)
     pending_schedules = DeviceSchedule.objects.filter(
+        schedule_claim.unleased(now),
         is_active=True,
         is_executed=False,
-        scheduled_time__lte=now
-    )
+        next_run_at__lte=now
+    ).select_related('device')
     
-    logger.info(f"Found {pending_schedules.count()} pending schedules")
+    pending_schedules = list(pending_schedules)
+    logger.info(f"Found {len(pending_schedules)} pending schedules")
     
     for schedule in pending_schedules:
         logger.info(f"Executing: {schedule.device.name} -> {schedule.action}")
@@ -33,39 +39,114 @@ def execute_scheduled_task(self, schedule_id):
     try:
         logger.info(f"=== EXECUTING SCHEDULE: {schedule_id} ===")
         
-        schedule = DeviceSchedule.objects.get(
-            id=schedule_id, 
-            is_active=True, 
-            is_executed=False
-        )
+        # Claim lịch (lease + SKIP LOCKED): beat/worker khác đã lấy thì bỏ qua
+        claimed = schedule_claim.claim_due(schedule_ids=[schedule_id])
+        if not claimed:
+            logger.info(f"Schedule {schedule_id} already claimed or not due")
+            return
+        schedule = claimed[0]
         
         device = schedule.device
         logger.info(f"Device before: {device.name} - is_on: {device.is_on}")
         
-        # Thực hiện hành động
-        if schedule.action == 'on':
-            device.is_on = True
-        elif schedule.action == 'off':
-            device.is_on = False
+        # Gửi lệnh đến ESP8266 qua HTTP client dùng chung
+        # Lỗi: không đổi trạng thái / ghi log, lịch giữ lease và được chạy lại khi lease hết hạn
+        if not esp_client.send_command(device, schedule.action):
+            logger.warning(f"Failed to send command to ESP8266 for {device.name} - schedule {schedule_id} will retry")
+            return
         
-        device.save()
-        schedule.is_executed = True
-        schedule.save()
+        # Lưu kết quả + hoàn tất lịch cùng 1 transaction
+        # (lỗi trước khi commit: lịch giữ lease, hết hạn thì được chạy lại)
+        with transaction.atomic():
+            # Đọc lại device: trạng thái có thể đã đổi trong lúc gửi lệnh
+            device = Device.objects.select_for_update().get(id=device.id)
+            old_is_on = device.is_on
+            
+            # Thực hiện hành động
+            if schedule.action == 'on':
+                device.is_on = True
+            elif schedule.action == 'off':
+                device.is_on = False
+            
+            # Mở / đóng session (device.save() lưu current_session_start)
+            control.bulk_update_statistics([(device, old_is_on, device.is_on)])
+            device.save()
+            
+            # Ghi log
+            DeviceLog.objects.create(
+                device=device,
+                action=f'scheduled_{schedule.action}',
+                old_status={'is_on': old_is_on},
+                new_status={'is_on': device.is_on},
+                user=schedule.user
+            )
+            
+            schedule_claim.complete([schedule])
         
         logger.info(f"Device after: {device.name} - is_on: {device.is_on}")
         
-        # Ghi log
-        DeviceLog.objects.create(
-            device=device,
-            action=f'scheduled_{schedule.action}',
-            old_status={},
-            new_status={'is_on': device.is_on},
-            user=schedule.user
-        )
-        
         logger.info(f"Schedule {schedule_id} executed successfully")
         
         # Không return gì cả
         
     except Exception as e:
-        logger.error(f"Error executing schedule {schedule_id}: {str(e)}")
\ No newline at end of file
+        logger.error(f"Error executing schedule {schedule_id}: {str(e)}")
+
+@shared_task(bind=True, ignore_result=True, max_retries=None)
+def execute_device_command(self, command_id, device_id, action, data, user_id, django_action=None):
+    """
+    Thực thi lệnh điều khiển từ DeviceControlView (chế độ async)
+    - Lệnh đã bị lệnh mới hơn thay thế thì bỏ qua (superseded)
+    - Board đang nhận lệnh khác thì chờ (retry) để gửi tuần tự
+    Kết quả (confirmed / failed / superseded) gửi qua WebSocket group phòng của thiết bị
+    """
+    from users.models import User
+    
+    if not command_queue.is_latest(device_id, command_id):
+        logger.info(f"Command {command_id} superseded")
+        realtime.send_command_result(command_id, device_id, 'superseded', message='Đã có lệnh mới hơn')
+        return
+    
+    device = None
+    board_ip = None
+    try:
+        device = Device.objects.get(id=device_id)
+        
+        if not command_queue.acquire_board(device.ip_address, command_id):
+            # Board đang bận - thử lại sau
+            raise self.retry(countdown=command_queue.LOCK_POLL_SECONDS * 4)
+        board_ip = device.ip_address
+        
+        # Kiểm tra lại sau khi chờ board
+        if not command_queue.is_latest(device_id, command_id):
+            logger.info(f"Command {command_id} superseded")
+            realtime.send_command_result(command_id, device_id, 'superseded', message='Đã có lệnh mới hơn')
+            return
+        
+        logger.info(f"=== EXECUTING COMMAND {command_id}: {device_id} -> {action} ===")
+        
+        # Trạng thái có thể đã đổi bởi lệnh trước đó
+        device.refresh_from_db()
+        user = User.objects.get(id=user_id)
+        
+        success = control.execute_control(device, action, data, user, django_action)
+        message = (
+            f'Đã {"bật" if device.is_on else "tắt"} {device.name}'
+            if success else 'Không thể kết nối với thiết bị'
+        )
+        realtime.send_command_result(
+            command_id, device_id, 'confirmed' if success else 'failed',
+            device=device, message=message,
+        )
+        
+        logger.info(f"Command {command_id} {'confirmed' if success else 'failed'}")
+        
+    except Retry:
+        raise
+    except Exception as e:
+        logger.error(f"Error executing command {command_id}: {str(e)}")
+        realtime.send_command_result(command_id, device_id, 'failed', device=device, message=f'Lỗi: {str(e)}')
+    finally:
+        if board_ip:
+            command_queue.release_board(board_ip, command_id)
+            command_queue.finish(device_id, command_id)
@@ -1,3 +1,947 @@
-from django.test import TestCase
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+from types import SimpleNamespace
+import json
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import (
+    Device, DeviceLog, DeviceSchedule, DeviceStatistics, DeviceUsageSession, UsageRollup,
+    next_scheduled_datetime, weekday_mask,
+)
+from . import (
+    command_queue, consumers, control, esp_client, realtime, schedule_claim, stats_cache, tariff, usage,
+)
+from .consumers import DICTIONARY_FIELDS, SHORT_KEYS, DeviceConsumer
+from .management.commands.sync_device_status import Command as SyncDeviceStatusCommand, PollScheduler
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+class FakeRedis:
+    """Redis tối thiểu cho command_queue: GET, SET NX, pipeline, script so sánh + xóa (bỏ qua TTL)"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = str(value)
+        return True
+
+    def pipeline(self):
+        return self
+
+    def execute(self):
+        return []
+
+    def register_script(self, script):
+        assert script == command_queue.COMPARE_AND_DELETE_SCRIPT
+
+        def compare_and_delete(keys, args):
+            if self.data.get(keys[0]) != str(args[0]):
+                return 0
+            return sum(self.data.pop(key, None) is not None for key in keys)
+        return compare_and_delete
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class RealStatisticsViewQueryTests(TestCase):
+    """RealStatisticsView: số query không tăng theo số thiết bị"""
+
+    def setUp(self):
+        cache.clear()
+
+    def _create_devices(self, count, start=0):
+        now = timezone.now()
+        today = timezone.localtime(now).date()
+        for index in range(start, start + count):
+            device = Device.objects.create(
+                id=f'device-{index}',
+                name=f'Đèn {index}',
+                device_type='light',
+                room='bedroom',
+            )
+            DeviceStatistics.objects.create(
+                device=device,
+                date=today,
+                turn_on_count=2,
+                total_usage_minutes=90,
+                power_consumption=0.5,
+                cost=1500,
+            )
+            # 6 sessions đã kết thúc hôm nay - API chỉ trả 5 session gần nhất
+            for offset in range(6):
+                start_time = now - timedelta(seconds=offset + 2)
+                DeviceUsageSession.objects.create(
+                    device=device,
+                    start_time=start_time,
+                    end_time=start_time + timedelta(seconds=1),
+                    duration_minutes=30,
+                )
+
+    def test_query_count_constant_as_devices_grow(self):
+        url = reverse('real_statistics')
+
+        self._create_devices(2)
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        self.assertEqual(len(response.json()['statistics']), 2)
+
+        self._create_devices(20, start=2)
+        cache.clear()
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        self.assertEqual(len(response.json()['statistics']), 22)
+
+    def test_aggregates_and_latest_sessions(self):
+        self._create_devices(1)
+
+        response = self.client.get(reverse('real_statistics'), {'period': 'today'})
+
+        data = response.json()
+        self.assertTrue(data['success'])
+        stats = data['statistics'][0]
+        self.assertEqual(stats['device_id'], 'device-0')
+        self.assertEqual(stats['turn_on_count'], 2)
+        self.assertEqual(stats['total_usage_hours'], 1.5)
+        self.assertEqual(stats['power_consumption'], 0.5)
+        self.assertEqual(stats['cost'], 1500)
+        self.assertEqual(len(stats['usage_data']), 5)
+        self.assertEqual(stats['usage_data'][0]['duration'], 0.5)
+
+    def test_cached_result_served_without_queries(self):
+        self._create_devices(3)
+        url = reverse('real_statistics')
+
+        first = self.client.get(url, {'period': 'week'}).json()
+        with self.assertNumQueries(0):
+            second = self.client.get(url, {'period': 'week'}).json()
+
+        self.assertEqual(first['statistics'], second['statistics'])
+        counters = stats_cache.counters()['real_statistics']
+        self.assertEqual(counters['hits'], 1)
+        self.assertEqual(counters['misses'], 1)
+
+
+class UsageSplitTests(SimpleTestCase):
+    """usage: session qua nửa đêm được chia đúng ngày, không tính tiền lũy kế"""
+
+    def test_session_across_midnight_split_per_day(self):
+        tz = timezone.get_current_timezone()
+        start = timezone.make_aware(datetime(2026, 10, 16, 23, 30, 20), tz)
+        end = timezone.make_aware(datetime(2026, 10, 17, 1, 15, 50), tz)
+        household, daily, rollups = {}, {}, {}
+        usage.add_household_kwh(household, start, end, tariff.power_kw('fan'))
+
+        usage.accumulate_session(
+            daily, rollups, 'fan-1', 'fan', 'bedroom', start, end, usage.hourly_prices(household)
+        )
+
+        first = daily[('fan-1', start.date())]
+        second = daily[('fan-1', end.date())]
+        self.assertEqual(first[0], 1)
+        self.assertEqual(second[0], 0)
+        # Tổng phút nguyên bằng duration_minutes của session
+        self.assertEqual(first[1] + second[1], int((end - start).total_seconds() / 60))
+        self.assertEqual(first[1], 29)
+        self.assertAlmostEqual(first[2] + second[2], 0.05 * (end - start).total_seconds() / 3600)
+        self.assertAlmostEqual(first[3] + second[3], tariff.tiered_cost(first[2] + second[2]))
+        self.assertEqual(rollups[('hour', 'device', 'fan-1', end.date(), 0)][1], 60)
+
+    def test_open_session_counts_turn_on_only(self):
+        start = timezone.now()
+        daily, rollups = {}, {}
+
+        usage.accumulate_session(daily, rollups, 'light-1', 'light', 'bedroom', start, None)
+
+        self.assertEqual(list(daily.values()), [[1, 0, 0.0, 0.0]])
+
+
+
+class UpsertIncrementSqlTests(SimpleTestCase):
+    """upsert_increment trên MySQL: row alias từ 8.0.19, MariaDB vẫn dùng VALUES()"""
+
+    def _sql(self, **connection_attrs):
+        connection = mock.MagicMock(vendor='mysql', **connection_attrs)
+        connection.ops.quote_name = lambda name: f'`{name}`'
+        usage.upsert_increment(
+            UsageRollup, usage.ROLLUP_KEY_FIELDS, usage.ROLLUP_VALUE_FIELDS,
+            [('hour', 'device', 'light-1', date(2026, 10, 17), 7, 1, 30, 0.005, 8.0)],
+            connection=connection,
+        )
+        cursor = connection.cursor.return_value.__enter__.return_value
+        return cursor.execute.call_args.args[0]
+
+    def test_mysql_uses_row_alias(self):
+        sql = self._sql(mysql_is_mariadb=False, mysql_version=(8, 0, 36))
+        self.assertIn(') AS new ON DUPLICATE KEY UPDATE', sql)
+        self.assertIn('`cost` = `cost` + new.`cost`', sql)
+        self.assertNotIn('VALUES(', sql)
+
+    def test_mariadb_keeps_values_function(self):
+        sql = self._sql(mysql_is_mariadb=True, mysql_version=(10, 11, 6))
+        self.assertIn('`cost` = `cost` + VALUES(`cost`)', sql)
+        self.assertNotIn(' AS new', sql)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class RebuildStatisticsCommandTests(TestCase):
+    """rebuild_statistics: thống kê tính lại từ session, bỏ số liệu sai cũ"""
+
+    def test_rebuild_replaces_wrong_statistics(self):
+        tz = timezone.get_current_timezone()
+        device = Device.objects.create(id='fan-1', name='Quạt', device_type='fan', room='bedroom')
+        start = timezone.make_aware(datetime(2026, 10, 1, 23, 0), tz)
+        DeviceUsageSession.objects.create(
+            device=device, start_time=start, end_time=start + timedelta(hours=2), duration_minutes=120
+        )
+        # Số liệu sai (tiền lũy kế) và ngày không còn session
+        DeviceStatistics.objects.create(device=device, date=start.date(), turn_on_count=5, cost=99999)
+        DeviceStatistics.objects.create(device=device, date=start.date() + timedelta(days=3), turn_on_count=1)
+
+        call_command('rebuild_statistics', '--from', '2026-10-01', '--to', '2026-10-05', stdout=StringIO())
+
+        rows = {
+            row.date: row for row in DeviceStatistics.objects.filter(device=device).order_by('date')
+        }
+        self.assertEqual(sorted(rows), [start.date(), start.date() + timedelta(days=1)])
+        first, second = rows[start.date()], rows[start.date() + timedelta(days=1)]
+        self.assertEqual((first.turn_on_count, first.total_usage_minutes), (1, 60))
+        self.assertEqual((second.turn_on_count, second.total_usage_minutes), (0, 60))
+        self.assertAlmostEqual(first.cost, 0.05 * 1984)
+
+        month = UsageRollup.objects.get(grain='month', scope='device', scope_key='fan-1')
+        self.assertAlmostEqual(month.usage_minutes, 120)
+        self.assertEqual(month.turn_on_count, 1)
+
+    def test_device_rebuild_prices_with_whole_household_in_one_pass(self):
+        tz = timezone.get_current_timezone()
+        ac = Device.objects.create(id='ac-1', name='Điều hòa', device_type='ac', room='bedroom')
+        fan = Device.objects.create(id='fan-1', name='Quạt', device_type='fan', room='bedroom')
+        # Điều hòa 800W x 70 giờ = 56 kWh: giờ sau đó của cả nhà đã sang bậc 2
+        ac_start = timezone.make_aware(datetime(2026, 10, 1, 0, 0), tz)
+        DeviceUsageSession.objects.create(
+            device=ac, start_time=ac_start, end_time=ac_start + timedelta(hours=70), duration_minutes=4200
+        )
+        fan_start = timezone.make_aware(datetime(2026, 10, 3, 23, 0), tz)
+        DeviceUsageSession.objects.create(
+            device=fan, start_time=fan_start, end_time=fan_start + timedelta(hours=1), duration_minutes=60
+        )
+
+        from devices.management.commands.rebuild_statistics import Command
+        with mock.patch.object(Command, '_stream_sessions', autospec=True,
+                               side_effect=Command._stream_sessions) as stream:
+            call_command(
+                'rebuild_statistics', '--from', '2026-10-01', '--to', '2026-10-03',
+                '--device', 'fan-1', stdout=StringIO()
+            )
+
+        self.assertEqual(stream.call_count, 1)
+        self.assertFalse(DeviceStatistics.objects.filter(device=ac).exists())
+        row = DeviceStatistics.objects.get(device=fan, date=fan_start.date())
+        self.assertAlmostEqual(row.cost, 0.05 * tariff.EVN_TIERS[1][1])
+
+    def test_rebuild_commits_one_month_at_a_time(self):
+        tz = timezone.get_current_timezone()
+        device = Device.objects.create(id='fan-1', name='Quạt', device_type='fan', room='bedroom')
+        # Session qua đầu tháng: mỗi tháng 1 giờ
+        start = timezone.make_aware(datetime(2026, 9, 30, 23, 0), tz)
+        DeviceUsageSession.objects.create(
+            device=device, start_time=start, end_time=start + timedelta(hours=2), duration_minutes=120
+        )
+
+        from devices.management.commands.rebuild_statistics import Command
+        out = StringIO()
+        with mock.patch.object(Command, '_stream_sessions', autospec=True,
+                               side_effect=Command._stream_sessions) as stream:
+            call_command('rebuild_statistics', '--from', '2026-09-15', '--to', '2026-10-05', stdout=out)
+
+        self.assertEqual(stream.call_count, 2)
+        self.assertIn('from 1 session(s)', out.getvalue())
+        months = {
+            row.bucket_date: row
+            for row in UsageRollup.objects.filter(grain='month', scope='device', scope_key='fan-1')
+        }
+        self.assertEqual(sorted(months), [date(2026, 9, 1), date(2026, 10, 1)])
+        self.assertAlmostEqual(months[date(2026, 9, 1)].usage_minutes, 60)
+        self.assertEqual(months[date(2026, 9, 1)].turn_on_count, 1)
+        self.assertAlmostEqual(months[date(2026, 10, 1)].usage_minutes, 60)
+        self.assertEqual(months[date(2026, 10, 1)].turn_on_count, 0)
+        # Giờ thuộc tháng sau được tính giá trong khoảng của tháng đó
+        row = DeviceStatistics.objects.get(device=device, date=date(2026, 10, 1))
+        self.assertAlmostEqual(row.cost, 0.05 * tariff.EVN_TIERS[0][1])
+
+
+class TariffTests(SimpleTestCase):
+    """tariff: giá điện bậc thang EVN theo tổng điện năng tháng"""
+
+    def test_tiered_cost(self):
+        self.assertEqual(tariff.tiered_cost(0), 0)
+        self.assertAlmostEqual(tariff.tiered_cost(120), 50 * 1984 + 50 * 2050 + 20 * 2380)
+        self.assertAlmostEqual(tariff.tiered_cost(450) - tariff.tiered_cost(400), 50 * 3460)
+
+    def test_marginal_costs_follow_month_to_date(self):
+        costs = tariff.marginal_costs([30, 40], month_to_date=20)
+
+        self.assertAlmostEqual(costs[0], 30 * 1984)
+        self.assertAlmostEqual(costs[1], 40 * 2050)
+        self.assertEqual(tariff.marginal_price(100), 2380)
+
+    def test_rated_power_overrides_type_default(self):
+        self.assertEqual(tariff.power_kw('ac'), 0.8)
+        self.assertEqual(tariff.power_kw('ac', 1200), 1.2)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class DeviceStatusPushViewTests(TestCase):
+    """Push trạng thái từ ESP8266: bắt buộc token, board xác định theo IP gửi request"""
+
+    def setUp(self):
+        cache.clear()
+        self.device = Device.objects.create(
+            id='light-1', name='Đèn', device_type='light', room='bedroom', ip_address='192.168.1.50'
+        )
+        self.url = reverse('device_status_push')
+
+    def _post(self, body, token=None):
+        headers = {'HTTP_X_DEVICE_TOKEN': token} if token else {}
+        return self.client.post(self.url, data=json.dumps(body), content_type='application/json', **headers)
+
+    @override_settings(ESP_PUSH_TOKEN=None)
+    def test_rejected_when_token_not_configured(self):
+        response = self._post({'LED1': 1})
+        self.assertEqual(response.status_code, 403)
+
+    @override_settings(ESP_PUSH_TOKEN='secret')
+    def test_rejected_with_wrong_token(self):
+        response = self._post({'LED1': 1}, token='wrong')
+        self.assertEqual(response.status_code, 403)
+
+    @override_settings(ESP_PUSH_TOKEN='secret')
+    def test_board_ip_in_body_is_ignored(self):
+        # Request đến từ 127.0.0.1: không được cập nhật board 192.168.1.50 dù body ghi IP đó
+        response = self._post({'ip': '192.168.1.50', 'status': {'LED1': 1}}, token='secret')
+
+        self.assertEqual(response.status_code, 404)
+        self.device.refresh_from_db()
+        self.assertFalse(self.device.is_online)
+        self.assertFalse(self.device.is_on)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BulkBoardCommandTests(TestCase):
+    """Gửi lệnh hàng loạt: lock board theo từng lệnh, lệnh cũ bị lệnh mới thay thế thì bỏ"""
+
+    def setUp(self):
+        cache.clear()
+        self.redis = FakeRedis()
+        self.redis_patcher = mock.patch.object(command_queue, 'get_redis', return_value=self.redis)
+        self.redis_patcher.start()
+        self.addCleanup(self.redis_patcher.stop)
+        self.devices = [
+            Device.objects.create(
+                id=f'light-{index}', name=f'Đèn {index}', device_type='light',
+                room='bedroom', ip_address='192.168.1.50'
+            )
+            for index in range(2)
+        ]
+
+    def test_lock_taken_per_command_and_superseded_skipped(self):
+        first_id, _ = command_queue.enqueue(self.devices[0], 'on')
+        old_id, _ = command_queue.enqueue(self.devices[1], 'on')
+        command_queue.enqueue(self.devices[1], 'off')  # thay thế old_id
+        lock_holders = []
+
+        def send(device, action, data):
+            lock_holders.append(self.redis.get(command_queue.LOCK_KEY.format(ip='192.168.1.50')))
+            return True
+
+        with mock.patch.object(control.esp_client, 'send_command', side_effect=send) as send_command:
+            results = control.send_grouped(
+                [(self.devices[0], 'on', {}), (self.devices[1], 'on', {})],
+                [first_id, old_id],
+            )
+
+        self.assertEqual(results, [True, control.SUPERSEDED])
+        self.assertEqual(send_command.call_count, 1)
+        self.assertEqual(lock_holders, [first_id])
+        self.assertIsNone(self.redis.get(command_queue.LOCK_KEY.format(ip='192.168.1.50')))
+
+    def test_release_board_keeps_lock_of_other_command(self):
+        self.assertTrue(command_queue.acquire_board('192.168.1.50', 'owner'))
+
+        command_queue.release_board('192.168.1.50', 'other')
+        self.assertEqual(self.redis.get(command_queue.LOCK_KEY.format(ip='192.168.1.50')), 'owner')
+
+        command_queue.release_board('192.168.1.50', 'owner')
+        self.assertIsNone(self.redis.get(command_queue.LOCK_KEY.format(ip='192.168.1.50')))
+
+
+class ScheduleClaimLeaseTests(TestCase):
+    """schedule_claim: lease giữ lịch đến khi complete, hết hạn thì claim lại được"""
+
+    def setUp(self):
+        from users.models import User
+
+        user = User.objects.create_user(username='owner', password='x')
+        device = Device.objects.create(id='light-1', name='Đèn', device_type='light', room='bedroom')
+        self.schedule = DeviceSchedule.objects.create(
+            user=user, device=device, action='on',
+            scheduled_time=datetime(2026, 1, 1, 7, 0).time(), repeat_type='daily'
+        )
+        self.due_at = timezone.now() - timedelta(seconds=30)
+        DeviceSchedule.objects.filter(id=self.schedule.id).update(next_run_at=self.due_at)
+
+    def test_claim_holds_schedule_until_complete(self):
+        now = timezone.now()
+        claimed = schedule_claim.claim_due(now)
+
+        self.assertEqual([schedule.id for schedule in claimed], [self.schedule.id])
+        # Chưa complete: lịch vẫn đến hạn nhưng worker khác không claim được
+        self.assertEqual(schedule_claim.claim_due(now), [])
+        self.schedule.refresh_from_db()
+        self.assertEqual(self.schedule.next_run_at, self.due_at)
+
+        schedule_claim.complete(claimed, now)
+
+        self.schedule.refresh_from_db()
+        self.assertGreater(self.schedule.next_run_at, now)
+        self.assertEqual(self.schedule.claimed_by, '')
+        self.assertIsNone(self.schedule.claimed_at)
+
+    def test_expired_lease_is_reclaimed(self):
+        now = timezone.now()
+        first = schedule_claim.claim_due(now)
+
+        later = now + timedelta(seconds=schedule_claim.lease_seconds() + 1)
+        second = schedule_claim.claim_due(later)
+        self.assertEqual([schedule.id for schedule in second], [self.schedule.id])
+
+        # Worker cũ hoàn tất muộn: lease đã thuộc worker mới nên không đổi lịch
+        self.assertEqual(schedule_claim.complete(first, later), [])
+        self.schedule.refresh_from_db()
+        self.assertEqual(self.schedule.next_run_at, self.due_at)
+        self.assertEqual(len(schedule_claim.complete(second, later)), 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ScheduleBatchExecutionTests(TestCase):
+    """Thực thi lịch hẹn: ghi lên device đọc lại sau khi gửi lệnh, mở / đóng session, ESP8266 lỗi thì không đổi"""
+
+    def setUp(self):
+        from users.models import User
+
+        cache.clear()
+        user = User.objects.create_user(username='owner', password='x')
+        device = Device.objects.create(
+            id='light-1', name='Đèn', device_type='light', room='bedroom', ip_address='192.168.1.50'
+        )
+        DeviceSchedule.objects.create(
+            user=user, device=device, action='on',
+            scheduled_time=datetime(2026, 1, 1, 7, 0).time(), repeat_type='daily'
+        )
+        DeviceSchedule.objects.update(next_run_at=timezone.now() - timedelta(seconds=30))
+
+    def test_changes_made_while_sending_are_kept(self):
+        from devices.management.commands.start_scheduler import Command
+
+        def send_grouped(commands):
+            # Trong lúc chờ ESP8266: API đổi độ sáng của đèn
+            Device.objects.filter(id='light-1').update(status={'brightness': 40})
+            return [True] * len(commands)
+
+        schedules = schedule_claim.claim_due(timezone.now())
+        with mock.patch.object(control, 'send_grouped', side_effect=send_grouped), \
+                mock.patch.object(realtime, '_group_send', return_value=True):
+            completed = Command(stdout=StringIO()).execute_schedules_batch(schedules)
+
+        self.assertEqual(len(completed), 1)
+        device = Device.objects.get(id='light-1')
+        self.assertTrue(device.is_on)
+        self.assertEqual(device.status['brightness'], 40)
+        self.assertEqual(device.status['last_scheduled_action'], 'on')
+
+    def test_scheduled_on_opens_usage_session(self):
+        from devices.management.commands.start_scheduler import Command
+
+        schedules = schedule_claim.claim_due(timezone.now())
+        with mock.patch.object(control, 'send_grouped', return_value=[True]), \
+                mock.patch.object(realtime, '_group_send', return_value=True):
+            Command(stdout=StringIO()).execute_schedules_batch(schedules)
+
+        device = Device.objects.get(id='light-1')
+        session = DeviceUsageSession.objects.get(device=device)
+        self.assertIsNone(session.end_time)
+        self.assertEqual(device.current_session_start, session.start_time)
+
+    def test_failed_send_leaves_device_and_keeps_lease(self):
+        from devices import tasks
+
+        schedule = DeviceSchedule.objects.get()
+        with mock.patch.object(esp_client, 'send_command', return_value=False):
+            tasks.execute_scheduled_task(str(schedule.id))
+
+        self.assertFalse(Device.objects.get(id='light-1').is_on)
+        self.assertFalse(DeviceLog.objects.exists())
+        self.assertFalse(DeviceUsageSession.objects.exists())
+        # Lịch giữ lease: chạy lại khi lease hết hạn
+        schedule.refresh_from_db()
+        self.assertIsNotNone(schedule.claimed_at)
+
+
+class UpdateBroadcasterTests(SimpleTestCase):
+    """Gom cập nhật: 1 message mỗi phòng, delta luôn có is_on / status"""
+
+    def setUp(self):
+        self.broadcaster = realtime.UpdateBroadcaster(window=0)
+        self.light = Device(id='light-1', name='Đèn', device_type='light', room='bedroom', status={})
+        self.fan = Device(id='fan-1', name='Quạt', device_type='fan', room='bedroom', status={})
+        self.socket = Device(id='socket-1', name='Ổ cắm', device_type='socket', room='kitchen', status={})
+        patcher = mock.patch.object(realtime, '_group_send', return_value=True)
+        self.group_send = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(realtime, 'record_event', return_value=7)
+        self.record_event = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sent(self):
+        return {call.kwargs['group']: call.args[0] for call in self.group_send.call_args_list}
+
+    def test_one_message_per_room_with_latest_state(self):
+        self.broadcaster.add(self.light)
+        self.light.is_on = True
+        self.broadcaster.add(self.light)
+        self.broadcaster.add(self.fan)
+        self.broadcaster.add(self.socket)
+
+        self.assertEqual(self.broadcaster.flush(), 3)
+
+        sent = self.sent()
+        self.assertEqual(set(sent), {realtime.room_group('bedroom'), realtime.room_group('kitchen')})
+        bedroom = sent[realtime.room_group('bedroom')]
+        self.assertEqual(bedroom['seq'], 7)
+        self.assertEqual([update['id'] for update in bedroom['updates']], ['light-1', 'fan-1'])
+        self.assertTrue(bedroom['updates'][0]['is_on'])
+
+    def test_delta_keeps_state_fields(self):
+        self.broadcaster.add(self.light)
+        self.broadcaster.flush()
+        self.group_send.reset_mock()
+
+        # Trạng thái giống lần gửi trước của process này vẫn gửi is_on / status
+        self.broadcaster.add(self.light)
+        self.broadcaster.flush(force=True)
+
+        update = self.sent()[realtime.room_group('bedroom')]['updates'][0]
+        self.assertEqual(set(update), {'id', 'is_on', 'status', 'updated_at'})
+        self.assertFalse(update['is_on'])
+
+        self.group_send.reset_mock()
+        self.light.name = 'Đèn ngủ'
+        self.broadcaster.add(self.light)
+        self.broadcaster.flush(force=True)
+        update = self.sent()[realtime.room_group('bedroom')]['updates'][0]
+        self.assertEqual(update['name'], 'Đèn ngủ')
+        self.assertNotIn('device_type', update)
+
+    def test_flush_respects_window(self):
+        broadcaster = realtime.UpdateBroadcaster(window=60)
+        broadcaster.add(self.light)
+        self.assertEqual(broadcaster.flush(force=True), 1)
+        broadcaster.add(self.light)
+        self.assertEqual(broadcaster.flush(), 0)
+        self.assertEqual(broadcaster.flush(force=True), 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PollCycleBroadcastTests(TestCase):
+    """Chu kỳ poll: thay đổi gửi ngay cuối chu kỳ, bật / tắt từ công tắc mở / đóng session"""
+
+    def setUp(self):
+        cache.clear()
+        self.device = Device.objects.create(
+            id='light-1', name='Đèn', device_type='light', room='bedroom', ip_address='192.168.1.50'
+        )
+        self.command = SyncDeviceStatusCommand(stdout=StringIO())
+        self.command._broadcaster = realtime.UpdateBroadcaster(window=60)
+        patcher = mock.patch.object(realtime, '_group_send', return_value=True)
+        self.group_send = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(realtime, 'record_event', return_value=1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_last_cycle_is_not_left_pending(self):
+        devices_by_ip = {'192.168.1.50': [self.device]}
+        self.command.reconcile_devices(devices_by_ip, {'192.168.1.50': {'LED1': 1}})
+        # Chu kỳ cuối (vd: trước khi dừng) vẫn trong window của lần gửi trước
+        self.command.reconcile_devices(devices_by_ip, {'192.168.1.50': {'LED1': 0}})
+
+        sent = [call.args[0]['updates'][0]['is_on'] for call in self.group_send.call_args_list]
+        self.assertEqual(sent, [True, False])
+        self.assertEqual(self.command.get_broadcaster()._pending, {})
+
+    def test_switch_change_opens_and_closes_usage_session(self):
+        devices_by_ip = {'192.168.1.50': [self.device]}
+        self.command.reconcile_devices(devices_by_ip, {'192.168.1.50': {'LED1': 1}})
+
+        device = Device.objects.get(id='light-1')
+        session = DeviceUsageSession.objects.get(device=device)
+        self.assertEqual(device.current_session_start, session.start_time)
+
+        self.command.reconcile_devices(devices_by_ip, {'192.168.1.50': {'LED1': 0}})
+
+        device.refresh_from_db()
+        session.refresh_from_db()
+        self.assertIsNone(device.current_session_start)
+        self.assertIsNotNone(session.end_time)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class StatsCacheInvalidationTests(TestCase):
+    """Sửa ngày cũ chỉ bỏ cache của các tháng chứa ngày đó"""
+
+    def setUp(self):
+        cache.clear()
+        self.today = timezone.localdate()
+        self.last_month_end = self.today.replace(day=1) - timedelta(days=1)
+        self.last_month_start = self.last_month_end.replace(day=1)
+        self.computed = 0
+
+    def compute(self):
+        self.computed += 1
+        return {'value': self.computed}
+
+    def get(self):
+        return stats_cache.get_or_compute(
+            'real_statistics', 'month', self.last_month_start, self.last_month_end, self.compute
+        )
+
+    def test_only_affected_months_are_invalidated(self):
+        self.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            stats_cache.invalidate()
+            stats_cache.invalidate(self.today.replace(day=1))
+        self.assertEqual(self.get(), {'value': 1})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            stats_cache.invalidate(self.last_month_end, self.today)
+        self.assertEqual(self.get(), {'value': 2})
+
+    def test_history_result_has_finite_timeout(self):
+        with mock.patch.object(stats_cache.cache, 'set') as cache_set:
+            self.get()
+        self.assertIsNotNone(cache_set.call_args.kwargs['timeout'])
+
+    def test_counters_track_endpoints(self):
+        self.get()
+        self.get()
+        counters = stats_cache.counters()
+        self.assertEqual(counters['real_statistics'], {'hits': 1, 'misses': 1, 'hit_rate': 0.5})
+        self.assertEqual(counters['overall_rollups'], {'hits': 0, 'misses': 0, 'hit_rate': 0.0})
+
+    def test_unknown_endpoint_rejected(self):
+        with self.assertRaises(ValueError):
+            stats_cache.get_or_compute('unknown', 'month', self.today, self.today, self.compute)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class RealTimeUsageLocalDateTests(TestCase):
+    """"Hôm nay" theo giờ địa phương, không theo ngày UTC"""
+
+    def test_today_summary_uses_local_date(self):
+        device = Device.objects.create(id='light-1', name='Đèn', device_type='light', room='bedroom')
+        DeviceStatistics.objects.create(
+            device=device, date=date(2026, 10, 18), turn_on_count=2, total_usage_minutes=30
+        )
+        # 18:30 UTC ngày 17 = 01:30 ngày 18 ở Asia/Ho_Chi_Minh
+        now = datetime(2026, 10, 17, 18, 30, tzinfo=dt_timezone.utc)
+        with mock.patch('django.utils.timezone.now', return_value=now):
+            data = self.client.get(reverse('realtime-usage')).json()
+
+        self.assertTrue(data['success'])
+        self.assertEqual(data['today_summary']['turn_on_count'], 2)
+
+
+class PollSchedulerTests(SimpleTestCase):
+    """Lịch poll từng board: đến hạn theo thứ tự, giãn khi ổn định, backoff khi lỗi"""
+
+    def setUp(self):
+        self.scheduler = PollScheduler(min_interval=1, max_interval=10, max_backoff=30, offline_after=3)
+
+    def test_due_boards_in_time_order(self):
+        self.scheduler.sync_ips(['10.0.0.1', '10.0.0.2', '10.0.0.3'], now=0)
+        self.assertEqual(sorted(self.scheduler.pop_due(0)), ['10.0.0.1', '10.0.0.2', '10.0.0.3'])
+
+        self.scheduler.record_success('10.0.0.1', changed=True, now=0)   # +1
+        self.scheduler.record_success('10.0.0.2', changed=False, now=0)  # +1.5
+        self.scheduler.record_failure('10.0.0.3', now=0)                 # +2
+
+        self.assertEqual(self.scheduler.seconds_until_next(0), 1)
+        self.assertEqual(self.scheduler.pop_due(0.5), [])
+        self.assertEqual(self.scheduler.pop_due(2), ['10.0.0.1', '10.0.0.2', '10.0.0.3'])
+
+    def test_stable_board_backs_off_to_max_interval(self):
+        self.scheduler.sync_ips(['10.0.0.1'], now=0)
+        now = 0
+        for _ in range(10):
+            self.scheduler.record_success('10.0.0.1', changed=False, now=now)
+            now = self.scheduler.seconds_until_next(now) + now
+        self.assertEqual(self.scheduler.seconds_until_next(now - 10), 10)
+
+        # Có thay đổi: quay về min_interval
+        self.scheduler.record_success('10.0.0.1', changed=True, now=now)
+        self.assertEqual(self.scheduler.seconds_until_next(now), 1)
+
+    def test_failures_back_off_and_flip_offline_once(self):
+        self.scheduler.sync_ips(['10.0.0.1'], now=0)
+        flips = [self.scheduler.record_failure('10.0.0.1', now=0) for _ in range(6)]
+
+        self.assertEqual(flips, [False, False, True, False, False, False])
+        self.assertEqual(self.scheduler.seconds_until_next(0), 30)
+        # Lần thành công đầu tiên: online lại và poll sau min_interval
+        self.assertTrue(self.scheduler.record_success('10.0.0.1', changed=False, now=0))
+        self.assertEqual(self.scheduler.seconds_until_next(0), 1)
+
+    def test_removed_board_is_skipped(self):
+        self.scheduler.sync_ips(['10.0.0.1', '10.0.0.2'], now=0)
+        self.scheduler.sync_ips(['10.0.0.2'], now=0)
+        self.assertEqual(self.scheduler.pop_due(0), ['10.0.0.2'])
+        self.assertIsNone(self.scheduler.seconds_until_next(0))
+
+
+class CommandQueueTests(SimpleTestCase):
+    """Hàng đợi lệnh: toggle gộp theo trạng thái mong muốn, lệnh cũ bị thay thế"""
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.redis_patcher = mock.patch.object(command_queue, 'get_redis', return_value=self.redis)
+        self.redis_patcher.start()
+        self.addCleanup(self.redis_patcher.stop)
+        self.device = Device(id='light-1', name='Đèn', device_type='light', room='bedroom', is_on=False)
+
+    def test_repeated_toggles_coalesce_on_desired_state(self):
+        first, action1 = command_queue.enqueue(self.device, 'toggle')
+        second, action2 = command_queue.enqueue(self.device, 'toggle')
+        third, action3 = command_queue.enqueue(self.device, 'toggle')
+
+        # Device chưa đổi trong DB: toggle dựa trên trạng thái mong muốn mới nhất
+        self.assertEqual([action1, action2, action3], ['on', 'off', 'on'])
+        self.assertFalse(command_queue.is_latest('light-1', first))
+        self.assertFalse(command_queue.is_latest('light-1', second))
+        self.assertTrue(command_queue.is_latest('light-1', third))
+
+    def test_finish_only_clears_latest_command(self):
+        first, _ = command_queue.enqueue(self.device, 'on')
+        command_queue.enqueue(self.device, 'off')
+
+        # Lệnh cũ xong muộn: không xóa trạng thái của lệnh mới
+        command_queue.finish('light-1', first)
+        self.assertEqual(command_queue.enqueue(self.device, 'toggle')[1], 'on')
+
+        latest, _ = command_queue.enqueue(self.device, 'off')
+        command_queue.finish('light-1', latest)
+        self.assertIsNone(self.redis.get(command_queue.LATEST_KEY.format(device_id='light-1')))
+        # Không còn trạng thái mong muốn: toggle theo trạng thái trong DB
+        self.assertEqual(command_queue.enqueue(self.device, 'toggle')[1], 'on')
+
+    def test_board_lock_released_only_by_owner(self):
+        self.assertTrue(command_queue.acquire_board('192.168.1.50', 'a'))
+        self.assertFalse(command_queue.acquire_board('192.168.1.50', 'b'))
+
+        command_queue.release_board('192.168.1.50', 'b')
+        self.assertFalse(command_queue.acquire_board('192.168.1.50', 'b'))
+
+        command_queue.release_board('192.168.1.50', 'a')
+        self.assertTrue(command_queue.acquire_board('192.168.1.50', 'b'))
+
+    @override_settings(ESP_COMMAND_REDIS_URL=None)
+    def test_missing_redis_url_fails_loudly(self):
+        self.redis_patcher.stop()
+        with mock.patch.object(command_queue, '_client', None):
+            with self.assertRaises(ImproperlyConfigured):
+                command_queue.enqueue(self.device, 'on')
+
+
+class NextScheduledDatetimeTests(SimpleTestCase):
+    """Lần chạy kế tiếp của lịch lặp lại theo bitmask ngày trong tuần"""
+
+    def setUp(self):
+        self.tz = timezone.get_current_timezone()
+        # Chủ nhật 18/10/2026 10:00 giờ địa phương
+        self.now = timezone.make_aware(datetime(2026, 10, 18, 10, 0), self.tz)
+
+    def schedule(self, repeat_type, hour, repeat_days=None):
+        return SimpleNamespace(
+            repeat_type=repeat_type,
+            repeat_days=repeat_days or [],
+            repeat_mask=weekday_mask(repeat_days),
+            scheduled_time=datetime(2026, 1, 1, hour, 0).time(),
+            scheduled_date=None,
+        )
+
+    def local(self, day, hour):
+        return timezone.make_aware(datetime(2026, 10, day, hour, 0), self.tz)
+
+    def test_weekday_mask(self):
+        self.assertEqual(weekday_mask(['mon', 'Sunday', 'xyz']), 0b1000001)
+        self.assertEqual(weekday_mask(None), 0)
+
+    def test_weekly_crosses_week_boundary(self):
+        # Chủ nhật -> thứ 2 tuần sau
+        schedule = self.schedule('weekly', 7, ['mon'])
+        self.assertEqual(next_scheduled_datetime(schedule, self.now), self.local(19, 7))
+
+        # Hôm nay đã qua giờ hẹn và chỉ hẹn chủ nhật: chủ nhật tuần sau
+        schedule = self.schedule('weekly', 7, ['sun'])
+        self.assertEqual(next_scheduled_datetime(schedule, self.now), self.local(25, 7))
+
+    def test_empty_mask_never_runs(self):
+        self.assertIsNone(next_scheduled_datetime(self.schedule('weekly', 7, []), self.now))
+
+    def test_scheduled_time_equal_to_now_moves_to_next_run(self):
+        self.assertEqual(next_scheduled_datetime(self.schedule('daily', 10), self.now), self.local(19, 10))
+        self.assertEqual(
+            next_scheduled_datetime(self.schedule('weekly', 10, ['sun']), self.now), self.local(25, 10)
+        )
+        self.assertIsNone(next_scheduled_datetime(self.schedule('once', 10), self.now))
+
+
+@override_settings(CACHES=LOCMEM_CACHES, REALTIME_RING_SIZE=3)
+class RealtimeResumeTests(SimpleTestCase):
+    """Kết nối lại: chỉ gửi phần bị lỡ, thiếu dữ liệu thì gửi snapshot"""
+
+    def setUp(self):
+        cache.clear()
+
+    def record(self, count):
+        for index in range(count):
+            realtime.record_event([('bedroom', {'id': f'light-{index}', 'is_on': True})])
+
+    def test_missed_events_in_order(self):
+        self.record(2)
+        seq, events = realtime.events_since(0)
+
+        self.assertEqual(seq, 2)
+        self.assertEqual([event['seq'] for event in events], [1, 2])
+        self.assertEqual(events[1]['updates'], [{'room': 'bedroom', 'update': {'id': 'light-1', 'is_on': True}}])
+        self.assertEqual(realtime.events_since(2), (2, []))
+
+    def test_gap_larger_than_ring_needs_snapshot(self):
+        self.record(5)
+        self.assertEqual(realtime.events_since(1), (5, None))
+        self.assertEqual([event['seq'] for event in realtime.events_since(2)[1]], [3, 4, 5])
+
+    def test_missing_event_needs_snapshot(self):
+        self.record(3)
+        cache.delete(realtime.EVENT_KEY.format(slot=2 % 3))
+        self.assertEqual(realtime.events_since(1), (3, None))
+
+    def test_seq_reset_needs_snapshot(self):
+        self.record(1)
+        self.assertEqual(realtime.events_since(10), (1, None))
+
+
+class LegacyClientTests(SimpleTestCase):
+    """Client cũ chưa gửi subscribe: nhận cả nhà dạng device_update; subscribe đầu tiên chuyển sang device_batch"""
+
+    def setUp(self):
+        self.consumer = DeviceConsumer()
+        self.consumer.scope = {'user': SimpleNamespace(is_authenticated=True), 'subprotocols': []}
+        self.consumer.channel_name = 'test-channel'
+        self.consumer.channel_layer = mock.Mock(group_add=mock.AsyncMock(), group_discard=mock.AsyncMock())
+        self.consumer.accept = mock.AsyncMock()
+        self.consumer.send = mock.AsyncMock()
+        async_to_sync(self.consumer.connect)()
+
+    def sent(self):
+        return [json.loads(call.kwargs['text_data']) for call in self.consumer.send.call_args_list]
+
+    def batch(self, room):
+        return {'type': 'device_batch', 'seq': 3, 'room': room, 'updates': [{'id': f'{room}-1', 'is_on': True}]}
+
+    def test_default_home_in_device_update_format(self):
+        self.assertEqual(self.consumer.groups_joined, set(realtime.home_groups()))
+
+        async_to_sync(self.consumer.device_batch)(self.batch('bedroom'))
+
+        self.assertEqual(self.sent(), [{'type': 'device_update', 'device': {'id': 'bedroom-1', 'is_on': True}}])
+
+    def test_first_subscribe_replaces_default(self):
+        async_to_sync(self.consumer.receive)(text_data=json.dumps({'action': 'subscribe', 'rooms': ['kitchen']}))
+        self.assertEqual(self.consumer.groups_joined, {realtime.room_group('kitchen')})
+        self.consumer.send.reset_mock()
+
+        async_to_sync(self.consumer.device_batch)(self.batch('bedroom'))
+        async_to_sync(self.consumer.device_batch)(self.batch('kitchen'))
+
+        self.assertEqual(self.sent(), [
+            {'type': 'device_batch', 'seq': 3, 'updates': [{'id': 'kitchen-1', 'is_on': True}]}
+        ])
+
+class CompactEncodingTests(SimpleTestCase):
+    """Encoding gọn: key ngắn + index thiết bị, client giải mã lại được"""
+
+    def setUp(self):
+        self.consumer = DeviceConsumer()
+        self.consumer.device_dictionary = [['light-1', 'Đèn', 'light', 'bedroom']]
+        self.consumer.device_index = {'light-1': 0}
+        self.updated_at = '2026-10-17T10:00:00+07:00'
+        self.timestamp = int(datetime.fromisoformat(self.updated_at).timestamp())
+
+    def decode_device(self, device):
+        """Giải mã như client: key dài, index -> id + field từ từ điển"""
+        names = {short: key for key, short in SHORT_KEYS.items() if key != 'device_id'}
+        device = {names.get(key, key): value for key, value in device.items()}
+        if isinstance(device['id'], int):
+            row = self.consumer.device_dictionary[device['id']]
+            device['id'] = row[0]
+            for position, field in enumerate(DICTIONARY_FIELDS, start=1):
+                device.setdefault(field, row[position])
+        return device
+
+    def test_batch_round_trip(self):
+        known = {'id': 'light-1', 'name': 'Đèn', 'is_on': True,
+                 'status': {'brightness': 80}, 'updated_at': self.updated_at}
+        unknown = {'id': 'socket-9', 'is_on': False, 'status': {}, 'updated_at': self.updated_at}
+
+        compact = self.consumer._compact({'type': 'device_batch', 'seq': 5, 'updates': [known, unknown]})
+
+        self.assertEqual(compact, {
+            't': 'device_batch',
+            's': 5,
+            'u': [
+                {'i': 0, 'o': True, 'x': {'brightness': 80}, 'a': self.timestamp},
+                {'i': 'socket-9', 'o': False, 'x': {}, 'a': self.timestamp},
+            ],
+        })
+        if consumers.msgpack is not None:
+            packed = consumers.msgpack.packb(compact, use_bin_type=True)
+            self.assertEqual(consumers.msgpack.unpackb(packed, raw=False), compact)
+
+        for original, encoded in zip([known, unknown], compact['u']):
+            decoded = self.decode_device(encoded)
+            for key, value in original.items():
+                expected = self.timestamp if key == 'updated_at' else value
+                self.assertEqual(decoded[key], expected)
+
+    def test_command_result_device_id_uses_index(self):
+        compact = self.consumer._compact({
+            'type': 'command_result', 'command_id': 'c-1', 'device_id': 'light-1',
+            'status': 'confirmed', 'message': 'Đã bật Đèn', 'device': None,
+        })
+        self.assertEqual(compact, {
+            't': 'command_result', 'c': 'c-1', 'i': 0, 'x': 'confirmed', 'm': 'Đã bật Đèn', 'd': None,
+        })
@@ -3,6 +3,7 @@ from . import views
 
 urlpatterns = [
     path('api/devices/', views.DeviceListView.as_view(), name='devices'),
+    path('api/devices/bulk-control/', views.BulkDeviceControlView.as_view(), name='device_bulk_control'),
     re_path(r'^api/devices/(?P<device_id>[\w-]+)/control/$', views.DeviceControlView.as_view(), name='device_control'),
     re_path(r'^api/devices/(?P<device_id>[\w-]+)/logs/$', views.DeviceLogsView.as_view(), name='device_logs'),
     path('api/devices/<uuid:device_id>/statistics/', views.DeviceStatisticsView.as_view(), name='device-statistics'),
@@ -10,9 +11,13 @@ urlpatterns = [
     path('api/statistics/realtime/', views.RealTimeUsageView.as_view(), name='realtime-usage'),
     path('api/statistics/', views.RealStatisticsView.as_view(), name='real_statistics'),
     path('api/debug/stats/', views.DebugStatsView.as_view(), name='debug_stats'),
+    path('api/debug/stats-cache/', views.StatisticsCacheView.as_view(), name='debug_stats_cache'),
     path('api/cleanup-sessions/', views.CleanupSessionsView.as_view(), name='cleanup_sessions'),
     path('api/schedules/', views.ScheduleListView.as_view(), name='schedule_list_create'),
     path('api/schedules/<uuid:schedule_id>/', views.ScheduleDetailView.as_view(), name='schedule_detail_update_delete'),
+    path('api/scenes/', views.SceneListView.as_view(), name='scene_list_create'),
+    path('api/scenes/<uuid:scene_id>/', views.SceneDetailView.as_view(), name='scene_detail_delete'),
     path('api/sensor-data/', views.SensorDataView.as_view(), name='sensor_data'), 
     path('api/devices/sync/', views.DeviceSyncView.as_view(), name='device_sync'),
+    path('api/devices/push/', views.DeviceStatusPushView.as_view(), name='device_status_push'),
 ]
\ No newline at end of file
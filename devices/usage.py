@@ -0,0 +1,267 @@
+# devices/usage.py
+"""
+Tính thống kê sử dụng từ DeviceUsageSession (nguồn dữ liệu duy nhất cho thống kê):
+- Chia session theo từng giờ địa phương (session qua nửa đêm được tính đúng ngày)
+- Cộng dồn vào DeviceStatistics (theo ngày) và UsageRollup (giờ / ngày / tháng ×
+  thiết bị / phòng / loại thiết bị) bằng 1 câu INSERT ... ON DUPLICATE KEY UPDATE (MySQL)
+  / ON CONFLICT (SQLite, PostgreSQL) mỗi batch
+- Lần bật tính lúc mở session, thời gian / điện năng / tiền điện tính lúc đóng session
+- Điện năng theo công suất từng thiết bị, tiền điện theo bậc thang tháng (devices/tariff.py):
+  mỗi giờ có 1 giá = tiền bậc thang của điện năng cả nhà trong giờ đó / số kWh,
+  duyệt các giờ theo thứ tự thời gian trên nền điện năng đã dùng từ đầu tháng
+- Ghi trực tiếp: giá tính trên điện năng tháng đã ghi nhận lúc đóng session;
+  rebuild_statistics tính lại theo đúng thứ tự thời gian của cả tháng
+"""
+import math
+from datetime import timedelta
+from itertools import groupby
+
+from django.db import connection as default_connection
+from django.db.models import Q, Sum
+from django.utils import timezone
+
+from .models import DeviceStatistics, UsageRollup
+from . import stats_cache, tariff
+
+ROLLUP_KEY_FIELDS = ['grain', 'scope', 'scope_key', 'bucket_date', 'hour']
+ROLLUP_VALUE_FIELDS = ['turn_on_count', 'usage_minutes', 'power_consumption', 'cost']
+
+DAILY_KEY_FIELDS = ['device', 'date']
+DAILY_VALUE_FIELDS = ['turn_on_count', 'total_usage_minutes', 'power_consumption', 'cost']
+
+UPSERT_BATCH_SIZE = 500
+
+
+def split_hours(start, end):
+    """
+    Chia khoảng [start, end) theo từng giờ địa phương
+    Yields: (date, hour, minutes, whole_minutes)
+    whole_minutes là số phút nguyên của từng phần; tổng bằng int(tổng số phút)
+    (giống duration_minutes của session), nên cộng theo ngày không bị lệch do làm tròn
+    """
+    session_start = current = timezone.localtime(start)
+    end = timezone.localtime(end)
+    elapsed_whole = 0
+    while current < end:
+        next_hour = current.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        piece_end = min(next_hour, end)
+        piece_whole = math.floor((piece_end - session_start).total_seconds() / 60) - elapsed_whole
+        elapsed_whole += piece_whole
+        yield current.date(), current.hour, (piece_end - current).total_seconds() / 60, piece_whole
+        current = piece_end
+
+
+def _add(rows, key, turn_on, minutes, power, cost):
+    values = rows.setdefault(key, [0, 0, 0.0, 0.0])
+    values[0] += turn_on
+    values[1] += minutes
+    values[2] += power
+    values[3] += cost
+
+
+def _rollup_keys(device_id, device_type, room, day, hour):
+    scopes = (('device', str(device_id)), ('room', room or ''), ('type', device_type or ''))
+    buckets = (('hour', day, hour), ('day', day, 0), ('month', day.replace(day=1), 0))
+    for grain, bucket_date, bucket_hour in buckets:
+        for scope, scope_key in scopes:
+            yield grain, scope, scope_key, bucket_date, bucket_hour
+
+
+def add_household_kwh(household, start, end, power_kw):
+    """Cộng điện năng của session vào household (key (date, hour) -> kWh cả nhà)"""
+    for day, hour, minutes, _ in split_hours(start, end):
+        household[(day, hour)] = household.get((day, hour), 0.0) + power_kw * minutes / 60
+
+
+def household_month_kwh(months):
+    """Điện năng cả nhà (kWh) đã ghi nhận của các tháng (ngày 1): 1 query trên rollup tháng"""
+    if not months:
+        return {}
+    return dict(
+        UsageRollup.objects.filter(grain='month', scope='type', bucket_date__in=list(months))
+        .values_list('bucket_date')
+        .annotate(total=Sum('power_consumption'))
+        .order_by()
+    )
+
+
+def hourly_prices(household, month_to_date=None):
+    """
+    Giá điện (đ/kWh) từng giờ theo bậc thang tháng
+    household: dict (date, hour) -> kWh cả nhà trong giờ
+    month_to_date: dict tháng (ngày 1) -> kWh đã dùng trước các giờ này
+    Returns: dict (date, hour) -> đ/kWh
+    """
+    month_to_date = month_to_date or {}
+    prices = {}
+    for month, keys in groupby(sorted(household), key=lambda key: key[0].replace(day=1)):
+        keys = list(keys)
+        costs = tariff.marginal_costs([household[key] for key in keys], month_to_date.get(month, 0.0))
+        for key, cost in zip(keys, costs):
+            prices[key] = cost / household[key] if household[key] else 0.0
+    return prices
+
+
+def accumulate_session(daily, rollups, device_id, device_type, room, start, end,
+                       prices=None, count_turn_on=True, rated_power_w=None):
+    """
+    Cộng 1 session vào daily (key (device_id, date)) và rollups (key rollup)
+    Giá trị: [turn_on, minutes, kWh, cost]. Lần bật được tính vào giờ chứa start.
+    prices: kết quả hourly_prices (cần khi end khác None)
+    end=None: session đang chạy - chỉ tính lần bật
+    """
+    if count_turn_on:
+        start_local = timezone.localtime(start)
+        _add(daily, (device_id, start_local.date()), 1, 0, 0.0, 0.0)
+        for key in _rollup_keys(device_id, device_type, room, start_local.date(), start_local.hour):
+            _add(rollups, key, 1, 0.0, 0.0, 0.0)
+    if end is None:
+        return
+
+    power_kw = tariff.power_kw(device_type, rated_power_w)
+    for day, hour, minutes, whole_minutes in split_hours(start, end):
+        power = power_kw * minutes / 60
+        cost = power * prices.get((day, hour), 0.0)
+        _add(daily, (device_id, day), 0, whole_minutes, power, cost)
+        for key in _rollup_keys(device_id, device_type, room, day, hour):
+            _add(rollups, key, 0, minutes, power, cost)
+
+
+def rollup_rows(rows):
+    """dict key -> values thành list tuple theo key fields + value fields"""
+    return [key + tuple(values) for key, values in rows.items()]
+
+
+def upsert_increment(model, key_fields, value_fields, rows, connection=None,
+                     batch_size=UPSERT_BATCH_SIZE, touch=None):
+    """
+    Thêm dòng mới hoặc CỘNG value_fields vào dòng đã có (theo unique key_fields)
+    Mỗi batch là 1 câu SQL, an toàn khi nhiều process cùng cộng vào 1 dòng
+    rows: list tuple theo thứ tự key_fields + value_fields
+    touch: dict field -> giá trị ghi khi thêm, và ghi đè khi trùng (vd: updated_at);
+           field auto_now_add chỉ ghi khi thêm
+    """
+    if not rows:
+        return
+    connection = connection or default_connection
+    touch = touch or {}
+    qn = connection.ops.quote_name
+    fields = [model._meta.get_field(name) for name in key_fields + value_fields + list(touch)]
+    table = qn(model._meta.db_table)
+    columns = ', '.join(qn(field.column) for field in fields)
+    value_columns = [qn(model._meta.get_field(name).column) for name in value_fields]
+    touch_columns = [
+        qn(model._meta.get_field(name).column) for name in touch
+        if not getattr(model._meta.get_field(name), 'auto_now_add', False)
+    ]
+
+    if connection.vendor == 'mysql':
+        if not connection.mysql_is_mariadb and connection.mysql_version >= (8, 0, 19):
+            # Row alias: VALUES(col) trong ON DUPLICATE KEY UPDATE deprecated từ MySQL 8.0.20
+            alias, new_value = ' AS new', 'new.{}'.format
+        else:
+            # MariaDB không hỗ trợ row alias
+            alias, new_value = '', 'VALUES({})'.format
+        conflict = f'{alias} ON DUPLICATE KEY UPDATE ' + ', '.join(
+            [f'{column} = {column} + {new_value(column)}' for column in value_columns]
+            + [f'{column} = {new_value(column)}' for column in touch_columns]
+        )
+    else:
+        key_columns = ', '.join(qn(model._meta.get_field(name).column) for name in key_fields)
+        conflict = f' ON CONFLICT ({key_columns}) DO UPDATE SET ' + ', '.join(
+            [f'{column} = {table}.{column} + excluded.{column}' for column in value_columns]
+            + [f'{column} = excluded.{column}' for column in touch_columns]
+        )
+
+    touch_values = tuple(touch.values())
+    placeholder = '(' + ', '.join(['%s'] * len(fields)) + ')'
+    with connection.cursor() as cursor:
+        for offset in range(0, len(rows), batch_size):
+            batch = rows[offset:offset + batch_size]
+            params = [
+                field.get_db_prep_value(value, connection)
+                for row in batch
+                for field, value in zip(fields, tuple(row) + touch_values)
+            ]
+            cursor.execute(
+                f'INSERT INTO {table} ({columns}) VALUES {", ".join([placeholder] * len(batch))}{conflict}',
+                params,
+            )
+
+
+def write_statistics(daily, rollups, connection=None):
+    """Cộng dồn kết quả accumulate_session vào DeviceStatistics và UsageRollup"""
+    now = timezone.now()
+    upsert_increment(
+        DeviceStatistics, DAILY_KEY_FIELDS, DAILY_VALUE_FIELDS, rollup_rows(daily),
+        connection=connection, touch={'created_at': now, 'updated_at': now},
+    )
+    upsert_increment(
+        UsageRollup, ROLLUP_KEY_FIELDS, ROLLUP_VALUE_FIELDS, rollup_rows(rollups),
+        connection=connection,
+    )
+
+
+def record_turn_ons(sessions):
+    """
+    Ghi nhận lần bật của các session vừa mở
+    sessions: list (device, session)
+    """
+    daily, rollups = {}, {}
+    for device, session in sessions:
+        accumulate_session(daily, rollups, device.id, device.device_type, device.room, session.start_time, None)
+    write_statistics(daily, rollups)
+    stats_cache.invalidate()
+
+
+def record_closed_sessions(closed):
+    """
+    Cộng thời gian / điện năng / tiền điện của các session vừa kết thúc
+    closed: list (device, session)
+    """
+    closed = [(device, session) for device, session in closed if session.end_time is not None]
+    household = {}
+    for device, session in closed:
+        add_household_kwh(
+            household, session.start_time, session.end_time,
+            tariff.power_kw(device.device_type, device.rated_power_w)
+        )
+    months = {day.replace(day=1) for day, _ in household}
+    prices = hourly_prices(household, household_month_kwh(months))
+
+    daily, rollups = {}, {}
+    for device, session in closed:
+        accumulate_session(
+            daily, rollups, device.id, device.device_type, device.room,
+            session.start_time, session.end_time, prices,
+            count_turn_on=False, rated_power_w=device.rated_power_w
+        )
+    write_statistics(daily, rollups)
+    # Session qua nửa đêm: thống kê ngày cũ cũng thay đổi
+    days = [day for _, day in daily]
+    if days:
+        stats_cache.invalidate(min(days), max(days))
+
+
+def period_filter(start_date, end_date):
+    """
+    Q chọn UsageRollup phủ đúng [start_date, end_date]:
+    tháng trọn vẹn dùng dòng grain='month', phần lẻ dùng dòng grain='day'
+    """
+    months = []
+    query = Q(pk__in=[])
+    day = start_date
+    while day <= end_date:
+        month_start = day.replace(day=1)
+        next_month = (month_start + timedelta(days=32)).replace(day=1)
+        month_end = next_month - timedelta(days=1)
+        if day == month_start and month_end <= end_date:
+            months.append(month_start)
+            day = next_month
+        else:
+            range_end = min(month_end, end_date)
+            query |= Q(grain='day', bucket_date__range=[day, range_end])
+            day = range_end + timedelta(days=1)
+    if months:
+        query |= Q(grain='month', bucket_date__in=months)
+    return query
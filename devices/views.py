@@ -1,127 +1,17 @@
-from django.http import JsonResponse
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.utils.decorators import method_decorator
 from django.views import View
+from django.conf import settings
+import hmac
 import json
-import requests
-from django.db.models import Sum, Avg, Count
+from django.db.models import Sum, Avg, F, Q, Window
+from django.db.models.functions import RowNumber
 from django.utils import timezone
 from datetime import timedelta, datetime
-from .models import Device, DeviceLog, DeviceStatistics, DeviceUsageSession 
-
-# Helper functions
-def _get_power_rate(device_type):
-    """Lấy công suất thiết bị (kW)"""
-    power_rates = {
-        'light': 0.015,    # 15W = 0.015kW
-        'fan': 0.05,       # 50W = 0.05kW
-        'ac': 1.2,         # 1200W = 1.2kW
-        'socket': 0.1,     # 100W = 0.1kW
-        'door': 0.005,     # 5W = 0.005kW
-    }
-    return power_rates.get(device_type, 0.1)
-
-def _update_device_statistics(device, action, old_is_on):
-    """Cập nhật thống kê khi thay đổi trạng thái thiếtết bị"""
-    print(f"🔧 Updating stats: device={device.name}, action={action}, old_is_on={old_is_on}, new_is_on={not old_is_on if action == 'toggle' else action == 'on'}")
-    
-    # Tính trạng thái mới thực tế
-    if action == 'toggle':
-        new_is_on = not old_is_on
-    elif action == 'on':
-        new_is_on = True
-    elif action == 'off':
-        new_is_on = False
-    else:
-        new_is_on = old_is_on
-
-    # Bật thiết bị - TẠO SESSION MỚI
-    if new_is_on and not old_is_on:
-        print(f"🚀 Starting NEW session for {device.name}")
-        # Đảm bảo kết thúc session cũ nếu có (phòng trường hợp)
-        old_sessions = DeviceUsageSession.objects.filter(
-            device=device, 
-            end_time__isnull=True
-        )
-        if old_sessions.exists():
-            print(f"⚠️  Found {old_sessions.count()} old active sessions, ending them")
-            for old_session in old_sessions:
-                old_session.end_time = timezone.now()
-                old_session.duration_minutes = round((session.end_time - session.start_time).total_seconds() / 60)
-                old_session.save()
-        
-        # Tạo session mới
-        DeviceUsageSession.objects.create(device=device, start_time=timezone.now())
-        
-        # Cập nhật số lần bật
-        today = timezone.localtime(timezone.now()).date()
-        stats, created = DeviceStatistics.objects.get_or_create(
-            device=device, 
-            date=today,
-            defaults={
-                'turn_on_count': 1,
-                'total_usage_minutes': 0,
-                'power_consumption': 0.0,
-                'cost': 0.0
-            }
-        )
-        if not created:
-            stats.turn_on_count += 1
-            stats.save()
-        print(f"✅ Session started. Turn on count: {stats.turn_on_count}")
-    
-    # Tắt thiết bị - KẾT THÚC SESSION
-    elif not new_is_on and old_is_on:
-        print(f"🛑 Ending session for {device.name}")
-        # Tìm session đang chạy
-        session = DeviceUsageSession.objects.filter(
-            device=device, 
-            end_time__isnull=True
-        ).order_by('-start_time').first()
-        
-        if session:
-            session.end_time = timezone.now()
-            duration = session.end_time - session.start_time
-            duration_minutes = int(duration.total_seconds() / 60)
-            duration_seconds = int(duration.total_seconds())
-            session.duration_minutes = duration_minutes
-            session.save()
-
-            print(f"⏱️ Session duration: {duration_seconds} seconds ({duration_minutes} minutes)")
-            
-            # Cập nhật thống kê
-            if duration_minutes > 0:
-                power_rate = _get_power_rate(device.device_type)
-                hours_used = duration_minutes / 60.0
-                power_consumed = power_rate * hours_used
-                cost = power_consumed * 2500  # 2500 VND/kWh
-
-                today = timezone.localtime(timezone.now()).date()
-                stats, created = DeviceStatistics.objects.get_or_create(
-                    device=device,
-                    date=today,
-                    defaults={
-                        'turn_on_count': 0,
-                        'total_usage_minutes': duration_minutes,
-                        'power_consumption': power_consumed,
-                        'cost': cost
-                    }
-                )
-                if not created:
-                    stats.total_usage_minutes += duration_minutes
-                    stats.power_consumption += power_consumed
-                    stats.cost += cost
-                    stats.save()
-                
-                print(f"✅ Stats updated: +{duration_minutes}min, total: {stats.total_usage_minutes}min, cost: {cost} VND")
-            else:
-                print("⏩ Session too short (< 1 min), skipping stats update")
-        else:
-            print("❌ No active session found to end")
-    
-    else:
-        print(f"ℹ️  No state change needed: {device.name}")
+from .models import Device, DeviceStatistics, DeviceUsageSession, DeviceScene, UsageRollup
+from . import command_queue, control, device_cache, esp_client, stats_cache, tariff, usage
 
 # Views
 @method_decorator(csrf_exempt, name='dispatch')
@@ -130,25 +20,14 @@ class DeviceListView(View):
         if not request.user.is_authenticated:
             return JsonResponse({'success': False, 'message': 'Chưa đăng nhập'}, status=401)
         
-        devices = Device.objects.all()
-        devices_data = []
-        
-        for device in devices:
-            devices_data.append({
-                'id': str(device.id),
-                'name': device.name,
-                'device_type': device.device_type,
-                'room': device.room,
-                'is_on': device.is_on,
-                'status': device.status,
-                'ip_address': device.ip_address,
-                'created_at': device.created_at.isoformat(),
-            })
-        
-        return JsonResponse({
-            'success': True,
-            'devices': devices_data
-        })
+        # Snapshot đã serialize sẵn (cache), không đổi thì trả 304
+        snapshot = device_cache.get_snapshot()
+        if request.META.get('HTTP_IF_NONE_MATCH') == snapshot['etag']:
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(snapshot['body'], content_type='application/json')
+        response['ETag'] = snapshot['etag']
+        return response
 @method_decorator(csrf_exempt, name='dispatch')
 class DeviceControlView(View):
     def post(self, request, device_id):
@@ -159,78 +38,48 @@ class DeviceControlView(View):
             data = json.loads(request.body)
             action = data.get('action')  # 'turn_on', 'turn_off', 'open', 'close' từ Flutter
             
-            # CONVERT action từ Flutter sang format Django
-            action_mapping = {
-                'turn_on': 'on',
-                'turn_off': 'off',
-                'open': 'on',
-                'close': 'off'
-            }
-            
             # Chuyển đổi action nếu cần
-            django_action = action_mapping.get(action, action)
+            django_action = control.normalize_action(action)
             
             device = Device.objects.get(id=device_id)
-            old_status = device.status.copy() if device.status else {}
-            old_is_on = device.is_on
             
-            # GỬI LỆNH ĐẾN ESP8266
-            esp_success = self._send_to_esp8266(device, django_action, data)
-            if not esp_success:
+            # Chế độ bất đồng bộ: trả 202 ngay, kết quả gửi qua WebSocket
+            if data.get('async') or request.GET.get('async') in ('1', 'true'):
+                return self._dispatch_async(request, device, action, django_action, data)
+            
+            if not device.ip_address or django_action not in control.VALID_ACTIONS:
+                return self._control_now(request, device, action, django_action, data)
+            
+            # Gộp lệnh + gửi tuần tự theo board
+            command_id, resolved_action = command_queue.enqueue(device, django_action)
+            if not command_queue.wait_for_board(device.ip_address, command_id):
                 return JsonResponse({
-                    'success': False, 
-                    'message': 'Không thể kết nối với thiết bị'
-                }, status=500)
-            
-            # Cập nhật thống kê TRƯỚC KHI thay đổi trạng thái
-            self._update_device_statistics(device, django_action, old_is_on)
-            
-            # Cập nhật trạng thái thiết bị
-            if django_action == 'toggle':
-                device.is_on = not device.is_on
-            elif django_action == 'on':
-                device.is_on = True
-            elif django_action == 'off':
-                device.is_on = False
-            
-            # Cập nhật status dựa trên device type
-            if device.device_type == 'light':
-                device.status = {
-                    'brightness': data.get('brightness', device.status.get('brightness', 100) if device.status else 100),
-                    'color': data.get('color', device.status.get('color', '#ffffff') if device.status else '#ffffff')
-                }
-            elif device.device_type == 'fan':
-                device.status = {
-                    'speed': data.get('speed', device.status.get('speed', 3) if device.status else 3),
-                    'mode': data.get('mode', device.status.get('mode', 'normal') if device.status else 'normal')
-                }
-            elif device.device_type == 'ac':
-                device.status = {
-                    'temperature': data.get('temperature', device.status.get('temperature', 25) if device.status else 25),
-                    'mode': data.get('mode', device.status.get('mode', 'cool') if device.status else 'cool')
-                }
-            
-            device.save()
-            
-            # Ghi log
-            DeviceLog.objects.create(
-                device=device,
-                action=action,  # Giữ nguyên action từ Flutter để dễ debug
-                old_status={'is_on': old_is_on, **old_status},
-                new_status={'is_on': device.is_on, **device.status},
-                user=request.user
-            )
+                    'success': False,
+                    'message': 'Thiết bị đang bận, vui lòng thử lại'
+                }, status=503)
             
-            return JsonResponse({
-                'success': True,
-                'message': f'Đã {"bật" if device.is_on else "tắt"} {device.name}',
-                'device': {
-                    'id': str(device.id),
-                    'name': device.name,
-                    'is_on': device.is_on,
-                    'status': device.status
-                }
-            })
+            try:
+                if not command_queue.is_latest(device.id, command_id):
+                    # Đã có lệnh mới hơn cho thiết bị này - bỏ qua lệnh cũ
+                    print(f"⏭️ Command {command_id} superseded: {device.name}")
+                    return JsonResponse({
+                        'success': True,
+                        'status': 'superseded',
+                        'message': 'Đã có lệnh mới hơn',
+                        'device': {
+                            'id': str(device.id),
+                            'name': device.name,
+                            'is_on': resolved_action == 'on',
+                            'status': device.status
+                        }
+                    })
+                
+                # Trạng thái có thể đã đổi bởi lệnh trước đó
+                device.refresh_from_db()
+                return self._control_now(request, device, action, resolved_action, data)
+            finally:
+                command_queue.release_board(device.ip_address, command_id)
+                command_queue.finish(device.id, command_id)
             
         except Device.DoesNotExist:
             return JsonResponse({'success': False, 'message': 'Thiết bị không tồn tại'}, status=404)
@@ -240,207 +89,194 @@ class DeviceControlView(View):
             traceback.print_exc()
             return JsonResponse({'success': False, 'message': f'Lỗi: {str(e)}'}, status=400)
     
-    def _send_to_esp8266(self, device, action, data):
-        """Gửi lệnh đến ESP8266"""
-        try:
-            # Kiểm tra IP address
-            if not device.ip_address:
-                print(f"⚠️ Device {device.name} không có IP address")
-                return False
-            
-            print(f"📡 Sending to ESP8266: {device.ip_address}, action: {action}")
-            
-            # Mapping device types với ESP endpoints
-            endpoints = {
-                'light': self._control_light,
-                'led': self._control_light,  # Thêm alias 'led'
-                'fan': self._control_fan,
-                'door': self._control_door,
-                'ac': self._control_dryer,
-            }
-            
-            control_func = endpoints.get(device.device_type.lower())
-            if control_func:
-                result = control_func(device, action, data)
-                print(f"{'✅' if result else '❌'} ESP8266 response: {result}")
-                return result
-            else:
-                print(f"⚠️ Device type {device.device_type} chưa được hỗ trợ")
-                return True  # Vẫn trả về success cho các device type khác
-            
-        except Exception as e:
-            print(f"❌ Lỗi gửi lệnh ESP8266: {e}")
-            import traceback
-            traceback.print_exc()
-            return False
-    
-    def _control_light(self, device, action, data):
-        """Điều khiển đèn"""
-        import requests
-        
-        # Xác định LED number dựa trên device name hoặc ID
-        led_number = self._get_led_number(device)
-        
-        # Xác định state (1=on, 0=off)
-        if action == 'toggle':
-            state = '0' if device.is_on else '1'
-        elif action == 'on':
-            state = '1'
-        elif action == 'off':
-            state = '0'
-        else:
-            state = '1'  # Default
+    def _control_now(self, request, device, action, django_action, data):
+        """Gửi lệnh đến ESP8266 rồi cập nhật DB, trả kết quả ngay"""
+        # GỬI LỆNH ĐẾN ESP8266
+        esp_success = self._send_to_esp8266(device, django_action, data)
+        if not esp_success:
+            return JsonResponse({
+                'success': False, 
+                'message': 'Không thể kết nối với thiết bị'
+            }, status=500)
         
-        url = f"http://{device.ip_address}/led{led_number}?state={state}"
-        print(f"🔗 LED URL: {url}")
+        # Cập nhật thống kê, trạng thái và ghi log
+        control.commit_control(device, action, data, request.user, django_action)
         
-        try:
-            response = requests.get(url, timeout=5)
-            return response.status_code == 200
-        except Exception as e:
-            print(f"❌ LED control error: {e}")
-            return False
+        return JsonResponse({
+            'success': True,
+            'message': f'Đã {"bật" if device.is_on else "tắt"} {device.name}',
+            'device': {
+                'id': str(device.id),
+                'name': device.name,
+                'is_on': device.is_on,
+                'status': device.status
+            }
+        })
     
-    def _control_fan(self, device, action, data):
-        """Điều khiển quạt"""
-        import requests
-        
-        if action == 'toggle':
-            speed = '0' if device.is_on else '3'  # Tắt hoặc tốc độ 3
-        elif action == 'on':
-            speed = str(data.get('speed', 3))  # Mặc định tốc độ 3
-        elif action == 'off':
-            speed = '0'
-        else:
-            speed = '3'  # Default
-        
-        url = f"http://{device.ip_address}/fan?speed={speed}"
-        print(f"🔗 FAN URL: {url}")
-        
-        try:
-            response = requests.get(url, timeout=5)
-            return response.status_code == 200
-        except Exception as e:
-            print(f"❌ FAN control error: {e}")
-            return False
+    def _send_to_esp8266(self, device, action, data):
+        """Gửi lệnh đến ESP8266 qua HTTP client dùng chung"""
+        print(f"📡 Sending to ESP8266: {device.ip_address}, action: {action}")
+        result = esp_client.send_command(device, action, data)
+        print(f"{'✅' if result else '❌'} ESP8266 response: {result}")
+        return result
     
-    def _control_door(self, device, action, data):
-        """Điều khiển cửa"""
-        import requests
-        
-        if action == 'toggle':
-            door_action = 'close' if device.is_on else 'open'
-        elif action == 'on':
-            door_action = 'open'
-        elif action == 'off':
-            door_action = 'close'
-        else:
-            door_action = 'open'  # Default
+    def _dispatch_async(self, request, device, action, django_action, data):
+        """Đưa lệnh vào hàng đợi Celery, trả về 202 kèm command_id và trạng thái dự kiến"""
+        from .tasks import execute_device_command
         
-        url = f"http://{device.ip_address}/door?action={door_action}"
-        print(f"🔗 DOOR URL: {url}")
+        if django_action not in control.VALID_ACTIONS:
+            return JsonResponse({'success': False, 'message': f'Action không hợp lệ: {action}'}, status=400)
         
-        try:
-            response = requests.get(url, timeout=5)
-            return response.status_code == 200
-        except Exception as e:
-            print(f"❌ DOOR control error: {e}")
-            return False
-    
-    def _control_dryer(self, device, action, data):
-        """Điều khiển máy sấy"""
-        import requests
+        if not device.ip_address:
+            return JsonResponse({'success': False, 'message': 'Thiết bị chưa có địa chỉ IP'}, status=400)
         
-        if action == 'toggle':
-            dryer_action = 'in' if device.is_on else 'out'
-        elif action == 'on':
-            dryer_action = 'out'
-        elif action == 'off':
-            dryer_action = 'in'
-        else:
-            dryer_action = 'out'  # Default
+        # Lệnh cũ chưa gửi của thiết bị này sẽ bị thay thế
+        command_id, resolved_action = command_queue.enqueue(device, django_action)
+        execute_device_command.delay(
+            command_id, str(device.id), action, data, str(request.user.id), resolved_action
+        )
+        print(f"📨 Queued command {command_id}: {device.name} -> {resolved_action}")
         
-        url = f"http://{device.ip_address}/dry?action={dryer_action}"
-        print(f"🔗 DRYER URL: {url}")
+        return JsonResponse({
+            'success': True,
+            'status': 'queued',
+            'command_id': command_id,
+            'message': f'Đang gửi lệnh đến {device.name}',
+            'device': {
+                'id': str(device.id),
+                'name': device.name,
+                'is_on': resolved_action == 'on',
+                'status': device.status
+            }
+        }, status=202)
+
+@method_decorator(csrf_exempt, name='dispatch')
+class BulkDeviceControlView(View):
+    """
+    Điều khiển nhiều thiết bị cùng lúc.
+    Body: {"action": "turn_off", "device_ids": [...]} | {"action": ..., "room": "bedroom"}
+          | {"action": ..., "device_type": "light"} | {"scene_id": "..."}
+    """
+    def post(self, request):
+        if not request.user.is_authenticated:
+            return JsonResponse({'success': False, 'message': 'Chưa đăng nhập'}, status=401)
         
         try:
-            response = requests.get(url, timeout=5)
-            return response.status_code == 200
+            data = json.loads(request.body)
+            
+            if data.get('scene_id'):
+                scene = DeviceScene.objects.get(id=data['scene_id'], user=request.user)
+                devices = Device.objects.in_bulk([item.get('device_id') for item in scene.actions])
+                commands = [
+                    (devices[item['device_id']], item.get('action'), item)
+                    for item in scene.actions
+                    if item.get('device_id') in devices
+                ]
+            else:
+                action = data.get('action')
+                if control.normalize_action(action) not in control.VALID_ACTIONS:
+                    return JsonResponse({'success': False, 'message': f'Action không hợp lệ: {action}'}, status=400)
+                
+                devices = Device.objects.all()
+                if 'device_ids' in data:
+                    devices = devices.filter(id__in=data['device_ids'])
+                if data.get('room'):
+                    devices = devices.filter(room=data['room'])
+                if data.get('device_type'):
+                    devices = devices.filter(device_type=data['device_type'])
+                if not any(key in data for key in ('device_ids', 'room', 'device_type')):
+                    return JsonResponse({
+                        'success': False,
+                        'message': 'Cần device_ids, room, device_type hoặc scene_id'
+                    }, status=400)
+                
+                commands = [(device, action, data) for device in devices]
+            
+            if not commands:
+                return JsonResponse({'success': False, 'message': 'Không có thiết bị nào'}, status=404)
+            
+            results = control.execute_bulk(commands, request.user)
+            success_count = sum(1 for result in results if result['success'])
+            print(f"📦 Bulk control: {success_count}/{len(results)} device(s) OK")
+            
+            return JsonResponse({
+                'success': success_count > 0,
+                'message': f'Đã điều khiển {success_count}/{len(results)} thiết bị',
+                'success_count': success_count,
+                'failed_count': len(results) - success_count,
+                'results': results
+            })
+            
+        except DeviceScene.DoesNotExist:
+            return JsonResponse({'success': False, 'message': 'Ngữ cảnh không tồn tại'}, status=404)
         except Exception as e:
-            print(f"❌ DRYER control error: {e}")
-            return False
-    
-    def _get_led_number(self, device):
-        """Xác định LED number từ device name"""
-        name = device.name.lower()
-        if '2' in name or 'ngủ' in name or 'ngu' in name:
-            return '2'
-        else:
-            return '1'  # Mặc định LED1
-    
-    def _update_device_statistics(self, device, action, old_is_on):
-        """Cập nhật thống kê sử dụng"""
-        from django.utils import timezone
-        
-        today = timezone.now().date()
+            print(f"❌ Error in BulkDeviceControlView: {e}")
+            import traceback
+            traceback.print_exc()
+            return JsonResponse({'success': False, 'message': f'Lỗi: {str(e)}'}, status=400)
+
+@method_decorator(csrf_exempt, name='dispatch')
+class SceneListView(View):
+    """API để LẤY DANH SÁCH và TẠO MỚI ngữ cảnh (scene)"""
+    def get(self, request):
+        if not request.user.is_authenticated:
+            return JsonResponse({'success': False, 'message': 'Chưa đăng nhập'}, status=401)
         
-        # Tạo hoặc cập nhật DeviceStatistics
-        stats, created = DeviceStatistics.objects.get_or_create(
-            device=device,
-            date=today,
-            defaults={
-                'turn_on_count': 0,
-                'total_usage_minutes': 0,
-                'power_consumption': 0.0,
-                'cost': 0.0
-            }
-        )
+        scenes = DeviceScene.objects.filter(user=request.user)
+        data = []
+        for scene in scenes:
+            data.append({
+                'id': str(scene.id),
+                'name': scene.name,
+                'actions': scene.actions,
+            })
+        return JsonResponse({'success': True, 'scenes': data})
+    
+    def post(self, request):
+        if not request.user.is_authenticated:
+            return JsonResponse({'success': False, 'message': 'Chưa đăng nhập'}, status=401)
         
-        # Tăng số lần bật nếu chuyển từ off sang on
-        if action in ['on', 'toggle'] and not old_is_on:
-            stats.turn_on_count += 1
-            stats.save()
+        try:
+            data = json.loads(request.body)
+            name = data.get('name')
+            actions = data.get('actions')
             
-            # Tạo session sử dụng mới
-            DeviceUsageSession.objects.create(
-                device=device,
-                start_time=timezone.now()
-            )
+            if not name or not isinstance(actions, list) or not actions:
+                return JsonResponse({'success': False, 'message': 'Thiếu name hoặc actions'}, status=400)
+            
+            for item in actions:
+                if not isinstance(item, dict) or 'device_id' not in item:
+                    return JsonResponse({'success': False, 'message': 'Mỗi action cần device_id'}, status=400)
+                if control.normalize_action(item.get('action')) not in control.VALID_ACTIONS:
+                    return JsonResponse({
+                        'success': False,
+                        'message': f'Action không hợp lệ: {item.get("action")}'
+                    }, status=400)
+            
+            scene = DeviceScene.objects.create(user=request.user, name=name, actions=actions)
+            
+            return JsonResponse({
+                'success': True,
+                'message': 'Đã tạo ngữ cảnh thành công',
+                'scene_id': str(scene.id)
+            }, status=201)
+            
+        except Exception as e:
+            return JsonResponse({'success': False, 'message': f'Lỗi: {str(e)}'}, status=400)
+
+@method_decorator(csrf_exempt, name='dispatch')
+class SceneDetailView(View):
+    """API để XÓA một ngữ cảnh"""
+    def delete(self, request, scene_id):
+        if not request.user.is_authenticated:
+            return JsonResponse({'success': False, 'message': 'Chưa đăng nhập'}, status=401)
         
-        # Kết thúc session nếu chuyển từ on sang off
-        elif action in ['off', 'toggle'] and old_is_on:
-            # Tìm session chưa kết thúc
-            active_session = DeviceUsageSession.objects.filter(
-                device=device,
-                end_time__isnull=True
-            ).last()
-            
-            if active_session:
-                active_session.end_time = timezone.now()
-                duration = (active_session.end_time - active_session.start_time).total_seconds() / 60
-                active_session.duration_minutes = int(duration)
-                active_session.save()
-                
-                # Cập nhật tổng thời gian sử dụng
-                stats.total_usage_minutes += active_session.duration_minutes
-                
-                # Tính điện năng tiêu thụ
-                power_rates = {
-                    'light': 0.01,
-                    'led': 0.01,
-                    'fan': 0.05,
-                    'ac': 0.8,
-                    'socket': 0.02,
-                    'door': 0.005,
-                    'dryer': 0.1
-                }
-                
-                power_rate = power_rates.get(device.device_type.lower(), 0.01)
-                hours_used = active_session.duration_minutes / 60
-                stats.power_consumption += power_rate * hours_used
-                stats.cost += stats.power_consumption * 3000  # 3000đ/kWh
-                
-                stats.save()
+        try:
+            scene = DeviceScene.objects.get(id=scene_id, user=request.user)
+            scene.delete()
+            return JsonResponse({'success': True, 'message': 'Đã xóa ngữ cảnh'})
+        except DeviceScene.DoesNotExist:
+            return JsonResponse({'success': False, 'message': 'Ngữ cảnh không tồn tại'}, status=404)
 
 # # devices/views.py - THÊM VIEW MỚI
 
@@ -656,6 +492,62 @@ class DeviceSyncView(View):
                 'success': False,
                 'message': f'Lỗi đồng bộ: {str(e)}'
             }, status=400)
+
+@method_decorator(csrf_exempt, name='dispatch')
+class DeviceStatusPushView(View):
+    def post(self, request):
+        """
+        ESP8266 chủ động gửi trạng thái (cùng format /api/status: LED1, FAN, DOOR, DRY, TEMP, HUM)
+        Body: {...status...} hoặc {"status": {...}}
+        Header X-Device-Token bắt buộc (ESP_PUSH_TOKEN); board xác định theo IP gửi request
+        """
+        push_token = getattr(settings, 'ESP_PUSH_TOKEN', None)
+        if not push_token:
+            return JsonResponse({'success': False, 'message': 'Push chưa được cấu hình (ESP_PUSH_TOKEN)'}, status=403)
+        if not hmac.compare_digest(request.headers.get('X-Device-Token', '').encode(), push_token.encode()):
+            return JsonResponse({'success': False, 'message': 'Token không hợp lệ'}, status=403)
+        
+        try:
+            data = json.loads(request.body)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return JsonResponse({'success': False, 'message': 'JSON không hợp lệ'}, status=400)
+        
+        if not isinstance(data, dict):
+            return JsonResponse({'success': False, 'message': 'JSON không hợp lệ'}, status=400)
+        
+        esp_status = data['status'] if isinstance(data.get('status'), dict) else data
+        # Không tin IP trong body: board nào cũng có thể giả trạng thái board khác
+        esp_ip = request.META.get('REMOTE_ADDR', '').strip()
+        
+        try:
+            from .management.commands.sync_device_status import Command, mark_board_pushed
+            
+            devices = list(Device.objects.filter(ip_address=esp_ip))
+            if not devices:
+                return JsonResponse({
+                    'success': False,
+                    'message': f'Không có thiết bị nào với IP {esp_ip}'
+                }, status=404)
+            
+            # Dùng chung logic mapping + broadcast với poller
+            sync_command = Command()
+            changes_count = sync_command.reconcile_devices({esp_ip: devices}, {esp_ip: esp_status})
+            
+            if Device.objects.filter(ip_address=esp_ip, is_online=False).update(is_online=True):
+                device_cache.invalidate()
+            mark_board_pushed(esp_ip)
+            
+            return JsonResponse({
+                'success': True,
+                'changed_count': changes_count
+            })
+            
+        except Exception as e:
+            print(f"❌ Error in DeviceStatusPushView: {e}")
+            return JsonResponse({
+                'success': False,
+                'message': f'Lỗi: {str(e)}'
+            }, status=400)
 # devices/views.py
 @method_decorator(csrf_exempt, name='dispatch')
 class SensorDataView(View):
@@ -672,8 +564,7 @@ class SensorDataView(View):
                 })
             
             # Gọi ESP8266 để lấy sensor data
-            url = f"http://{sensor_device.ip_address}/sensor"
-            response = requests.get(url, timeout=5)
+            response = esp_client.esp_get(sensor_device.ip_address, '/sensor')
             
             if response.status_code == 200:
                 # Parse sensor data từ ESP8266
@@ -748,7 +639,7 @@ class DeviceLogsView(View):
             return JsonResponse({'success': False, 'message': 'Thiết bị không tồn tại'}, status=404)
 
 # XÓA các view trùng lặp: DeviceUsageStartView, DeviceUsageEndView, và function toggle_device
-# Vì logic đã được tích hợp vào DeviceControlView thông qua _update_device_statistics
+# Vì logic đã được tích hợp vào DeviceControlView thông qua control.update_statistics
 
 @method_decorator(csrf_exempt, name='dispatch')
 class RealStatisticsView(View):
@@ -771,52 +662,11 @@ class RealStatisticsView(View):
                 start_date = timezone.localtime(timezone.now()).date()
                 end_date = start_date
 
-            devices = Device.objects.all()
-            statistics = []
-
-            for device in devices:
-                # Lấy thống kê từ database
-                device_stats = DeviceStatistics.objects.filter(
-                    device=device,
-                    date__range=[start_date, end_date]
-                ).aggregate(
-                    total_turn_on=Sum('turn_on_count'),
-                    total_minutes=Sum('total_usage_minutes'),
-                    total_power=Sum('power_consumption'),
-                    total_cost=Sum('cost')
-                )
-
-                # Lấy sessions sử dụng gần đây
-                recent_sessions = DeviceUsageSession.objects.filter(
-                    device=device,
-                    start_time__date=timezone.now().date()
-                ).order_by('-start_time')[:5]
-
-                usage_data = []
-                for session in recent_sessions:
-                    if session.end_time:
-                        duration_hours = session.duration_minutes / 60.0
-                        usage_data.append({
-                            'time': session.start_time.strftime('%H:%M'),
-                            'duration': round(duration_hours, 1)
-                        })
-
-                # Tính toán dữ liệu
-                total_hours = (device_stats['total_minutes'] or 0) / 60.0
-                power_consumption = device_stats['total_power'] or 0.0
-                cost = device_stats['total_cost'] or 0.0
-                turn_on_count = device_stats['total_turn_on'] or 0
-
-                statistics.append({
-                    'device_id': str(device.id),
-                    'device_name': device.name,
-                    'device_type': device.device_type,
-                    'turn_on_count': turn_on_count,
-                    'total_usage_hours': round(total_hours, 1),
-                    'power_consumption': round(power_consumption, 2),
-                    'cost': round(cost),
-                    'usage_data': usage_data,
-                })
+            # Cache theo period + khoảng ngày (tính lại khi thống kê hôm nay thay đổi)
+            statistics = stats_cache.get_or_compute(
+                'real_statistics', period, start_date, end_date,
+                lambda: self._build_statistics(start_date, end_date)
+            )
 
             return JsonResponse({
                 'success': True,
@@ -829,6 +679,59 @@ class RealStatisticsView(View):
         except Exception as e:
             return JsonResponse({'success': False, 'message': str(e)})
 
+    def _build_statistics(self, start_date, end_date):
+        """Thống kê từng thiết bị: 1 query tổng hợp + 1 query sessions gần nhất"""
+        # Thống kê theo thiết bị: 1 query (LEFT JOIN + GROUP BY)
+        date_filter = Q(statistics__date__range=[start_date, end_date])
+        devices = Device.objects.annotate(
+            total_turn_on=Sum('statistics__turn_on_count', filter=date_filter),
+            total_minutes=Sum('statistics__total_usage_minutes', filter=date_filter),
+            total_power=Sum('statistics__power_consumption', filter=date_filter),
+            total_cost=Sum('statistics__cost', filter=date_filter),
+        )
+
+        # 5 sessions gần nhất hôm nay của mỗi thiết bị: 1 query (window function)
+        recent_sessions = DeviceUsageSession.objects.filter(
+            start_time__date=timezone.localtime(timezone.now()).date()
+        ).annotate(
+            row_number=Window(
+                expression=RowNumber(),
+                partition_by=[F('device_id')],
+                order_by=F('start_time').desc(),
+            )
+        ).filter(row_number__lte=5).order_by('device_id', '-start_time')
+
+        usage_by_device = {}
+        for session in recent_sessions:
+            usage_data = usage_by_device.setdefault(session.device_id, [])
+            if session.end_time:
+                duration_hours = session.duration_minutes / 60.0
+                usage_data.append({
+                    'time': session.start_time.strftime('%H:%M'),
+                    'duration': round(duration_hours, 1)
+                })
+
+        statistics = []
+        for device in devices:
+            # Tính toán dữ liệu
+            total_hours = (device.total_minutes or 0) / 60.0
+            power_consumption = device.total_power or 0.0
+            cost = device.total_cost or 0.0
+            turn_on_count = device.total_turn_on or 0
+
+            statistics.append({
+                'device_id': str(device.id),
+                'device_name': device.name,
+                'device_type': device.device_type,
+                'turn_on_count': turn_on_count,
+                'total_usage_hours': round(total_hours, 1),
+                'power_consumption': round(power_consumption, 2),
+                'cost': round(cost),
+                'usage_data': usage_by_device.get(device.id, []),
+            })
+
+        return statistics
+
 @method_decorator(csrf_exempt, name='dispatch')
 class DeviceStatisticsView(View):
     """API lấy thống kê chi tiết theo thiết bị"""
@@ -838,7 +741,7 @@ class DeviceStatisticsView(View):
             device = Device.objects.get(id=device_id)
             
             # Xác định khoảng thời gian
-            end_date = timezone.now().date()
+            end_date = timezone.localdate()
             if period == 'today':
                 start_date = end_date
             elif period == 'week':
@@ -849,6 +752,8 @@ class DeviceStatisticsView(View):
                 start_date = end_date - timedelta(days=365)
             else:
                 start_date = end_date
+            # Giá điện bậc thang hiện tại theo điện năng cả nhà tháng này
+            month = timezone.localtime(timezone.now()).date().replace(day=1)
 
             # Lấy thống kê tổng hợp
             stats = DeviceStatistics.objects.filter(
@@ -912,8 +817,9 @@ class DeviceStatisticsView(View):
                 },
                 'daily_data': daily_data,
                 'recent_sessions': sessions_data,
-                'power_rate': _get_power_rate(device.device_type),
-                'electricity_price': 2500,
+                'power_rate': tariff.power_kw(device.device_type, device.rated_power_w),
+                'rated_power_w': device.rated_power_w,
+                'electricity_price': tariff.marginal_price(usage.household_month_kwh([month]).get(month, 0.0)),
             })
 
         except Device.DoesNotExist:
@@ -928,8 +834,8 @@ class OverallStatisticsView(View):
         try:
             period = request.GET.get('period', 'today')
             
-            # Xác định khoảng thời gian
-            end_date = timezone.now().date()
+            # Xác định khoảng thời gian (ngày địa phương, giống rollup)
+            end_date = timezone.localtime(timezone.now()).date()
             if period == 'today':
                 start_date = end_date
             elif period == 'week':
@@ -939,71 +845,93 @@ class OverallStatisticsView(View):
             else:
                 start_date = end_date
 
+            # Đọc rollup đã tổng hợp sẵn (cache): các ngày đã qua không đổi nữa,
+            # chỉ phần hôm nay tính lại khi thống kê thay đổi
+            today = end_date
+            pieces = []
+            if start_date < today:
+                pieces.append((start_date, today - timedelta(days=1)))
+            pieces.append((today, today))
+
+            merged = {}
+            for piece_start, piece_end in pieces:
+                rollups = stats_cache.get_or_compute(
+                    'overall_rollups', 'range', piece_start, piece_end,
+                    lambda: self._rollup_totals(piece_start, piece_end)
+                )
+                for rollup in rollups:
+                    key = (rollup['scope'], rollup['scope_key'])
+                    if key not in merged:
+                        merged[key] = dict(rollup)
+                        continue
+                    for field in ('total_usage', 'total_power', 'total_cost', 'total_turn_on'):
+                        merged[key][field] += rollup[field]
+
+            rollups_by_scope = {'device': [], 'room': [], 'type': []}
+            for rollup in merged.values():
+                rollups_by_scope[rollup['scope']].append(rollup)
+
+            device_rollups = rollups_by_scope['device']
+            devices_info = {
+                str(device_id): (name, device_type, room)
+                for device_id, name, device_type, room in Device.objects.filter(
+                    id__in=[rollup['scope_key'] for rollup in device_rollups]
+                ).values_list('id', 'name', 'device_type', 'room')
+            }
+
             # Thống kê tổng hợp
-            overall_stats = DeviceStatistics.objects.filter(
-                date__range=[start_date, end_date]
-            ).aggregate(
-                total_turn_on=Sum('turn_on_count'),
-                total_usage_minutes=Sum('total_usage_minutes'),
-                total_power=Sum('power_consumption'),
-                total_cost=Sum('cost'),
-                device_count=Count('device', distinct=True)
-            )
+            overall_stats = {
+                'total_turn_on': sum(rollup['total_turn_on'] for rollup in device_rollups),
+                'total_usage_minutes': sum(rollup['total_usage'] for rollup in device_rollups),
+                'total_power': sum(rollup['total_power'] for rollup in device_rollups),
+                'total_cost': sum(rollup['total_cost'] for rollup in device_rollups),
+                'device_count': len(device_rollups),
+            }
 
-            # Thống kê theo loại thiết bị
-            stats_by_type = DeviceStatistics.objects.filter(
-                date__range=[start_date, end_date]
-            ).values('device__device_type').annotate(
-                total_usage=Sum('total_usage_minutes'),
-                total_cost=Sum('cost'),
-                total_turn_on=Sum('turn_on_count'),
-                device_count=Count('device', distinct=True)
-            )
+            # Số thiết bị có sử dụng theo loại / phòng
+            type_device_count = {}
+            room_device_count = {}
+            for name, device_type, room in devices_info.values():
+                type_device_count[device_type] = type_device_count.get(device_type, 0) + 1
+                room_device_count[room] = room_device_count.get(room, 0) + 1
 
+            # Thống kê theo loại thiết bị
             device_type_stats = []
-            for stat in stats_by_type:
+            for stat in rollups_by_scope['type']:
                 device_type_stats.append({
-                    'type': stat['device__device_type'],
-                    'type_name': dict(Device.DEVICE_TYPES).get(stat['device__device_type'], 'Khác'),
+                    'type': stat['scope_key'],
+                    'type_name': dict(Device.DEVICE_TYPES).get(stat['scope_key'], 'Khác'),
                     'total_usage_hours': round(stat['total_usage'] / 60, 1),
                     'total_cost': round(stat['total_cost']),
                     'total_turn_on': stat['total_turn_on'],
-                    'device_count': stat['device_count'],
+                    'device_count': type_device_count.get(stat['scope_key'], 0),
                 })
 
             # Thống kê theo phòng
-            stats_by_room = DeviceStatistics.objects.filter(
-                date__range=[start_date, end_date]
-            ).values('device__room').annotate(
-                total_usage=Sum('total_usage_minutes'),
-                total_cost=Sum('cost'),
-                device_count=Count('device', distinct=True)
-            )
-
             room_stats = []
-            for stat in stats_by_room:
+            for stat in rollups_by_scope['room']:
                 room_stats.append({
-                    'room': stat['device__room'],
-                    'room_name': dict(Device.ROOM_CHOICES).get(stat['device__room'], 'Khác'),
+                    'room': stat['scope_key'],
+                    'room_name': dict(Device.ROOM_CHOICES).get(stat['scope_key'], 'Khác'),
                     'total_usage_hours': round(stat['total_usage'] / 60, 1),
                     'total_cost': round(stat['total_cost']),
-                    'device_count': stat['device_count'],
+                    'device_count': room_device_count.get(stat['scope_key'], 0),
                 })
 
             # Thiết bị sử dụng nhiều nhất
-            top_devices = DeviceStatistics.objects.filter(
-                date__range=[start_date, end_date]
-            ).values('device__id', 'device__name', 'device__device_type').annotate(
-                total_usage=Sum('total_usage_minutes'),
-                total_cost=Sum('cost')
-            ).order_by('-total_usage')[:5]
+            top_devices = sorted(
+                (rollup for rollup in device_rollups if rollup['scope_key'] in devices_info),
+                key=lambda rollup: rollup['total_usage'],
+                reverse=True
+            )[:5]
 
             top_usage_devices = []
             for device in top_devices:
+                name, device_type, room = devices_info[device['scope_key']]
                 top_usage_devices.append({
-                    'id': device['device__id'],
-                    'name': device['device__name'],
-                    'type': device['device__device_type'],
+                    'id': device['scope_key'],
+                    'name': name,
+                    'type': device_type,
                     'usage_hours': round(device['total_usage'] / 60, 1),
                     'cost': round(device['total_cost']),
                 })
@@ -1027,46 +955,62 @@ class OverallStatisticsView(View):
         except Exception as e:
             return JsonResponse({'success': False, 'message': str(e)})
 
+    def _rollup_totals(self, start_date, end_date):
+        """Tổng rollup theo (scope, scope_key) trong khoảng ngày: 1 query"""
+        return list(UsageRollup.objects.filter(
+            usage.period_filter(start_date, end_date)
+        ).values('scope', 'scope_key').annotate(
+            total_usage=Sum('usage_minutes'),
+            total_power=Sum('power_consumption'),
+            total_cost=Sum('cost'),
+            total_turn_on=Sum('turn_on_count'),
+        ))
+
 @method_decorator(csrf_exempt, name='dispatch')
 class RealTimeUsageView(View):
     """API theo dõi sử dụng real-time"""
     def get(self, request):
         try:
-            # Thiết bị đang bật
-            active_devices = Device.objects.filter(is_on=True)
+            # Thiết bị đang bật có session đang chạy: 1 query (current_session_start có index)
+            active_devices = Device.objects.filter(
+                is_on=True,
+                current_session_start__isnull=False
+            ).only('id', 'name', 'device_type', 'rated_power_w', 'current_session_start')
             
             active_devices_data = []
+            active_kwh = []
             total_active_power = 0.0
+            now = timezone.now()  # Giữ consistent
             
             for device in active_devices:
-                # Tìm session đang chạy
-                active_session = DeviceUsageSession.objects.filter(
-                    device=device,
-                    end_time__isnull=True
-                ).first()
+                usage_duration = now - device.current_session_start
+                usage_minutes = round(usage_duration.total_seconds() / 60)
+                power_rate = tariff.power_kw(device.device_type, device.rated_power_w)
+                active_kwh.append(power_rate * (usage_minutes / 60))
                 
-                if active_session:
-                    now = timezone.now()  # Giữ consistent
-                    usage_duration = now - active_session.start_time
-                    usage_minutes = round(usage_duration.total_seconds() / 60)
-                    power_rate = _get_power_rate(device.device_type)
-                    estimated_cost = (power_rate * (usage_minutes / 60)) * 2500
-                    
-                    active_devices_data.append({
-                        'device_id': str(device.id),
-                        'device_name': device.name,
-                        'device_type': device.device_type,
-                        'start_time': active_session.start_time.isoformat(),
-                        'usage_minutes': usage_minutes,
-                        'usage_hours': round(usage_minutes / 60, 2),
-                        'power_consumption': round(power_rate * (usage_minutes / 60), 3),
-                        'estimated_cost': round(estimated_cost),
-                    })
-                    
-                    total_active_power += power_rate
+                active_devices_data.append({
+                    'device_id': str(device.id),
+                    'device_name': device.name,
+                    'device_type': device.device_type,
+                    'start_time': device.current_session_start.isoformat(),
+                    'usage_minutes': usage_minutes,
+                    'usage_hours': round(usage_minutes / 60, 2),
+                    'power_consumption': round(power_rate * (usage_minutes / 60), 3),
+                })
+                
+                total_active_power += power_rate
+
+            # Tiền điện ước tính: bậc thang trên điện năng cả nhà đã dùng tháng này (1 lượt)
+            month = timezone.localtime(now).date().replace(day=1)
+            estimated_costs = tariff.marginal_costs(
+                active_kwh,
+                usage.household_month_kwh([month]).get(month, 0.0)
+            )
+            for data, estimated_cost in zip(active_devices_data, estimated_costs):
+                data['estimated_cost'] = round(estimated_cost)
 
             # Thống kê hôm nay
-            today = timezone.now().date()
+            today = timezone.localdate()
             today_stats = DeviceStatistics.objects.filter(
                 date=today
             ).aggregate(
@@ -1091,6 +1035,15 @@ class RealTimeUsageView(View):
         except Exception as e:
             return JsonResponse({'success': False, 'message': str(e)})
 @method_decorator(csrf_exempt, name='dispatch')
+class StatisticsCacheView(View):
+    def get(self, request):
+        """API xem hit / miss của cache thống kê"""
+        return JsonResponse({
+            'success': True,
+            'counters': stats_cache.counters(),
+        })
+
+@method_decorator(csrf_exempt, name='dispatch')
 class DebugStatsView(View):
     def get(self, request):
         """API debug để kiểm tra chi tiết sessions và statistics"""
@@ -1160,17 +1113,22 @@ class CleanupSessionsView(View):
     def post(self, request):
         """Dọn dẹp các sessions đang chạy"""
         try:
-            active_sessions = DeviceUsageSession.objects.filter(end_time__isnull=True)
+            active_sessions = DeviceUsageSession.objects.filter(end_time__isnull=True).select_related('device')
             count = active_sessions.count()
             
+            closed_sessions = []
             for session in active_sessions:
                 session.end_time = timezone.now()
                 duration = session.end_time - session.start_time
                 session.duration_minutes = int(duration.total_seconds() / 60)
                 session.save()
+                closed_sessions.append((session.device, session))
                 
                 print(f"🧹 Cleaned session: {session.device.name}, duration: {session.duration_minutes}min")
             
+            usage.record_closed_sessions(closed_sessions)
+            Device.objects.filter(current_session_start__isnull=False).update(current_session_start=None)
+            
             return JsonResponse({
                 'success': True,
                 'message': f'Đã dọn dẹp {count} sessions đang chạy',
@@ -1182,7 +1140,7 @@ class CleanupSessionsView(View):
         
 # devices/views.py
 # ... (imports đã có)
-from .models import Device, DeviceLog, DeviceStatistics, DeviceUsageSession, DeviceSchedule # Thêm DeviceSchedule
+from .models import Device, DeviceStatistics, DeviceUsageSession, DeviceSchedule # Thêm DeviceSchedule
 from django.utils import timezone
 
 # ... (Các views DeviceListView, DeviceControlView, v.v. giữ nguyên)
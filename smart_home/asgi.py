@@ -1,11 +1,18 @@
 import os
 from django.core.asgi import get_asgi_application
+from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'smart_home.settings')
 
+# Khởi tạo Django trước khi import routing (consumers dùng models)
+django_asgi_app = get_asgi_application()
+
+from devices.routing import websocket_urlpatterns  # noqa: E402
+
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
-    # Nếu bạn có websocket routing:
-    "websocket": URLRouter([]),
+    "http": django_asgi_app,
+    "websocket": AuthMiddlewareStack(
+        URLRouter(websocket_urlpatterns)
+    ),
 })
@@ -94,6 +94,49 @@ CHANNEL_LAYERS = {
     },
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/1',
+    }
+}
+
+# HTTP client dùng chung cho ESP8266 (devices/esp_client.py)
+ESP_HTTP_TIMEOUT = 5  # Timeout lệnh điều khiển (giây)
+ESP_STATUS_TIMEOUT = 3  # Timeout poll /api/status (giây)
+ESP_HTTP_RETRIES = 1  # Chỉ retry lỗi kết nối
+ESP_HTTP_BACKOFF = 0.1
+ESP_HTTP_POOL_CONNECTIONS = 64  # Số host (board) giữ pool
+ESP_HTTP_POOL_MAXSIZE = 4  # Số kết nối keep-alive tối đa mỗi board
+
+# Hàng đợi lệnh theo board (devices/command_queue.py)
+ESP_COMMAND_REDIS_URL = 'redis://127.0.0.1:6379/1'  # Redis cho lock board / lệnh mới nhất
+ESP_COMMAND_TTL = 60  # Thời gian giữ trạng thái mong muốn của device (giây)
+ESP_BOARD_LOCK_TTL = 15  # Lock tối đa cho 1 lệnh đến board (giây)
+ESP_BOARD_LOCK_WAIT = 10  # Thời gian chờ board rảnh ở chế độ đồng bộ (giây)
+ESP_BULK_CONCURRENCY = 16  # Số board gửi lệnh song song khi điều khiển hàng loạt
+
+# ESP8266 push trạng thái (POST /api/devices/push/)
+# Chuỗi bí mật board gửi trong header X-Device-Token; chưa đặt thì endpoint push bị tắt
+ESP_PUSH_TOKEN = os.environ.get('ESP_PUSH_TOKEN')
+ESP_PUSH_FALLBACK_SECONDS = 60  # Board đã push trong khoảng này thì poller bỏ qua
+
+# Lease của 1 lần claim lịch hẹn (giây): quá hạn chưa hoàn tất thì worker khác claim lại
+SCHEDULE_LEASE_SECONDS = 120
+
+# WebSocket: gom cập nhật device trong cửa sổ này (giây) rồi gửi 1 message mỗi group
+REALTIME_BATCH_WINDOW = 0.5
+# Ring buffer thay đổi gần nhất cho client kết nối lại (resume)
+REALTIME_RING_SIZE = 1000
+REALTIME_RING_TTL = 3600
+
+# Snapshot danh sách thiết bị (DeviceListView) trong Redis
+DEVICE_LIST_CACHE_TTL = 300
+
+# Cache thống kê: kết quả có ngày hôm nay / chỉ gồm ngày đã qua hết hạn sau các TTL này (giây)
+STATS_CACHE_TODAY_TTL = 300
+STATS_CACHE_HISTORY_TTL = 7 * 24 * 3600
+
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases